@@ -0,0 +1,45 @@
+"""create store_status_hourly
+
+Revision ID: 5b2e8c41d7a3
+Revises: c3fcb4a9500e
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b2e8c41d7a3'
+down_revision: Union[str, None] = 'c3fcb4a9500e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('store_status_hourly',
+    sa.Column('store_id', sa.BigInteger(), nullable=False),
+    sa.Column('hour_start', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('uptime_minutes', sa.Float(), nullable=False),
+    sa.Column('downtime_minutes', sa.Float(), nullable=False),
+    sa.Column('expected_minutes', sa.Float(), nullable=False),
+    sa.Column('last_status', postgresql.ENUM('ACTIVE', 'INACTIVE', name='activitystatus', create_type=False), nullable=True),
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('created_by', sa.String(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_by', sa.String(), nullable=True),
+    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+    sa.Column('deleted_by', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['store_id'], ['stores.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_store_status_hourly_store_id_hour_start', 'store_status_hourly', ['store_id', 'hour_start'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_store_status_hourly_store_id_hour_start', table_name='store_status_hourly')
+    op.drop_table('store_status_hourly')
@@ -0,0 +1,102 @@
+from sqlalchemy import func, select, update
+from sqlalchemy.engine import Result
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Generic, Type, List, Optional, Dict, Any, Sequence, Tuple
+from .crud import BaseCRUDService, Column, T
+from . import instrumentation
+
+
+class AsyncBaseCRUDService(Generic[T]):
+    """BaseCRUDService for an AsyncSession, for code running on the event loop.
+
+    Queries are built exactly like the sync service's, including the findAllByAttributes operators.
+    Relationships are not lazy loaded on an AsyncSession, anything needed has to be selected up front.
+    Writes drop the cache_tags of the service once the session commits, like the sync service.
+    """
+    cache_tags: Tuple[str, ...] = ()
+
+    def __init__(self, model: Type[T]):
+        self.model = model
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrumentation.tag_methods(cls)
+
+    selectColumns = BaseCRUDService.selectColumns
+    _column = BaseCRUDService._column
+    _apply_filters = BaseCRUDService._apply_filters
+    #an AsyncSession shares info, and so the tags to drop, with the Session it wraps
+    _invalidate_cached = BaseCRUDService._invalidate_cached
+
+    async def findOne(self, db: AsyncSession, **kwargs) -> Optional[T]:
+        return (await db.scalars(select(self.model).filter_by(**kwargs).limit(1))).first()
+
+    async def findOneBy(self, db: AsyncSession, **kwargs) -> Optional[T]:
+        return await self.findOne(db, **kwargs)
+
+    async def findOneById(self, db: AsyncSession, id: int) -> Optional[T]:
+        return await db.get(self.model, id)
+
+    async def findAll(self, db: AsyncSession, skip: int = 0, limit: int = 100) -> List[T]:
+        return list(await db.scalars(select(self.model).offset(skip).limit(limit)))
+
+    async def findAllBy(self, db: AsyncSession, skip: int = 0, limit: int = 100, **kwargs) -> List[T]:
+        return list(await db.scalars(select(self.model).filter_by(**kwargs).offset(skip).limit(limit)))
+
+    async def findAllByAttributes(self, db: AsyncSession, skip: int = 0, limit: int = 100, **kwargs) -> List[T]:
+        return list(await db.scalars(self._apply_filters(select(self.model), kwargs).offset(skip).limit(limit)))
+
+    async def findColumns(self, db: AsyncSession, columns: Sequence[Column], order_by: Sequence[Column] = (), limit: Optional[int] = None, **kwargs) -> Result:
+        #buffered plain rows, like the sync findColumns without a server side cursor
+        query = self.selectColumns(columns, order_by, **kwargs)
+        if limit is not None:
+            query = query.limit(limit)
+        return await db.execute(query)
+
+    async def create(self, db: AsyncSession, obj_in: dict) -> T:
+        self._invalidate_cached(db)
+        db_obj = self.model(**obj_in)
+        db.add(db_obj)
+        await db.commit()
+        await db.refresh(db_obj)
+        return db_obj
+
+    async def createMultiple(self, db: AsyncSession, objs_in: List[dict]) -> List[T]:
+        self._invalidate_cached(db)
+        db_objs = [self.model(**obj_in) for obj_in in objs_in]
+        db.add_all(db_objs)
+        await db.commit()
+        for db_obj in db_objs:
+            await db.refresh(db_obj)
+        return db_objs
+
+    async def findAndUpdate(self, db: AsyncSession, filter_by: dict, update_data: dict) -> Optional[T]:
+        self._invalidate_cached(db)
+        instance = await self.findOneBy(db, **filter_by)
+        if instance:
+            for key, value in update_data.items():
+                setattr(instance, key, value)
+            await db.commit()
+            await db.refresh(instance)
+        return instance
+
+    async def updateMultiple(self, db: AsyncSession, filter_by: dict, update_data: dict) -> int:
+        self._invalidate_cached(db)
+        return (await db.execute(update(self.model).filter_by(**filter_by).values(**update_data))).rowcount
+
+    async def delete(self, db: AsyncSession, id: int, soft: bool = True) -> Optional[T]:
+        self._invalidate_cached(db)
+        obj = await self.findOneById(db, id)
+        if obj:
+            if soft:
+                setattr(obj, 'is_deleted', True)
+            else:
+                await db.delete(obj)
+            await db.commit()
+        return obj
+
+    async def count(self, db: AsyncSession, **kwargs) -> int:
+        return await db.scalar(select(func.count(self.model.id)).filter_by(**kwargs))
+
+
+instrumentation.tag_methods(AsyncBaseCRUDService)
@@ -1,85 +1,112 @@
 import csv
+import os
+import sys
 from datetime import datetime, time
-from io import StringIO
-import uuid
-from app.business_hour.model import BusinessHour, DayOfWeek
-from app.models import Store
+from itertools import islice
+from typing import Dict, Iterator, List, Set, Tuple
+from app.business_hour.model import DayOfWeek
 from app.database import engine
+from app.services import business_hour_service, status_service, store_service, store_status_hourly_service
 from app.store_status.enum import ActivityStatus
+from app.store_status.ingest import parse_timestamp
 from sqlalchemy.orm import Session
 import pytz
 
-def parse_timestamp(timestamp_str):
-    for fmt in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S']:
-        try:
-            return datetime.strptime(timestamp_str, fmt)
-        except ValueError:
-            continue
+#rows parsed, checked for missing stores and copied per chunk, so memory stays flat whatever the file size
+CHUNK_ROWS = 100000
+STATUSES = {status.value: status for status in ActivityStatus}
+
+
+def read_chunks(csv_path: str, chunk_rows: int = CHUNK_ROWS, start_offset: int = 0) -> Iterator[Tuple[Dict[str, List], int]]:
+    """Column lists of chunk_rows rows at a time, with the byte offset in the file right after the chunk.
+
+    start_offset skips to a line start, such as an offset printed by an earlier run. Rows are one per
+    line, quoted fields spanning lines are not supported.
+    """
+    with open(csv_path, mode='rb') as file:
+        header = next(csv.reader([file.readline().decode()]))
+        store_id_at, status_at, timestamp_at = header.index('store_id'), header.index('status'), header.index('timestamp_utc')
+        if start_offset:
+            file.seek(start_offset)
+        offset = file.tell()
+        while True:
+            lines = list(islice(file, chunk_rows))
+            if not lines:
+                return
+            offset += sum(len(line) for line in lines)
+            store_ids, statuses, timestamps = [], [], []
+            for row in csv.reader(line.decode() for line in lines):
+                if not row:
+                    continue
+                store_ids.append(int(row[store_id_at]))
+                statuses.append(STATUSES[row[status_at].strip().lower()])
+                timestamps.append(parse_timestamp(row[timestamp_at]))
+            yield {'store_id': store_ids, 'status': statuses, 'timestamp': timestamps}, offset
 
-def backfill_store_status(csv_path: str, db: Session):
-    stores_dict = {store.id: store for store in db.query(Store).all()}
-    
-    # Prepare data for COPY
-    copy_data = []
-    new_stores = set()
 
-    with open(csv_path, mode='r') as file:
-        reader = csv.DictReader(file)
-        for i, row in enumerate(reader, start=1):
-            store_id = int(row['store_id'])
-            if store_id not in stores_dict:
-                new_stores.add(store_id)
-            
-            timestamp = pytz.utc.localize(parse_timestamp(row['timestamp_utc']))
-            current_timestamp = datetime.now(pytz.utc)
-            status_id = uuid.uuid4().int & (1<<63)-1
-            #status_id, store_id, status, timestamp, created_by, created_at, updated_by, updated_at
-            copy_data.append(f"{status_id}\t{store_id}\t{ActivityStatus[row['status'].upper()].value.upper()}\t{timestamp}\tbackfill_script\t{current_timestamp}\tbackfill_script\t{current_timestamp}\n")
+def insert_missing_stores(db: Session, store_ids: Set[int]) -> None:
+    #stores only seen in the status dump, open around the clock in America/Chicago
+    store_service.bulkInsert(db, [
+        {
+            'id': store_id,
+            'timezone': 'America/Chicago',
+            'created_by': 'missing_store_backfill',
+            'updated_by': 'missing_store_backfill'
+        }
+        for store_id in store_ids
+    ], commit=False)
+    business_hour_service.bulkInsert(db, [
+        {
+            'store_id': store_id,
+            'day_of_week': day,
+            'start_time': pytz.timezone('America/Chicago').localize(datetime.combine(datetime.now().date(), time(0, 0))).timetz(),
+            'end_time': pytz.timezone('America/Chicago').localize(datetime.combine(datetime.now().date(), time(23, 59, 59))).timetz(),
+            'created_by': 'missing_store_backfill',
+            'updated_by': 'missing_store_backfill'
+        }
+        for store_id in store_ids
+        for day in DayOfWeek
+    ], commit=False)
+
+
+def backfill_store_status(csv_path: str, db: Session, start_offset: int = 0, chunk_rows: int = CHUNK_ROWS):
+    #every chunk commits with the stores it needs, a failed run can be resumed from the last offset printed
+    known_stores = set(store_service.find_ids(db))
+    file_size = os.path.getsize(csv_path)
+    first_timestamp, last_timestamp = None, None
+    total_rows, total_new_stores = 0, 0
+
+    for columns, offset in read_chunks(csv_path, chunk_rows, start_offset):
+        if not columns['store_id']:
+            continue
+        new_stores = set(columns['store_id']) - known_stores
+        if new_stores:
+            insert_missing_stores(db, new_stores)
+            known_stores |= new_stores
+            total_new_stores += len(new_stores)
 
-            if i % 100000 == 0:
-                print(f"Processed {i} rows...")
+        status_service.bulkInsert(db, {
+            **columns,
+            'created_by': 'backfill_script',
+            'updated_by': 'backfill_script',
+        }, batch_size=len(columns['store_id']), binary=True)
 
-    print(f"CSV processing complete. Total rows: {i}")
-    print(f"Number of new stores found: {len(new_stores)}")
+        chunk_first, chunk_last = min(columns['timestamp']), max(columns['timestamp'])
+        first_timestamp = chunk_first if first_timestamp is None else min(first_timestamp, chunk_first)
+        last_timestamp = chunk_last if last_timestamp is None else max(last_timestamp, chunk_last)
+        total_rows += len(columns['store_id'])
+        print(f"Copied {total_rows} rows, {offset}/{file_size} bytes ({offset * 100 / max(file_size, 1):.1f}%), {total_new_stores} new stores")
 
-    # Handle new stores
-    for store_id in new_stores:
-        new_store = Store(
-            id=store_id,
-            timezone='America/Chicago',
-            created_by='missing_store_backfill',
-            updated_by='missing_store_backfill'
-        )
-        db.add(new_store)
-        
-        for day in DayOfWeek:
-            business_hour = BusinessHour(
-                store_id=store_id,
-                day_of_week=day,
-                start_time=pytz.timezone('America/Chicago').localize(datetime.combine(datetime.now().date(), time(0, 0))),
-                end_time=pytz.timezone('America/Chicago').localize(datetime.combine(datetime.now().date(), time(23, 59, 59))),
-                created_by='missing_store_backfill',
-                updated_by='missing_store_backfill'
-            )
-            db.add(business_hour)
-    
-    db.commit()
+    print(f"Inserted {total_rows} rows of store status data")
 
-    print("starting bulk insert of store status data...")
-    # Use COPY for bulk insert
-    conn = engine.raw_connection()
-    with conn.cursor() as cur:
-        cur.copy_from(
-            StringIO(''.join(copy_data)),
-            'store_status',
-            columns=('id', 'store_id', 'status', 'timestamp', 'created_by', 'created_at', 'updated_by', 'updated_at')
-        )
-    conn.commit()
-    
-    print(f"Inserted {len(copy_data)} rows of store status data")
+    if first_timestamp is not None:
+        print("rebuilding hourly rollups...")
+        store_status_hourly_service.refresh(first_timestamp, last_timestamp)
 
 if __name__ == '__main__':
     csv_path = 'app/csv/store_status.csv'
+    #python -m app.backfill.copy_store_status [byte offset to resume from]
+    start_offset = int(sys.argv[1]) if len(sys.argv) > 1 else 0
     with Session(engine) as db:
-        backfill_store_status(csv_path, db)
-    print("Store status backfill completed successfully.")
\ No newline at end of file
+        backfill_store_status(csv_path, db, start_offset)
+    print("Store status backfill completed successfully.")
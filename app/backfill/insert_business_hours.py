@@ -1,8 +1,9 @@
 import csv
 from datetime import datetime, time
 from app.business_hour.model import DayOfWeek
-from app.models import BusinessHour, Store
+from app.models import Store
 from app.database import engine
+from app.services import business_hour_service, store_service
 from sqlalchemy.orm import Session
 import pytz
 
@@ -14,6 +15,7 @@ def backfill_business_hours(csv_path: str, db: Session):
     business_hours = {store_id: {} for store_id in stores}
 
     current_date = datetime.now().date()
+    new_stores = []
     additional_stores = 0
     missing_business_hours = 0
 
@@ -31,7 +33,7 @@ def backfill_business_hours(csv_path: str, db: Session):
                     created_by='missing_store_backfill',
                     updated_by='missing_store_backfill'
                 )
-                db.add(store)
+                new_stores.append({'id': store.id, 'timezone': store.timezone, 'created_by': store.created_by, 'updated_by': store.updated_by})
                 stores[store_id] = store
                 business_hours[store_id] = {}
                 additional_stores += 1
@@ -45,6 +47,7 @@ def backfill_business_hours(csv_path: str, db: Session):
             if index % 1000 == 0:
                 print(f"Processed {index} of {total_rows} rows ({index/total_rows:.2%})")
 
+    store_service.bulkInsert(db, new_stores)
     print(f"\nAdditional stores added: {additional_stores}")
     
     batch_size = 1000
@@ -63,26 +66,25 @@ def backfill_business_hours(csv_path: str, db: Session):
                 tz.localize(datetime.combine(current_date, time.fromisoformat('23:59:59')))
             ))
 
-            business_hour = BusinessHour(
-                store_id=store_id,
-                day_of_week=DayOfWeek(day),
-                start_time=start_time,
-                end_time=end_time,
-                created_by='backfill_script',
-                updated_by='backfill_script'
-            )
+            business_hour = {
+                'store_id': store_id,
+                'day_of_week': DayOfWeek(day),
+                #local wall clock with its offset, a datetime would be shifted to the session timezone
+                'start_time': start_time.timetz(),
+                'end_time': end_time.timetz(),
+                'created_by': 'backfill_script',
+                'updated_by': 'backfill_script'
+            }
             batch.append(business_hour)
             processed_business_hours += 1
 
             if len(batch) >= batch_size:
-                db.bulk_save_objects(batch)
-                db.commit()
+                business_hour_service.bulkInsert(db, batch, batch_size=batch_size)
                 batch.clear()
                 print(f"Inserted {processed_business_hours} of {total_business_hours} business hours ({processed_business_hours/total_business_hours:.2%})")
 
     if batch:
-        db.bulk_save_objects(batch)
-        db.commit()
+        business_hour_service.bulkInsert(db, batch, batch_size=batch_size)
 
     print(f"\nMissing business hours filled: {missing_business_hours}")
     print(f"Total business hours inserted: {total_business_hours}")
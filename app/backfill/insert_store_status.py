@@ -1,126 +1,137 @@
 import csv
-from datetime import datetime, time
-from app.business_hour.model import BusinessHour, DayOfWeek
-from app.models import Store, StoreStatus
-from app.store_status.enum import ActivityStatus
-from app.database import engine
+import io
+import os
+import threading
+from datetime import datetime
+from typing import Iterator, List, NamedTuple, Optional, Tuple, Union
+from multiprocessing import Pool, cpu_count
+import numpy as np
+from app.backfill.copy_store_status import STATUSES, insert_missing_stores
+from app.crud import CopyPayload
+from app.database import current_session, engine, reset_after_fork
+from app.services import status_service, store_service, store_status_hourly_service
+from app.store_status.ingest import parse_timestamp
 from sqlalchemy.orm import Session
-import pytz
-from multiprocessing import Pool, cpu_count, Manager
 
-
-#time data is in multiple formats, so we try both
-def parse_timestamp(timestamp_str):
-    for fmt in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S']:
-        try:
-            return datetime.strptime(timestamp_str, fmt)
-        except ValueError:
+#each worker parses a newline aligned byte range of about this size at a time
+RANGE_BYTES = 8 * 1024 * 1024
+
+
+class ParsedRange(NamedTuple):
+    #one byte range of the csv, parsed in a worker
+    start: int
+    end: int
+    store_ids: np.ndarray  #the distinct store ids of the range
+    rows: Union[CopyPayload, dict]  #COPY input when the database takes COPY, column lists otherwise
+    count: int
+    first_timestamp: Optional[datetime]
+    last_timestamp: Optional[datetime]
+
+
+def byte_ranges(csv_path: str, range_bytes: int = RANGE_BYTES) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """The csv header and [start, end) byte ranges covering every row, each starting and ending on a line boundary."""
+    size = os.path.getsize(csv_path)
+    ranges = []
+    with open(csv_path, mode='rb') as file:
+        header = next(csv.reader([file.readline().decode()]))
+        start = file.tell()
+        while start < size:
+            #the range runs to the end of the line its nominal end falls in
+            file.seek(min(start + range_bytes, size) - 1)
+            file.readline()
+            end = min(file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return header, ranges
+
+
+def parse_range(args) -> ParsedRange:
+    csv_path, header, start, end, copy = args
+    with open(csv_path, mode='rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    store_id_at, status_at, timestamp_at = header.index('store_id'), header.index('status'), header.index('timestamp_utc')
+
+    store_ids, statuses, timestamps = [], [], []
+    for row in csv.reader(io.StringIO(data.decode())):
+        if not row:
             continue
-
-def process_batch(batch, stores_dict):
-    records = []
-    new_stores = []
-    for row in batch:
-        store_id = int(row['store_id'])
-        store = stores_dict.get(store_id)
-        if not store:
-            new_stores.append(store_id)
-
-        records.append(StoreStatus(
-            store_id=store_id,
-            status=ActivityStatus(row['status']),
-            timestamp=pytz.utc.localize(parse_timestamp(row['timestamp_utc'])),
-            created_by='backfill_script',
-            updated_by='backfill_script'
-        ))
-    return records, new_stores
-
-
-def insert_records(db, records):
-    db.bulk_save_objects(records)
-    db.commit()
-
-
-def backfill_store_status(csv_path: str, db: Session):
-    with open(csv_path, mode='r') as file:
-        total_rows = sum(1 for row in csv.DictReader(file))
-
-    # Use a Manager to create a shared dictionary
-    with Manager() as manager:
-        stores_dict = manager.dict()
-        stores_dict.update(
-            {store.id: store for store in db.query(Store).all()})
-
-        # Create a pool of workers
-        pool = Pool(processes=cpu_count())
-
-        batch_size = 10000
-        batch = []
-        total_records = []
-
-        with open(csv_path, mode='r') as file:
-            reader = csv.DictReader(file)
-            for index, row in enumerate(reader, start=1):
-                batch.append(row)
-                if len(batch) == batch_size:
-                    # Process batch in parallel
-                    batch_result = pool.apply_async(
-                        process_batch, (batch, stores_dict))
-                    batch_records, new_store_ids = batch_result.get()
-                    total_records.extend(batch_records)
-
-                    # Handle new stores
-                    for store_id in new_store_ids:
-                        if store_id not in stores_dict:
-                            new_store = Store(
-                                id=store_id,
-                                timezone='America/Chicago',
-                                created_by='missing_store_backfill',
-                                updated_by='missing_store_backfill'
-                            )
-                            db.add(new_store)
-                            db.commit()
-                            stores_dict[store_id] = new_store
-
-                            current_date = datetime.now().date()
-                            for day in DayOfWeek:
-                                business_hour = BusinessHour(
-                                    store_id=store_id,
-                                    day_of_week=day,
-                                    start_time=pytz.timezone('America/Chicago').localize(
-                                        datetime.combine(current_date, time.fromisoformat('00:00:00'))),
-                                    end_time=pytz.timezone('America/Chicago').localize(
-                                        datetime.combine(current_date, time.fromisoformat('23:59:59'))),
-                                    created_by='missing_store_backfill',
-                                    updated_by='missing_store_backfill'
-                                )
-                                db.add(business_hour)
-                            db.commit()
-
-                    batch = []
-
-                # Batch insert when we have enough records
-                if len(total_records) >= 50000:
-                    insert_records(db, total_records)
-                    total_records = []
-
-                if index % 100000 == 0:
-                    print(f"Processed {index} rows",)
-
-        # Process any remaining rows in the last batch
-        if batch:
-            batch_result = pool.apply_async(
-                process_batch, (batch, stores_dict))
-            batch_records, _ = batch_result.get()
-            total_records.extend(batch_records)
-
-        # Insert any remaining records
-        if total_records:
-            insert_records(db, total_records)
-            print("Inserted remaining records", len(total_records))
-
-        pool.close()
-        pool.join()
+        store_ids.append(int(row[store_id_at]))
+        statuses.append(STATUSES[row[status_at].strip().lower()])
+        timestamps.append(parse_timestamp(row[timestamp_at]))
+
+    columns = {
+        'store_id': store_ids,
+        'status': statuses,
+        'timestamp': timestamps,
+        'created_by': 'backfill_script',
+        'updated_by': 'backfill_script',
+    }
+    #encoding the COPY input here leaves the writer nothing to do but send it
+    rows = status_service.encodeCopy(columns) if copy else columns
+    return ParsedRange(
+        start, end, np.unique(np.asarray(store_ids, dtype=np.int64)), rows, len(store_ids),
+        min(timestamps) if timestamps else None, max(timestamps) if timestamps else None,
+    )
+
+
+def parse_ranges(csv_path: str, copy: bool, processes: int = cpu_count(), range_bytes: int = RANGE_BYTES) -> Iterator[ParsedRange]:
+    """Parsed ranges of the csv in whatever order workers finish them, while the rest are still being parsed.
+
+    At most two ranges per worker are parsed ahead of the caller, so a slow writer holds the workers back
+    instead of parsed ranges piling up in memory.
+    """
+    if current_session() is not None:
+        #forked workers would inherit the open session and its connection
+        raise RuntimeError("parse_ranges forks worker processes, call it outside of session_scope()")
+    header, ranges = byte_ranges(csv_path, range_bytes)
+    window = threading.BoundedSemaphore(processes * 2)
+
+    def pending() -> Iterator[tuple]:
+        #pulled by the pool's task feeder thread, which waits here while the window is full
+        for start, end in ranges:
+            window.acquire()
+            yield csv_path, header, start, end, copy
+
+    with Pool(processes=processes, initializer=reset_after_fork) as pool:
+        for parsed in pool.imap_unordered(parse_range, pending()):
+            try:
+                yield parsed
+            finally:
+                window.release()
+
+
+def backfill_store_status(csv_path: str, db: Session, processes: int = cpu_count()):
+    #every range commits with the stores it needs
+    known_stores = np.asarray(store_service.find_ids(db), dtype=np.int64)
+    copy = status_service.canCopy(db)
+    file_size = os.path.getsize(csv_path)
+    first_timestamp, last_timestamp = None, None
+    total_rows, done_bytes = 0, 0
+
+    for parsed in parse_ranges(csv_path, copy, processes):
+        new_stores = np.setdiff1d(parsed.store_ids, known_stores, assume_unique=True)
+        if len(new_stores):
+            insert_missing_stores(db, set(new_stores.tolist()))
+            known_stores = np.union1d(known_stores, new_stores)
+
+        if copy:
+            status_service.bulkCopy(db, parsed.rows)
+        elif parsed.count:
+            status_service.bulkInsert(db, parsed.rows, batch_size=10000)
+
+        if parsed.first_timestamp is not None:
+            first_timestamp = parsed.first_timestamp if first_timestamp is None else min(first_timestamp, parsed.first_timestamp)
+            last_timestamp = parsed.last_timestamp if last_timestamp is None else max(last_timestamp, parsed.last_timestamp)
+        total_rows += parsed.count
+        done_bytes += parsed.end - parsed.start
+        print(f"Inserted {total_rows} rows, {done_bytes}/{file_size} bytes parsed ({done_bytes * 100 / max(file_size, 1):.1f}%)")
+
+    print(f"Inserted {total_rows} rows of store status data")
+
+    if first_timestamp is not None:
+        print("rebuilding hourly rollups...")
+        store_status_hourly_service.refresh(first_timestamp, last_timestamp)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,6 @@
 import csv
-from app.models import Store
 from app.database import engine
+from app.services import store_service
 from sqlalchemy.orm import Session
 
 def backfill_stores(csv_path: str, db: Session):
@@ -13,25 +13,23 @@ def backfill_stores(csv_path: str, db: Session):
     with open(csv_path, mode='r') as file:
         reader = csv.DictReader(file)
         for index, row in enumerate(reader, start=1):
-            store = Store(
-                id=int(row['store_id']),
-                timezone=row['timezone_str'],
-                created_by='backfill_script',
-                updated_by='backfill_script'
-            )
+            store = {
+                'id': int(row['store_id']),
+                'timezone': row['timezone_str'],
+                'created_by': 'backfill_script',
+                'updated_by': 'backfill_script'
+            }
             batch.append(store)
             
             if len(batch) == batch_size:
-                db.bulk_save_objects(batch)
-                db.commit()
+                store_service.bulkInsert(db, batch, batch_size=batch_size)
                 batch.clear() 
             
             print(f"Processing store {index} of {total_rows} ({index/total_rows:.2%})", end='\r')
 
     # Insert any remaining records
     if batch:
-        db.bulk_save_objects(batch)
-        db.commit()
+        store_service.bulkInsert(db, batch, batch_size=batch_size)
     
     print(f"\nCompleted processing {total_rows} stores.")
 
@@ -0,0 +1,219 @@
+from collections import OrderedDict
+from datetime import datetime, time, timedelta, timezone
+from typing import Dict, Iterable, Optional, Tuple
+import hashlib
+import threading
+import numpy as np
+import pytz
+from app.report.uptime_engine import to_epoch_us
+
+# Turns the weekly local schedule of a store into sorted UTC open intervals.
+# Instants are int64 microseconds since the unix epoch, "local" instants are wall clock microseconds
+# counted as if the wall clock were UTC.
+MICROSECONDS_PER_SECOND = 1_000_000
+MICROSECONDS_PER_DAY = 86400 * MICROSECONDS_PER_SECOND
+DEFAULT_TIMEZONE = 'America/Chicago'
+#end times at or after this are read as midnight, the backfills write 23:59:59 for "open until close of day"
+END_OF_DAY_US = MICROSECONDS_PER_DAY - MICROSECONDS_PER_SECOND
+
+# (day_of_week, local open time, local close time), both times as microseconds after local midnight
+Schedule = Tuple[Tuple[int, int, int], ...]
+
+
+def _time_of_day_us(value: time) -> int:
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * MICROSECONDS_PER_SECOND + value.microsecond
+
+
+def normalize_schedule(business_hours: Iterable) -> Schedule:
+    """Weekly schedule from business hour rows, independent of row order and of the stored utc offsets."""
+    schedule = set()
+    for bh in business_hours:
+        start, end = _time_of_day_us(bh.start_time), _time_of_day_us(bh.end_time)
+        if end >= END_OF_DAY_US:
+            end = MICROSECONDS_PER_DAY
+        day_of_week = bh.day_of_week.value if hasattr(bh.day_of_week, 'value') else int(bh.day_of_week)
+        schedule.add((day_of_week, start, end))
+    return tuple(sorted(schedule))
+
+
+class _TimezoneOffsets:
+    """UTC offsets of a timezone over a horizon, as the sorted instants at which the offset changes."""
+
+    def __init__(self, name: str, start_us: int, end_us: int):
+        self.tz = pytz.timezone(name or DEFAULT_TIMEZONE)
+        self.start_us, self.end_us = start_us, end_us
+        #probe every 15 minutes then narrow each change down to the second
+        probes = list(range(start_us, end_us + 1, 15 * 60 * MICROSECONDS_PER_SECOND))
+        offsets = [self._offset_at(probe) for probe in probes]
+        self.transitions, self.offsets = [start_us], [offsets[0]]
+        for (lo, lo_offset), (hi, hi_offset) in zip(zip(probes, offsets), zip(probes[1:], offsets[1:])):
+            if lo_offset == hi_offset:
+                continue
+            while hi - lo > MICROSECONDS_PER_SECOND:
+                mid = (lo + hi) // 2
+                if self._offset_at(mid) == lo_offset:
+                    lo = mid
+                else:
+                    hi = mid
+            self.transitions.append(hi)
+            self.offsets.append(hi_offset)
+        self.transitions = np.asarray(self.transitions, dtype=np.int64)
+        self.offsets = np.asarray(self.offsets, dtype=np.int64)
+
+    def _offset_at(self, utc_us: int) -> int:
+        moment = datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(microseconds=utc_us)
+        offset = moment.astimezone(self.tz).utcoffset()
+        return (offset.days * 86400 + offset.seconds) * MICROSECONDS_PER_SECOND
+
+    def offset_at(self, utc_us: np.ndarray) -> np.ndarray:
+        return self.offsets[np.maximum(np.searchsorted(self.transitions, utc_us, side='right') - 1, 0)]
+
+    def to_utc(self, local_us: np.ndarray) -> np.ndarray:
+        """Local wall clock to UTC. Repeated wall clock times resolve to their first occurrence,
+        skipped ones (spring forward) to the instant the clock jumps past them."""
+        result = np.full(len(local_us), np.iinfo(np.int64).max, dtype=np.int64)
+        for offset in np.unique(self.offsets):
+            candidate = local_us - offset
+            valid = self.offset_at(candidate) == offset
+            result = np.where(valid, np.minimum(result, candidate), result)
+        skipped = result == np.iinfo(np.int64).max
+        after_jump = local_us[skipped] - self.offset_at(local_us[skipped] - self.offsets.max())
+        result[skipped] = self.transitions[np.searchsorted(self.transitions, after_jump, side='right') - 1]
+        return result
+
+
+def build_open_intervals(schedule: Schedule, offsets: _TimezoneOffsets, start_us: int, end_us: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorted, merged UTC open intervals of a weekly schedule that overlap [start_us, end_us).
+
+    A close time that is not after the open time (an overnight span) closes on the following local day.
+    Intervals are not cut to the range, an interval open at start_us keeps its real opening instant as
+    long as it lies inside the timezone horizon.
+    """
+    if not schedule:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    day_of_week, open_us, close_us = (np.asarray(column, dtype=np.int64) for column in zip(*schedule))
+    close_us = np.where(close_us <= open_us, close_us + MICROSECONDS_PER_DAY, close_us)
+
+    #every local day that could hold an interval touching the range, with a day of slack for offsets and overnight spans
+    first_day = (start_us // MICROSECONDS_PER_DAY) - 2
+    last_day = (end_us // MICROSECONDS_PER_DAY) + 1
+    days = np.arange(first_day, last_day + 1, dtype=np.int64)
+    weekday = (days + 3) % 7  # 1970-01-01 was a thursday
+    matches = weekday[:, None] == day_of_week[None, :]
+    day_index, entry_index = np.nonzero(matches)
+    local_day = days[day_index] * MICROSECONDS_PER_DAY
+    starts = offsets.to_utc(local_day + open_us[entry_index])
+    ends = offsets.to_utc(local_day + close_us[entry_index])
+
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    if not len(starts):
+        return starts, ends
+    #overlapping or touching intervals are merged, so no instant is counted twice
+    reach = np.maximum.accumulate(ends)
+    opens_group = np.r_[True, starts[1:] > reach[:-1]]
+    group = np.cumsum(opens_group) - 1
+    group_end = np.zeros(group[-1] + 1, dtype=np.int64)
+    np.maximum.at(group_end, group, ends)
+    starts = starts[opens_group]
+    overlaps = (group_end > start_us) & (starts < end_us)
+    return starts[overlaps], group_end[overlaps]
+
+
+def open_microseconds(starts: np.ndarray, ends: np.ndarray, a_us: int, b_us: int) -> int:
+    #open time inside [a_us, b_us) with two binary searches over the sorted intervals
+    lo = np.searchsorted(ends, a_us, side='right')
+    hi = np.searchsorted(starts, b_us, side='left')
+    if hi <= lo:
+        return 0
+    return int(np.minimum(ends[lo:hi], b_us).sum() - np.maximum(starts[lo:hi], a_us).sum())
+
+
+def is_open_at(starts: np.ndarray, ends: np.ndarray, at_us: int) -> bool:
+    i = np.searchsorted(starts, at_us, side='right') - 1
+    return bool(i >= 0 and at_us < ends[i])
+
+
+def schedule_id(schedule: Schedule, timezone_name: str) -> str:
+    #stores with the same weekly schedule in the same timezone share one id, and so one set of intervals
+    return hashlib.blake2b(repr((schedule, timezone_name)).encode(), digest_size=8).hexdigest()
+
+
+class ScheduleIndex:
+    """LRU cache of UTC open intervals per interned schedule.
+
+    Stores are mapped to the id of their normalized weekly schedule and timezone, so intervals and open
+    time are worked out once per distinct schedule no matter how many stores share it. An edited schedule
+    or timezone hashes to another id, so entries never go stale, they just age out. An entry covers a
+    horizon around the range it was built for and is rebuilt when asked about instants outside it.
+    """
+
+    def __init__(self, max_entries: int = 10000, horizon_padding: timedelta = timedelta(days=1)):
+        self.max_entries = max_entries
+        self.horizon_padding_us = int(horizon_padding.total_seconds()) * MICROSECONDS_PER_SECOND
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._offsets: Dict[Tuple[str, int, int], _TimezoneOffsets] = {}
+        self._lock = threading.Lock()
+
+    def intervals(self, business_hours: Iterable, timezone_name: Optional[str], start_us: int, end_us: int) -> Tuple[np.ndarray, np.ndarray]:
+        entry = self._entry(business_hours, timezone_name, start_us, end_us)
+        return entry['starts'], entry['ends']
+
+    def open_minutes(self, business_hours: Iterable, timezone_name: Optional[str], start: datetime, end: datetime) -> float:
+        start_us, end_us = to_epoch_us(start), to_epoch_us(end)
+        entry = self._entry(business_hours, timezone_name, start_us, end_us)
+        open_time = entry['open_time']
+        if (start_us, end_us) not in open_time:
+            open_time[(start_us, end_us)] = open_microseconds(entry['starts'], entry['ends'], start_us, end_us)
+        return open_time[(start_us, end_us)] / (60 * MICROSECONDS_PER_SECOND)
+
+    def is_open(self, business_hours: Iterable, timezone_name: Optional[str], at: datetime) -> bool:
+        at_us = to_epoch_us(at)
+        entry = self._entry(business_hours, timezone_name, at_us, at_us)
+        return is_open_at(entry['starts'], entry['ends'], at_us)
+
+    def invalidate(self, schedule_id: Optional[str] = None) -> None:
+        with self._lock:
+            if schedule_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(schedule_id, None)
+
+    def _entry(self, business_hours: Iterable, timezone_name: Optional[str], start_us: int, end_us: int) -> dict:
+        schedule = normalize_schedule(business_hours)
+        timezone_name = timezone_name or DEFAULT_TIMEZONE
+        key = schedule_id(schedule, timezone_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['horizon_start'] <= start_us and end_us <= entry['horizon_end']:
+                self._entries.move_to_end(key)
+                return entry
+
+        horizon_start = (start_us // MICROSECONDS_PER_DAY) * MICROSECONDS_PER_DAY - self.horizon_padding_us
+        horizon_end = -(-end_us // MICROSECONDS_PER_DAY) * MICROSECONDS_PER_DAY + self.horizon_padding_us
+        starts, ends = build_open_intervals(schedule, self._timezone_offsets(timezone_name, horizon_start, horizon_end), horizon_start, horizon_end)
+        entry = {'horizon_start': horizon_start, 'horizon_end': horizon_end, 'starts': starts, 'ends': ends, 'open_time': {}}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def _timezone_offsets(self, timezone_name: str, start_us: int, end_us: int) -> _TimezoneOffsets:
+        key = (timezone_name, start_us, end_us)
+        offsets = self._offsets.get(key)
+        if offsets is None:
+            offsets = _TimezoneOffsets(timezone_name, start_us, end_us)
+            with self._lock:
+                #horizons move with the clock, only keep the recent ones
+                if len(self._offsets) > 4096:
+                    self._offsets.clear()
+                self._offsets[key] = offsets
+        return offsets
+
+
+schedule_index = ScheduleIndex()
+
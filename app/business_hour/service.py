@@ -1,7 +1,17 @@
-from app.crud import BaseCRUDService
+from typing import Iterator, Optional
+from sqlalchemy.engine import Row
+from app.crud import BaseCRUDService, id_range
+from app.store.model import Store
 from .model import BusinessHour
 from sqlalchemy.orm import Session
 
 class BusinessHourService(BaseCRUDService[BusinessHour]):
     def __init__(self):
         super().__init__(BusinessHour)
+
+    def stream_schedule_rows(self, db: Session, min_store_id: Optional[int] = None, max_store_id: Optional[int] = None, yield_per: int = 10000) -> Iterator[Row]:
+        #plain rows ordered by store, each carrying its store's timezone, no ORM objects are built
+        query = self.selectColumns(
+            ('store_id', 'day_of_week', 'start_time', 'end_time', Store.timezone), order_by=('store_id', 'id'), store_id=id_range(min_store_id, max_store_id),
+        ).join(Store, Store.id == BusinessHour.store_id)
+        return db.execute(query, execution_options={"yield_per": yield_per})
@@ -9,3 +9,53 @@ class Config:
     REDIS_HOST=os.getenv('REDIS_HOST')
     REDIS_PORT=os.getenv('REDIS_PORT')
     REDIS_DB=os.getenv('REDIS_DB')
+    #report generation
+    #shards > 1 splits the store id space into a chord of celery sub-tasks
+    REPORT_SHARDS=int(os.getenv('REPORT_SHARDS', '1'))
+    REPORT_SHARD_MAX_RETRIES=int(os.getenv('REPORT_SHARD_MAX_RETRIES', '3'))
+    #'raw' computes every window from store_status, 'rollup' sums store_status_hourly (needs the rollup catch-up to have run)
+    REPORT_SOURCE=os.getenv('REPORT_SOURCE', 'raw')
+    #finished reports are written once as files (plain and gzipped) and downloads are served from them
+    REPORT_ARTIFACT_STORE=os.getenv('REPORT_ARTIFACT_STORE', 'local')
+    REPORT_ARTIFACT_DIR=os.getenv('REPORT_ARTIFACT_DIR', 'reports')
+    #sql statement counts and latencies per service method, see app/instrumentation.py and /debug/queries
+    QUERY_INSTRUMENTATION=os.getenv('QUERY_INSTRUMENTATION', 'false').lower() == 'true'
+    #a select repeated this many times from one call site within a request or task is reported as a possible N+1
+    QUERY_N_PLUS_ONE_THRESHOLD=int(os.getenv('QUERY_N_PLUS_ONE_THRESHOLD', '20'))
+    #connection pool of each engine, per process
+    DB_POOL_SIZE=int(os.getenv('DB_POOL_SIZE', '5'))
+    DB_MAX_OVERFLOW=int(os.getenv('DB_MAX_OVERFLOW', '10'))
+    DB_POOL_TIMEOUT=int(os.getenv('DB_POOL_TIMEOUT', '30'))
+    #seconds before a connection is replaced, keeps it under server or proxy idle timeouts
+    DB_POOL_RECYCLE=int(os.getenv('DB_POOL_RECYCLE', '1800'))
+    DB_POOL_PRE_PING=os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    #results cached in redis by app.redis.redis_cache, with a short lived copy in each process
+    CACHE_ENABLED=os.getenv('CACHE_ENABLED', 'true').lower() == 'true'
+    CACHE_TTL=int(os.getenv('CACHE_TTL', '300'))
+    CACHE_L1_SIZE=int(os.getenv('CACHE_L1_SIZE', '1024'))
+    CACHE_L1_TTL=float(os.getenv('CACHE_L1_TTL', '5'))
+    CACHE_LOCK_TIMEOUT=float(os.getenv('CACHE_LOCK_TIMEOUT', '10'))
+    #report statuses kept in redis for status checks and waits without the database
+    REPORT_STATUS_TTL=int(os.getenv('REPORT_STATUS_TTL', str(7 * 24 * 3600)))
+    #longest a GET /report_status/{id}?wait= long poll is held open, in seconds
+    REPORT_STATUS_MAX_WAIT=float(os.getenv('REPORT_STATUS_MAX_WAIT', '60'))
+    #store polling, each cycle is split into store id ranges polled as a celery group
+    POLL_INTERVAL_MINUTES=int(os.getenv('POLL_INTERVAL_MINUTES', '60'))
+    POLL_SHARDS=int(os.getenv('POLL_SHARDS', '1'))
+    #seconds a poll shard lock outlives a worker that died holding it, a running shard keeps renewing it
+    POLL_LOCK_TTL=float(os.getenv('POLL_LOCK_TTL', '60'))
+    #how polls find out whether a store is up: 'random' or 'http', a GET of STATUS_PROBE_URL per store
+    STATUS_PROBE=os.getenv('STATUS_PROBE', 'random')
+    STATUS_PROBE_URL=os.getenv('STATUS_PROBE_URL', 'http://localhost:8081/stores/{store_id}/status')
+    STATUS_PROBE_CONCURRENCY=int(os.getenv('STATUS_PROBE_CONCURRENCY', '500'))
+    STATUS_PROBE_TIMEOUT=float(os.getenv('STATUS_PROBE_TIMEOUT', '5'))
+    #probe results are written in batches of this many while probing goes on
+    STATUS_PROBE_WRITE_BATCH=int(os.getenv('STATUS_PROBE_WRITE_BATCH', '5000'))
+    #POST /store_status group commit: a bulk insert every INGEST_FLUSH_ROWS pings or INGEST_FLUSH_MS milliseconds,
+    #new pings get a 429 once INGEST_MAX_PENDING are waiting, a single request carries at most INGEST_MAX_BATCH
+    #pings in at most INGEST_MAX_BYTES bytes
+    INGEST_FLUSH_ROWS=int(os.getenv('INGEST_FLUSH_ROWS', '5000'))
+    INGEST_FLUSH_MS=int(os.getenv('INGEST_FLUSH_MS', '200'))
+    INGEST_MAX_PENDING=int(os.getenv('INGEST_MAX_PENDING', '200000'))
+    INGEST_MAX_BATCH=int(os.getenv('INGEST_MAX_BATCH', '50000'))
+    INGEST_MAX_BYTES=int(os.getenv('INGEST_MAX_BYTES', '8388608'))
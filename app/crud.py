@@ -1,15 +1,47 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from typing import Generic, TypeVar, Type, List, Optional, Dict, Any
-from .base import BaseAudit
+from sqlalchemy import Select, bindparam, func, insert, select, tuple_, update
+from sqlalchemy.engine import Result
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.sql import sqltypes
+from typing import Generic, TypeVar, Type, List, Optional, Dict, Any, Iterable, Iterator, Mapping, NamedTuple, Sequence, Tuple, Union
+from datetime import date, datetime, time, timezone
+from enum import Enum
+from io import BytesIO, StringIO
+from functools import lru_cache
+from itertools import chain, islice
+import struct
+import numpy as np
+from .base import BaseAudit, generate_ids
+from . import instrumentation
+from .redis import invalidate_on_commit
 
 T = TypeVar('T', bound=BaseAudit)
+# a column of the projection methods: a column name of the service's model, or any column expression
+Column = Any
+# rows for the bulk methods: dicts, or a mapping of column name -> array/list (a scalar is used for every row)
+Rows = Union[Iterable[Dict[str, Any]], Mapping[str, Any]]
+
+
+class CopyPayload(NamedTuple):
+    #COPY FROM STDIN input for a service's table, see encodeCopy
+    columns: List[str]
+    binary: bool
+    data: bytes
+    count: int
 
 
 class BaseCRUDService(Generic[T]):
+    #redis_cache tags of results read from this service's table, dropped whenever a write through it commits
+    cache_tags: Tuple[str, ...] = ()
+
     def __init__(self, model: Type[T]):
         self.model = model
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        #statements run by a service method are counted under "<model>.<method>"
+        instrumentation.tag_methods(cls)
+
     def findOne(self, db: Session, **kwargs) -> Optional[T]:
         return db.query(self.model).filter_by(**kwargs).first()
 
@@ -33,9 +65,70 @@ class BaseCRUDService(Generic[T]):
         return db.query(self.model).filter_by(**kwargs).offset(skip).limit(limit).all()
 
     def findAllByAttributes(self, db: Session, skip: int = 0, limit: int = 100, **kwargs) -> List[T]:
-        query = db.query(self.model)
+        query = self._apply_filters(db.query(self.model), kwargs)
+        return query.offset(skip).limit(limit).all()
+
+    def iterAll(self, db: Session, page_size: int = 1000, order_by: Sequence[str] = ('id',)) -> Iterator[T]:
+        yield from self._iterPages(db.query(self.model), page_size, order_by)
+
+    def iterAllBy(self, db: Session, page_size: int = 1000, order_by: Sequence[str] = ('id',), **kwargs) -> Iterator[T]:
+        yield from self._iterPages(db.query(self.model).filter_by(**kwargs), page_size, order_by)
+
+    def iterAllByAttributes(self, db: Session, page_size: int = 1000, order_by: Sequence[str] = ('id',), **kwargs) -> Iterator[T]:
+        yield from self._iterPages(self._apply_filters(db.query(self.model), kwargs), page_size, order_by)
 
-        for key, value in kwargs.items():
+    def _iterPages(self, query, page_size: int, order_by: Sequence[str]) -> Iterator[T]:
+        #keyset pagination: every page starts after the last key of the one before, so no page gets slower
+        #and there is no cap. id is appended as a tie breaker when the key isn't unique by itself
+        names = list(order_by) + (['id'] if 'id' not in order_by else [])
+        columns = [getattr(self.model, name) for name in names]
+        query = query.order_by(*columns)
+        last_key = None
+        while True:
+            page_query = query if last_key is None else query.filter(tuple_(*columns) > tuple_(*last_key))
+            page = page_query.limit(page_size).all()
+            if not page:
+                return
+            #read before handing out the page, a commit by the caller would expire the objects
+            last_key = [getattr(page[-1], name) for name in names]
+            yield from page
+            if len(page) < page_size:
+                return
+
+    def selectColumns(self, columns: Sequence[Column], order_by: Sequence[Column] = (), **kwargs) -> Select:
+        #a core select of just these columns, filtered like findAllByAttributes. callers can add joins or
+        #conditions the operators can't express before running it
+        query = select(*(self._column(column) for column in columns))
+        return self._apply_filters(query, kwargs).order_by(*(self._column(column) for column in order_by))
+
+    def findColumns(self, db: Session, columns: Sequence[Column], order_by: Sequence[Column] = (), limit: Optional[int] = None, yield_per: Optional[int] = None, **kwargs) -> Result:
+        #plain tuples, no ORM objects are built and nothing goes into the identity map.
+        #with yield_per the rows come from a server side cursor that many at a time
+        query = self.selectColumns(columns, order_by, **kwargs)
+        if limit is not None:
+            query = query.limit(limit)
+        return db.execute(query, execution_options={"yield_per": yield_per} if yield_per else {})
+
+    def findRecords(self, db: Session, columns: Sequence[Column], order_by: Sequence[Column] = (), limit: Optional[int] = None, yield_per: Optional[int] = None, **kwargs) -> Iterator[Any]:
+        #the same rows as findColumns as small __slots__ objects, for code that reads attributes off entities
+        result = self.findColumns(db, columns, order_by, limit, yield_per, **kwargs)
+        record_type = _record_type(tuple(result.keys()))
+        return (record_type(*row) for row in result)
+
+    def findColumnArrays(self, db: Session, columns: Sequence[Column], order_by: Sequence[Column] = (), limit: Optional[int] = None, dtypes: Optional[Mapping[str, Any]] = None, **kwargs) -> Dict[str, np.ndarray]:
+        #column name -> array of its values. dtypes picks the array type per column, numpy infers the rest
+        result = self.findColumns(db, columns, order_by, limit, **kwargs)
+        names = list(result.keys())
+        rows = result.all()
+        dtypes = dtypes or {}
+        values = list(zip(*rows)) if rows else [()] * len(names)
+        return {name: np.asarray(column, dtype=dtypes.get(name)) for name, column in zip(names, values)}
+
+    def _column(self, column: Column):
+        return getattr(self.model, column) if isinstance(column, str) else column
+
+    def _apply_filters(self, query, filters: Dict[str, Any]):
+        for key, value in filters.items():
             column = getattr(self.model, key)
             if isinstance(value, dict):
                 for operator, operand in value.items():
@@ -59,10 +152,10 @@ class BaseCRUDService(Generic[T]):
                         query = query.filter(column.ilike(f'%{operand}%'))
             else:
                 query = query.filter(column == value)
-        
-        return query.offset(skip).limit(limit).all()
+        return query
 
     def create(self, db: Session, obj_in: dict) -> T:
+        self._invalidate_cached(db)
         db_obj = self.model(**obj_in)
         db.add(db_obj)
         db.commit()
@@ -70,6 +163,7 @@ class BaseCRUDService(Generic[T]):
         return db_obj
 
     def createMultiple(self, db: Session, objs_in: List[dict]) -> List[T]:
+        self._invalidate_cached(db)
         db_objs = [self.model(**obj_in) for obj_in in objs_in]
         db.add_all(db_objs)
         db.commit()
@@ -78,6 +172,7 @@ class BaseCRUDService(Generic[T]):
         return db_objs
 
     def findAndUpdate(self, db: Session, filter_by: dict, update_data: dict) -> Optional[T]:
+        self._invalidate_cached(db)
         instance = self.findOneBy(db, **filter_by)
         if instance:
             for key, value in update_data.items():
@@ -87,9 +182,11 @@ class BaseCRUDService(Generic[T]):
         return instance
 
     def updateMultiple(self, db: Session, filter_by: dict, update_data: dict) -> int:
+        self._invalidate_cached(db)
         return db.query(self.model).filter_by(**filter_by).update(update_data)
 
     def delete(self, db: Session, id: int, soft: bool = True) -> Optional[T]:
+        self._invalidate_cached(db)
         obj = self.findOneById(db, id)
         if obj:
             if soft:
@@ -102,3 +199,278 @@ class BaseCRUDService(Generic[T]):
 
     def count(self, db: Session, **kwargs) -> int:
         return db.query(func.count(self.model.id)).filter_by(**kwargs).scalar()
+
+    def bulkInsert(self, db: Session, rows: Rows, batch_size: int = 1000, return_ids: bool = False, commit: bool = True, binary: bool = False) -> Optional[List[int]]:
+        #no ORM objects and nothing read back: COPY on postgresql (psycopg2), multi-row INSERT elsewhere.
+        #binary COPY skips postgres parsing every field as text, it falls back to text for column types it can't encode
+        self._invalidate_cached(db)
+        ids = [] if return_ids else None
+        table = self.model.__table__
+        for batch in self._batches(rows, batch_size):
+            self._fill_defaults(batch)
+            if self.canCopy(db):
+                self._copy(db, batch, binary)
+            else:
+                db.execute(insert(table), batch)
+            if return_ids:
+                ids.extend(row['id'] for row in batch)
+        if commit:
+            db.commit()
+        return ids
+
+    def bulkUpsert(self, db: Session, rows: Rows, conflict_keys: Sequence[str], update_columns: Optional[Sequence[str]] = None, batch_size: int = 1000, return_ids: bool = False, commit: bool = True) -> Optional[List[int]]:
+        #conflict_keys need a unique index. update_columns None updates every given column but the key and the
+        #creation audit fields, [] leaves conflicting rows as they are (DO NOTHING)
+        self._invalidate_cached(db)
+        dialect = db.get_bind().dialect.name
+        if dialect == 'postgresql':
+            dialect_insert = postgresql.insert
+        elif dialect == 'sqlite':
+            dialect_insert = sqlite.insert
+        else:
+            raise ValueError(f"bulkUpsert is not supported on {dialect}")
+
+        ids = [] if return_ids else None
+        table = self.model.__table__
+        for batch in self._batches(rows, batch_size):
+            self._fill_defaults(batch)
+            statement = dialect_insert(table)
+            if update_columns is None:
+                columns = [name for name in batch[0] if name not in conflict_keys and name not in ('id', 'created_at', 'created_by')]
+            else:
+                columns = list(update_columns) + (['updated_at'] if update_columns and 'updated_at' in table.c else [])
+            if columns:
+                statement = statement.on_conflict_do_update(index_elements=list(conflict_keys), set_={name: statement.excluded[name] for name in columns})
+            else:
+                statement = statement.on_conflict_do_nothing(index_elements=list(conflict_keys))
+            if return_ids:
+                #ids of the rows inserted or updated, rows left alone by DO NOTHING are not returned
+                ids.extend(db.execute(statement.returning(table.c.id), batch).scalars())
+            else:
+                db.execute(statement, batch)
+        if commit:
+            db.commit()
+        return ids
+
+    def bulkUpdate(self, db: Session, rows: Rows, key: str = 'id', batch_size: int = 1000, commit: bool = True) -> int:
+        #each row holds the key and the columns to set, every row of a batch must set the same columns
+        self._invalidate_cached(db)
+        table = self.model.__table__
+        updated = 0
+        for batch in self._batches(rows, batch_size):
+            columns = [name for name in batch[0] if name != key]
+            values = {name: bindparam(f"new_{name}") for name in columns}
+            if 'updated_at' in table.c and 'updated_at' not in values:
+                values['updated_at'] = func.now()
+            statement = update(table).where(table.c[key] == bindparam("match_key")).values(values)
+            params = [{"match_key": row[key], **{f"new_{name}": row[name] for name in columns}} for row in batch]
+            updated += db.execute(statement, params).rowcount
+        if commit:
+            db.commit()
+        return updated
+
+    def _invalidate_cached(self, db: Session) -> None:
+        if self.cache_tags:
+            invalidate_on_commit(db, *self.cache_tags)
+
+    def _batches(self, rows: Rows, batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+        #fresh dicts per batch, so defaults can be filled without touching the caller's rows
+        if isinstance(rows, Mapping):
+            lengths = [len(values) for values in rows.values() if _is_column(values)]
+            n_rows = lengths[0] if lengths else 0
+            columns = {
+                name: (values.tolist() if hasattr(values, 'tolist') else list(values)) if _is_column(values) else [values] * n_rows
+                for name, values in rows.items()
+            }
+            for i in range(0, n_rows, batch_size):
+                names = list(columns)
+                yield [dict(zip(names, values)) for values in zip(*(columns[name][i:i + batch_size] for name in names))]
+            return
+        rows = iter(rows)
+        while True:
+            batch = [dict(row) for row in islice(rows, batch_size)]
+            if not batch:
+                return
+            yield batch
+
+    def _fill_defaults(self, rows: List[Dict[str, Any]]) -> None:
+        #bulk paths skip the ORM, so the audit defaults are filled here. audit timestamps are UTC
+        columns = self.model.__table__.c
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if 'id' in columns:
+            missing = [row for row in rows if row.get('id') is None]
+            for row, row_id in zip(missing, generate_ids(len(missing))):
+                row['id'] = row_id
+        for name in ('created_at', 'updated_at'):
+            if name in columns:
+                for row in rows:
+                    if row.get(name) is None:
+                        row[name] = now
+
+    def canCopy(self, db: Session) -> bool:
+        dialect = db.get_bind().dialect
+        return dialect.name == 'postgresql' and dialect.driver == 'psycopg2'
+
+    def encodeCopy(self, rows: Rows, binary: bool = True) -> CopyPayload:
+        #rows with their defaults filled, encoded for bulkCopy. needs no session, so worker processes can build it
+        batch = list(chain.from_iterable(self._batches(rows, 100000)))
+        self._fill_defaults(batch)
+        return self._encode_copy(batch, binary)
+
+    def bulkCopy(self, db: Session, payload: CopyPayload, commit: bool = True) -> None:
+        if not self.canCopy(db):
+            raise ValueError("bulkCopy needs postgresql with psycopg2, use bulkInsert")
+        self._invalidate_cached(db)
+        if payload.count:
+            self._run_copy(db, payload)
+        if commit:
+            db.commit()
+
+    def _copy(self, db: Session, rows: List[Dict[str, Any]], binary: bool = False) -> None:
+        self._run_copy(db, self._encode_copy(rows, binary))
+
+    def _encode_copy(self, rows: List[Dict[str, Any]], binary: bool) -> CopyPayload:
+        columns = list(rows[0]) if rows else []
+        table_columns = self.model.__table__.c
+        encoders = [_binary_encoder(table_columns[name].type) for name in columns] if binary else [None]
+        if all(encoders):
+            return CopyPayload(columns, True, _copy_binary_buffer(rows, columns, encoders).getvalue(), len(rows))
+        buffer = StringIO()
+        for row in rows:
+            buffer.write("\t".join(_copy_text(row.get(name)) for name in columns))
+            buffer.write("\n")
+        return CopyPayload(columns, False, buffer.getvalue().encode(), len(rows))
+
+    def _run_copy(self, db: Session, payload: CopyPayload) -> None:
+        #COPY runs on the session's own connection, inside its transaction
+        quoted_columns = ", ".join(f'"{name}"' for name in payload.columns)
+        options = " WITH (FORMAT binary)" if payload.binary else ""
+        cursor = db.connection().connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY "{self.model.__table__.name}" ({quoted_columns}) FROM STDIN{options}', BytesIO(payload.data))
+        finally:
+            cursor.close()
+
+
+instrumentation.tag_methods(BaseCRUDService)
+
+
+def _is_column(values: Any) -> bool:
+    return hasattr(values, '__len__') and not isinstance(values, (str, bytes))
+
+
+def _copy_text(value: Any) -> str:
+    #a field of COPY's text format, enums are stored by name like sqlalchemy's Enum type does
+    if value is None:
+        return "\\N"
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+#COPY's binary format: a signature, no flags and no header extension, then rows of (field count, (length, value)...)
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+PG_EPOCH = datetime(2000, 1, 1)
+PG_EPOCH_UTC = PG_EPOCH.replace(tzinfo=timezone.utc)
+PG_EPOCH_DATE = PG_EPOCH.date()
+_NULL_FIELD = struct.pack(">i", -1)
+
+
+def _copy_binary_buffer(rows: List[Dict[str, Any]], columns: List[str], encoders: List[Any]) -> BytesIO:
+    buffer = BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    field_count = struct.pack(">h", len(columns))
+    encoded = [(name, encoder, {}) for name, encoder in zip(columns, encoders)]
+    for row in rows:
+        buffer.write(field_count)
+        for name, encoder, repeated in encoded:
+            value = row.get(name)
+            if value is None:
+                buffer.write(_NULL_FIELD)
+                continue
+            if isinstance(value, (str, Enum)):
+                #the same audit values and enum members come up on every row, they're encoded once
+                field = repeated.get(value)
+                if field is None:
+                    field = encoder(value)
+                    if len(repeated) < 64:
+                        repeated[value] = field
+            else:
+                field = encoder(value)
+            buffer.write(field)
+    buffer.write(PGCOPY_TRAILER)
+    return buffer
+
+
+def _binary_encoder(column_type: Any) -> Optional[Any]:
+    #a value -> length prefixed field encoder for the column type, None when the type has no binary encoding here
+    if isinstance(column_type, sqltypes.Enum):
+        #sqlalchemy stores enums by name, postgres reads an enum label as its text
+        return lambda value: _binary_text(value.name if isinstance(value, Enum) else str(value))
+    if isinstance(column_type, sqltypes.String):
+        return lambda value: _binary_text(str(value))
+    if isinstance(column_type, sqltypes.BigInteger):
+        return lambda value: struct.pack(">iq", 8, int(value))
+    if isinstance(column_type, sqltypes.SmallInteger):
+        return lambda value: struct.pack(">ih", 2, int(value))
+    if isinstance(column_type, sqltypes.Integer):
+        return lambda value: struct.pack(">ii", 4, int(value))
+    if isinstance(column_type, sqltypes.Boolean):
+        return lambda value: struct.pack(">i?", 1, bool(value))
+    if isinstance(column_type, sqltypes.DateTime):
+        #microseconds since 2000-01-01. timestamptz is sent in UTC, naive values are taken as UTC. a timestamp
+        #without time zone keeps the wall clock time, like the text format
+        if column_type.timezone:
+            return lambda value: struct.pack(">iq", 8, _pg_microseconds(value, PG_EPOCH_UTC if value.tzinfo else PG_EPOCH))
+        return lambda value: struct.pack(">iq", 8, _pg_microseconds(value.replace(tzinfo=None) if value.tzinfo else value, PG_EPOCH))
+    if isinstance(column_type, sqltypes.Date):
+        return lambda value: struct.pack(">ii", 4, (value - PG_EPOCH_DATE).days)
+    if isinstance(column_type, sqltypes.Time) and not column_type.timezone:
+        #timetz is left to the text format, pytz zones of a bare time have no offset to send
+        return lambda value: struct.pack(">iq", 8, _time_microseconds(value))
+    return None
+
+
+def _binary_text(value: str) -> bytes:
+    data = value.encode()
+    return struct.pack(">i", len(data)) + data
+
+
+def _pg_microseconds(value: datetime, epoch: datetime) -> int:
+    delta = value - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _time_microseconds(value: time) -> int:
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond
+
+
+def id_range(low: Optional[Any] = None, high: Optional[Any] = None) -> Dict[str, Any]:
+    #an inclusive range filter for the attribute methods, an open end is left out
+    return {operator: value for operator, value in (('$gte', low), ('$lte', high)) if value is not None}
+
+
+class _Record:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self) -> str:
+        return f"Record({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+    def _asdict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+@lru_cache(maxsize=None)
+def _record_type(names: tuple) -> type:
+    return type("Record", (_Record,), {"__slots__": names})
@@ -1,11 +1,85 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Iterator, Optional
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from app.config import Config
+from app.instrumentation import instrument_engine
 
 # Database URL - replace with your actual database URL
 SQLALCHEMY_DATABASE_URL = "postgresql://loop:loop@db:5432/loop_db"
+#backend -> driver used for the same database from the event loop
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+def async_database_url(url: str):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+def pool_options() -> dict:
+    #every process holds at most pool_size + max_overflow connections per engine
+    return {
+        "pool_size": Config.DB_POOL_SIZE,
+        "max_overflow": Config.DB_MAX_OVERFLOW,
+        "pool_timeout": Config.DB_POOL_TIMEOUT,
+        "pool_recycle": Config.DB_POOL_RECYCLE,
+        "pool_pre_ping": Config.DB_POOL_PRE_PING,
+    }
 
 # Create the SQLAlchemy engine
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=False)
+engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=False, **pool_options())
+instrument_engine(engine)
 
 # Create a SessionLocal class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+#the async engine is used by the FastAPI endpoints so a slow query doesn't hold up the event loop
+async_engine = create_async_engine(async_database_url(SQLALCHEMY_DATABASE_URL), echo=False, **pool_options())
+instrument_engine(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+_current_session: ContextVar[Optional[Session]] = ContextVar("current_session", default=None)
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """The session of the enclosing unit of work, or a new one for just this block.
+
+    A celery task runs inside one scope, so every service method it calls shares one session and
+    connection. An error leaving a nested block rolls the shared session back so the caller can still
+    use it, e.g. to mark a report as failed.
+    """
+    db = _current_session.get()
+    if db is not None:
+        try:
+            yield db
+        except BaseException:
+            db.rollback()
+            raise
+        return
+    with Session(engine) as db:
+        token = _current_session.set(db)
+        try:
+            yield db
+        finally:
+            _current_session.reset(token)
+
+
+def current_session() -> Optional[Session]:
+    #the session of the enclosing session_scope(), if any
+    return _current_session.get()
+
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    #FastAPI dependency, one session per request
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def reset_after_fork() -> None:
+    #connections inherited through fork belong to the parent, the child starts with empty pools
+    #without closing them under the parent, and outside of any session scope the parent had open
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+    _current_session.set(None)
@@ -0,0 +1,232 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import inspect
+import re
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.config import Config
+
+# Counts and latencies of the SQL statements the app runs, per call site. A call site is the innermost
+# BaseCRUDService method on the stack when the statement ran, as "<model>.<method>". Statements are
+# recorded process wide and, inside query_stats(), for that unit of work (a request or a celery task),
+# where a SELECT of the same shape repeated from one call site is reported as an N+1 suspect.
+
+#upper bounds in milliseconds of the latency histogram buckets, the last bucket takes everything slower
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+RECENT_UNITS = 50
+UNTAGGED = "untagged"
+
+_call_site: ContextVar[Optional[str]] = ContextVar("query_call_site", default=None)
+_unit: ContextVar[Optional["QueryStats"]] = ContextVar("query_unit", default=None)
+#"in (?, ?, ?)" and "in (%(p_1)s, %(p_2)s)" lists of any length are one shape
+_PLACEHOLDER_LIST = re.compile(r"\((?:\s*(?:\?|%s|%\([^)]*\)s|\$\d+|:\w+)\s*,)+\s*(?:\?|%s|%\([^)]*\)s|\$\d+|:\w+)\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def query_shape(statement: str) -> str:
+    return _PLACEHOLDER_LIST.sub("(...)", _WHITESPACE.sub(" ", statement).strip())
+
+
+class _SiteStats:
+    __slots__ = ("count", "total_ms", "max_ms", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms: float) -> None:
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "histogram": {label: n for label, n in zip(labels, self.buckets) if n},
+        }
+
+
+class QueryStats:
+    """Statement counts and latency histograms per call site, plus repeats per (call site, query shape)."""
+
+    def __init__(self, name: str = "process"):
+        self.name = name
+        self.started_at = time.time()
+        self.duration_ms: Optional[float] = None
+        self._sites: Dict[str, _SiteStats] = {}
+        self._shapes: Dict[Tuple[str, str], int] = {}
+        #the report item sink writes from its own thread into the same unit
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return sum(site.count for site in self._sites.values())
+
+    @property
+    def total_ms(self) -> float:
+        return sum(site.total_ms for site in self._sites.values())
+
+    def record(self, call_site: str, statement: str, elapsed_ms: float) -> None:
+        shape = query_shape(statement)
+        with self._lock:
+            site = self._sites.get(call_site)
+            if site is None:
+                site = self._sites[call_site] = _SiteStats()
+            site.add(elapsed_ms)
+            key = (call_site, shape)
+            self._shapes[key] = self._shapes.get(key, 0) + 1
+
+    def n_plus_one_suspects(self, threshold: int = Config.QUERY_N_PLUS_ONE_THRESHOLD) -> List[Dict[str, Any]]:
+        with self._lock:
+            repeated = [(key, count) for key, count in self._shapes.items() if count >= threshold and key[1][:6].upper() == "SELECT"]
+        return [{"call_site": call_site, "count": count, "statement": shape} for (call_site, shape), count in sorted(repeated, key=lambda item: -item[1])]
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            sites = {name: site.to_dict() for name, site in sorted(self._sites.items(), key=lambda item: -item[1].total_ms)}
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": None if self.duration_ms is None else round(self.duration_ms, 3),
+            "count": sum(site["count"] for site in sites.values()),
+            "total_ms": round(sum(site["total_ms"] for site in sites.values()), 3),
+            "call_sites": sites,
+            "n_plus_one_suspects": self.n_plus_one_suspects(),
+        }
+
+
+process_stats = QueryStats()
+#summaries of the last finished units of work, newest last
+recent_units: deque = deque(maxlen=RECENT_UNITS)
+
+
+@contextmanager
+def query_stats(name: str) -> Iterator[QueryStats]:
+    """Collects the statements run inside the block, on this thread or on tasks and threads started from it
+    with a copy of its context, into a fresh QueryStats.
+
+    N+1 suspects are printed when the block exits and a summary is kept for the debug endpoint.
+    """
+    stats = QueryStats(name)
+    token = _unit.set(stats)
+    started = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        _unit.reset(token)
+        stats.duration_ms = (time.perf_counter() - started) * 1000
+        if Config.QUERY_INSTRUMENTATION:
+            summary = stats.to_dict()
+            recent_units.append(summary)
+            for suspect in summary["n_plus_one_suspects"]:
+                print(f"Possible N+1 in {name}: {suspect['count']} x {suspect['call_site']}: {suspect['statement'][:200]}")
+
+
+def current_stats() -> Optional[QueryStats]:
+    return _unit.get()
+
+
+def snapshot() -> Dict[str, Any]:
+    return {"process": process_stats.to_dict(), "recent": list(recent_units)}
+
+
+def reset() -> None:
+    global process_stats
+    process_stats = QueryStats()
+    recent_units.clear()
+
+
+def instrument_engine(engine: Engine) -> None:
+    if not Config.QUERY_INSTRUMENTATION or event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    #kept on the statement's own context, a statement that fails never reaches after_cursor_execute
+    #and must not leave its start time behind for the next one
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - context._query_started) * 1000
+    call_site = _call_site.get() or UNTAGGED
+    process_stats.record(call_site, statement, elapsed_ms)
+    unit = _unit.get()
+    if unit is not None:
+        unit.record(call_site, statement, elapsed_ms)
+
+
+def tag_methods(cls: type) -> type:
+    """Wraps the public methods a service class defines so statements run inside them are tagged with
+    "<model>.<method>". Nested calls leave the innermost method as the call site."""
+    if not Config.QUERY_INSTRUMENTATION:
+        return cls
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(method):
+            continue
+        setattr(cls, name, _tagged(method))
+    return cls
+
+
+def _tagged(method):
+    if inspect.iscoroutinefunction(method):
+        @wraps(method)
+        async def coroutine_wrapper(self, *args, **kwargs):
+            token = _call_site.set(f"{_model_name(self)}.{method.__name__}")
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                _call_site.reset(token)
+        return coroutine_wrapper
+
+    if inspect.isgeneratorfunction(method):
+        @wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            call_site = f"{_model_name(self)}.{method.__name__}"
+            generator = method(self, *args, **kwargs)
+            #the tag is only held while the generator runs, not while its caller handles what it yielded
+            try:
+                while True:
+                    token = _call_site.set(call_site)
+                    try:
+                        item = next(generator)
+                    except StopIteration as stop:
+                        return stop.value
+                    finally:
+                        _call_site.reset(token)
+                    yield item
+            finally:
+                generator.close()
+        return generator_wrapper
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        token = _call_site.set(f"{_model_name(self)}.{method.__name__}")
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _call_site.reset(token)
+    return wrapper
+
+
+def _model_name(service) -> str:
+    model = getattr(service, "model", None)
+    return model.__name__ if model is not None else type(service).__name__
@@ -1,10 +1,14 @@
 from app.base import BaseAudit
 from app.config import Config
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import instrumentation
 from .services import *
-from app.database import engine
+from app.database import engine, get_async_db
+from app.store_status.ingest import read_body
 from app.tasks import celery
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
 app = FastAPI()
 
@@ -18,17 +22,53 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def collect_query_stats(request: Request, call_next):
+    if not Config.QUERY_INSTRUMENTATION:
+        return await call_next(request)
+    with instrumentation.query_stats(f"{request.method} {request.url.path}") as stats:
+        response = await call_next(request)
+    response.headers["X-Query-Count"] = str(stats.count)
+    response.headers["X-Query-Time-Ms"] = f"{stats.total_ms:.1f}"
+    return response
+
 @app.on_event("startup")
 def startup():
     BaseAudit.metadata.create_all(bind=engine)
+    status_ingest_queue.start()
+
+@app.on_event("shutdown")
+def shutdown():
+    status_ingest_queue.close()
 
 @app.post("/trigger_report")
-async def trigger_report():
-    report_id = report_service.prepare_report()
-    celery.send_task('tasks.generate_report', args=[report_id])
+async def trigger_report(db: AsyncSession = Depends(get_async_db)):
+    report_id = await report_service.prepare_report_async(db)
+    #publishing to the broker is blocking redis io
+    await run_in_threadpool(celery.send_task, 'tasks.generate_report', args=[report_id])
     return str(report_id)
 
+@app.post("/store_status", status_code=202)
+async def ingest_store_status(request: Request):
+    #NDJSON or CSV pings, written in the background together with everyone else's
+    accepted = await status_ingest_queue.ingest(await read_body(request), request.headers.get("content-type", ""))
+    return {"accepted": accepted}
+
 @app.get("/get_report/{report_id}")
-async def get_report(report_id: str):
-    return report_service.get_report(report_id)
+async def get_report(report_id: int, request: Request, format: str = 'csv', db: AsyncSession = Depends(get_async_db)):
+    return await report_service.get_report_async(db, report_id, request.headers, format)
+
+@app.get("/report_status/{report_id}")
+async def get_report_status(report_id: int, wait: float = 0, db: AsyncSession = Depends(get_async_db)):
+    return await report_service.get_report_status_async(db, report_id, wait)
+
+@app.get("/report_status/{report_id}/events")
+async def report_status_events(report_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await report_service.report_status_events(db, report_id)
 
+@app.get("/debug/queries")
+async def debug_queries():
+    #this process only, celery workers keep their own stats
+    if not Config.QUERY_INSTRUMENTATION:
+        raise HTTPException(status_code=404, detail="Query instrumentation is off")
+    return instrumentation.snapshot()
@@ -1,5 +1,6 @@
 # import all models from here
 from .store.model import Store
 from .store_status.model import StoreStatus
+from .store_status_hourly.model import StoreStatusHourly
 from .business_hour.model import BusinessHour 
 from .report.model import Report, ReportItem
@@ -1,36 +1,393 @@
-from datetime import datetime
-import json
+from datetime import date, datetime, time as time_of_day
+from enum import Enum
 from functools import wraps
-from sqlalchemy.orm import class_mapper
-
-def serialize_sqlalchemy_obj(obj):
-    data = {}
-    for column in class_mapper(obj.__class__).columns:
-        value = getattr(obj, column.name)
-        if isinstance(value, datetime):
-            data[column.name] = value.isoformat()
-        else:
-            data[column.name] = value
-    return data
-
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
-
-def redis_cache(func):
-    @wraps(func)
-    def wrapper(self, *args, **kwargs):
-        cache_key = f"{func.__name__}"
-        cached_result = self.redis_client.get(cache_key)
-        
-        if cached_result:
-            return json.loads(cached_result)
-        
-        result = func(self, *args, **kwargs)
-        serialized_result = json.dumps([serialize_sqlalchemy_obj(store) for store in result], cls=DateTimeEncoder)
-        self.redis_client.set(cache_key, serialized_result)
-        
-        return result
-    return wrapper
+from hashlib import blake2b
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+import asyncio
+import importlib
+import inspect
+import threading
+import time
+import uuid
+import msgpack
+from redis import Redis, RedisError
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+from sqlalchemy import event, inspect as sqlalchemy_inspect
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from app.config import Config
+
+# Bump when the shape of anything cached changes, old entries are then never read again
+CACHE_SCHEMA_VERSION = 1
+#msgpack extension types, everything else is packed natively
+_EXT_DATETIME, _EXT_DATE, _EXT_TIME, _EXT_ENUM, _EXT_MODEL, _EXT_TUPLE = range(1, 7)
+#seconds redis is left alone after an error, so an outage doesn't add a connection timeout to every call
+REDIS_RETRY_AFTER = 5
+#tags may depend on the call, they get the same arguments the key is built from
+Tags = Union[Sequence[str], Callable[..., Iterable[str]]]
+
+
+def _default(obj: Any):
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(_EXT_DATETIME, obj.isoformat().encode())
+    if isinstance(obj, date):
+        return msgpack.ExtType(_EXT_DATE, obj.isoformat().encode())
+    if isinstance(obj, time_of_day):
+        return msgpack.ExtType(_EXT_TIME, obj.isoformat().encode())
+    if isinstance(obj, Enum):
+        enum_type = type(obj)
+        return msgpack.ExtType(_EXT_ENUM, packb([f"{enum_type.__module__}:{enum_type.__qualname__}", obj.name]))
+    if isinstance(obj, (tuple, Row)):
+        return msgpack.ExtType(_EXT_TUPLE, packb(list(obj)))
+    if hasattr(obj, "__table__"):
+        #an ORM instance comes back as a detached instance of its model carrying the column values
+        state = sqlalchemy_inspect(obj)
+        columns = {attribute.key: getattr(obj, attribute.key) for attribute in state.mapper.column_attrs}
+        return msgpack.ExtType(_EXT_MODEL, packb([f"{type(obj).__module__}:{type(obj).__qualname__}", columns]))
+    if hasattr(obj, "item"):
+        #numpy scalars
+        return obj.item()
+    raise TypeError(f"Can't cache a {type(obj).__name__}")
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == _EXT_DATETIME:
+        return datetime.fromisoformat(data.decode())
+    if code == _EXT_DATE:
+        return date.fromisoformat(data.decode())
+    if code == _EXT_TIME:
+        return time_of_day.fromisoformat(data.decode())
+    if code == _EXT_TUPLE:
+        return tuple(unpackb(data))
+    if code == _EXT_ENUM:
+        path, name = unpackb(data)
+        return _import(path)[name]
+    if code == _EXT_MODEL:
+        path, columns = unpackb(data)
+        return _import(path)(**columns)
+    return msgpack.ExtType(code, data)
+
+
+def _import(path: str):
+    module, _, qualname = path.partition(":")
+    obj = importlib.import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+def packb(value: Any) -> bytes:
+    return msgpack.packb(value, default=_default, use_bin_type=True, strict_types=True)
+
+
+def unpackb(data: bytes) -> Any:
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+class RedisCache:
+    """Read-through cache of function results in redis, with an optional in-process LRU in front of it.
+
+    Keys are built from the schema version, the function and its arguments (sessions and self left out).
+    Entries expire after their TTL and can be dropped early by tag. A miss is computed by one caller at a
+    time per key, across threads through a local lock and across processes through a lock in redis, while
+    the others wait for its result. If redis can't be reached the function is just called.
+
+    The local LRU holds entries for at most l1_ttl seconds, which is how long another process can keep
+    serving an entry after it was invalidated.
+    """
+
+    def __init__(self, client: Optional[Redis] = None, async_client: Optional[AsyncRedis] = None, namespace: str = "cache",
+                 default_ttl: int = Config.CACHE_TTL, l1_size: int = Config.CACHE_L1_SIZE, l1_ttl: float = Config.CACHE_L1_TTL,
+                 lock_timeout: float = Config.CACHE_LOCK_TIMEOUT, enabled: bool = Config.CACHE_ENABLED):
+        #a cache that can't answer quickly is skipped, so no retries and short timeouts
+        self.client = client or Redis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB,
+                                      socket_connect_timeout=1, socket_timeout=1, retry=Retry(NoBackoff(), 0))
+        self.async_client = async_client or AsyncRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB,
+                                                       socket_connect_timeout=1, socket_timeout=1, retry=AsyncRetry(NoBackoff(), 0))
+        self.namespace = namespace
+        self.default_ttl = default_ttl
+        self.l1_size = l1_size
+        self.l1_ttl = l1_ttl
+        self.lock_timeout = lock_timeout
+        self.enabled = enabled
+        #key -> (expires at, packed value, tags)
+        self._l1: "OrderedDict[str, Tuple[float, bytes, Tuple[str, ...]]]" = OrderedDict()
+        self._l1_lock = threading.Lock()
+        self._flights: Dict[str, list] = {}
+        self._flights_lock = threading.Lock()
+        self._down_until = 0.0
+
+    def cached(self, ttl: Optional[int] = None, tags: Tags = (), cache_if: Optional[Callable[[Any], bool]] = None, name: Optional[str] = None):
+        """Decorates a function or coroutine function. cache_if can keep results out of the cache, e.g. a
+        report that isn't finished yet."""
+        def decorator(func):
+            signature = inspect.signature(func)
+            func_name = name or f"{func.__module__}.{func.__qualname__}"
+            entry_ttl = ttl or self.default_ttl
+
+            def prepare(args, kwargs) -> Tuple[str, Tuple[str, ...]]:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                arguments = {
+                    key: value for key, value in bound.arguments.items()
+                    if key != "self" and not isinstance(value, (Session, AsyncSession))
+                }
+                digest = blake2b(packb(sorted(arguments.items())), digest_size=16).hexdigest()
+                call_tags = tags(**arguments) if callable(tags) else tags
+                return f"{self.namespace}:v{CACHE_SCHEMA_VERSION}:{func_name}:{digest}", tuple(call_tags)
+
+            if inspect.iscoroutinefunction(func):
+                @wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await func(*args, **kwargs)
+                    key, call_tags = prepare(args, kwargs)
+                    return await self._get_or_compute_async(key, call_tags, entry_ttl, cache_if, lambda: func(*args, **kwargs))
+                return async_wrapper
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                key, call_tags = prepare(args, kwargs)
+                return self._get_or_compute(key, call_tags, entry_ttl, cache_if, lambda: func(*args, **kwargs))
+            return wrapper
+        return decorator
+
+    def invalidate(self, *tags: str) -> None:
+        if not tags:
+            return
+        self._l1_drop(tags)
+        try:
+            pipeline = self.client.pipeline()
+            for tag in tags:
+                #bumping the generation stops results computed before this from being stored after it
+                pipeline.incr(self._generation_key(tag))
+                pipeline.smembers(self._tag_key(tag))
+            results = pipeline.execute()
+            keys = [key for members in results[1::2] for key in members]
+            self.client.delete(*keys, *(self._tag_key(tag) for tag in tags))
+        except RedisError as e:
+            self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+            print(f"Cache invalidation of {', '.join(tags)} failed: {e}")
+
+    def clear_local(self) -> None:
+        with self._l1_lock:
+            self._l1.clear()
+
+    def _get_or_compute(self, key: str, tags: Tuple[str, ...], ttl: int, cache_if, compute: Callable[[], Any]) -> Any:
+        packed = self._l1_get(key)
+        if packed is not None:
+            return unpackb(packed)
+        if time.monotonic() < self._down_until:
+            return compute()
+        with self._local_flight(key):
+            #another thread may have filled it while this one waited
+            packed = self._l1_get(key)
+            if packed is not None:
+                return unpackb(packed)
+            token = None
+            try:
+                packed = self.client.get(key)
+                if packed is None:
+                    packed, token = self._wait_for_lock_holder(key)
+            except RedisError:
+                self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+                return compute()
+            if packed is not None:
+                self._l1_put(key, packed, tags, ttl)
+                return unpackb(packed)
+
+            #this caller holds the redis lock, or gave up waiting for the one that did
+            try:
+                generations = self._generations(tags)
+                value = compute()
+                if cache_if is None or cache_if(value):
+                    packed = packb(value)
+                    self._store(key, packed, tags, ttl, generations)
+                return value
+            finally:
+                self._release(key, token)
+
+    @contextmanager
+    def _local_flight(self, key: str) -> Iterator[None]:
+        #one lock per key being computed in this process, dropped when nobody waits on it anymore
+        with self._flights_lock:
+            flight = self._flights.setdefault(key, [threading.Lock(), 0])
+            flight[1] += 1
+        try:
+            with flight[0]:
+                yield
+        finally:
+            with self._flights_lock:
+                flight[1] -= 1
+                if not flight[1]:
+                    del self._flights[key]
+
+    def _wait_for_lock_holder(self, key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        #(None, lock token) once this caller holds the redis lock, (value, None) if the holder stored one
+        #meanwhile and (None, None) after waiting lock_timeout for it
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_timeout
+        while not self.client.set(self._lock_key(key), token, nx=True, px=int(self.lock_timeout * 1000)):
+            time.sleep(0.05)
+            packed = self.client.get(key)
+            if packed is not None:
+                return packed, None
+            if time.monotonic() > deadline:
+                return None, None
+        return None, token
+
+    def _generations(self, tags: Tuple[str, ...]) -> Optional[List]:
+        if not tags:
+            return []
+        try:
+            return self.client.mget([self._generation_key(tag) for tag in tags])
+        except RedisError:
+            self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+            return None
+
+    def _store(self, key: str, packed: bytes, tags: Tuple[str, ...], ttl: int, generations: Optional[List]) -> None:
+        if generations is None:
+            return
+        try:
+            if tags and self.client.mget([self._generation_key(tag) for tag in tags]) != generations:
+                #invalidated while computing, the result may already be stale
+                return
+            pipeline = self.client.pipeline()
+            pipeline.set(key, packed, ex=ttl)
+            for tag in tags:
+                pipeline.sadd(self._tag_key(tag), key)
+                pipeline.expire(self._tag_key(tag), ttl)
+            pipeline.execute()
+        except RedisError:
+            self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+            return
+        self._l1_put(key, packed, tags, ttl)
+
+    def _release(self, key: str, token: Optional[str]) -> None:
+        if token is None:
+            return
+        try:
+            if self.client.get(self._lock_key(key)) == token.encode():
+                self.client.delete(self._lock_key(key))
+        except RedisError:
+            self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+            pass
+
+    async def _get_or_compute_async(self, key: str, tags: Tuple[str, ...], ttl: int, cache_if, compute: Callable[[], Any]) -> Any:
+        packed = self._l1_get(key)
+        if packed is not None:
+            return unpackb(packed)
+        if time.monotonic() < self._down_until:
+            return await compute()
+        client = self.async_client
+        token = uuid.uuid4().hex
+        try:
+            packed = await client.get(key)
+            deadline = time.monotonic() + self.lock_timeout
+            while packed is None and not await client.set(self._lock_key(key), token, nx=True, px=int(self.lock_timeout * 1000)):
+                await asyncio.sleep(0.05)
+                packed = await client.get(key)
+                if time.monotonic() > deadline:
+                    token = None
+                    break
+            generations = await client.mget([self._generation_key(tag) for tag in tags]) if tags else []
+        except RedisError:
+            self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+            return await compute()
+        if packed is not None:
+            self._l1_put(key, packed, tags, ttl)
+            return unpackb(packed)
+
+        try:
+            value = await compute()
+            if cache_if is None or cache_if(value):
+                packed = packb(value)
+                if not tags or await client.mget([self._generation_key(tag) for tag in tags]) == generations:
+                    pipeline = client.pipeline()
+                    pipeline.set(key, packed, ex=ttl)
+                    for tag in tags:
+                        pipeline.sadd(self._tag_key(tag), key)
+                        pipeline.expire(self._tag_key(tag), ttl)
+                    await pipeline.execute()
+                    self._l1_put(key, packed, tags, ttl)
+            return value
+        except RedisError:
+            self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+            return value
+        finally:
+            if token is not None:
+                try:
+                    if await client.get(self._lock_key(key)) == token.encode():
+                        await client.delete(self._lock_key(key))
+                except RedisError:
+                    self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+                    pass
+
+    def _l1_get(self, key: str) -> Optional[bytes]:
+        if not self.l1_size:
+            return None
+        with self._l1_lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._l1[key]
+                return None
+            self._l1.move_to_end(key)
+            return entry[1]
+
+    def _l1_put(self, key: str, packed: bytes, tags: Tuple[str, ...], ttl: int) -> None:
+        if not self.l1_size:
+            return
+        with self._l1_lock:
+            self._l1[key] = (time.monotonic() + min(ttl, self.l1_ttl), packed, tags)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_size:
+                self._l1.popitem(last=False)
+
+    def _l1_drop(self, tags: Iterable[str]) -> None:
+        tags = set(tags)
+        with self._l1_lock:
+            for key in [key for key, (_, _, entry_tags) in self._l1.items() if tags.intersection(entry_tags)]:
+                del self._l1[key]
+
+    def _tag_key(self, tag: str) -> str:
+        return f"{self.namespace}:tag:{tag}"
+
+    def _generation_key(self, tag: str) -> str:
+        return f"{self.namespace}:generation:{tag}"
+
+    def _lock_key(self, key: str) -> str:
+        return f"{key}:lock"
+
+
+cache = RedisCache()
+
+
+def redis_cache(ttl: Optional[int] = None, tags: Tags = (), cache_if: Optional[Callable[[Any], bool]] = None):
+    return cache.cached(ttl=ttl, tags=tags, cache_if=cache_if)
+
+
+def invalidate_on_commit(db: Session, *tags: str) -> None:
+    #tags are dropped once the session commits, so nobody caches the old rows again in between
+    db.info.setdefault("cache_tags", set()).update(tags)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(db: Session) -> None:
+    tags = db.info.pop("cache_tags", None)
+    if tags:
+        cache.invalidate(*tags)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back(db: Session) -> None:
+    db.info.pop("cache_tags", None)
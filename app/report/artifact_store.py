@@ -0,0 +1,79 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import BinaryIO, ContextManager, Iterator, Optional
+import os
+import tempfile
+from app.config import Config
+
+
+class BlobStore(ABC):
+    """Where finished report files are kept, addressed by flat keys such as report_12.csv."""
+
+    @abstractmethod
+    def writer(self, key: str) -> ContextManager[BinaryIO]:
+        #the blob must only become visible once the block exits without an error
+        ...
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def etag(self, key: str) -> Optional[str]:
+        #None when there is no such blob
+        ...
+
+    def local_path(self, key: str) -> Optional[str]:
+        #a path on local disk lets the blob be sent as a file response, stores that can't offer one return None
+        return None
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+
+class LocalDirectoryBlobStore(BlobStore):
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, os.path.basename(key))
+
+    @contextmanager
+    def writer(self, key: str) -> Iterator[BinaryIO]:
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=f".{os.path.basename(key)}.")
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                yield file
+            os.chmod(tmp_path, 0o644)
+            #rename is atomic, readers see either the old blob or the complete new one
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self._path(key), 'rb')
+
+    def etag(self, key: str) -> Optional[str]:
+        try:
+            stat = os.stat(self._path(key))
+        except FileNotFoundError:
+            return None
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+    def local_path(self, key: str) -> Optional[str]:
+        return self._path(key)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+def get_blob_store(kind: str = Config.REPORT_ARTIFACT_STORE, location: str = Config.REPORT_ARTIFACT_DIR) -> BlobStore:
+    if kind == 'local':
+        return LocalDirectoryBlobStore(location)
+    raise ValueError(f"Unknown report artifact store: {kind}")
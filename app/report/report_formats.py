@@ -0,0 +1,71 @@
+from datetime import timedelta
+from typing import BinaryIO, Collection, Dict, Iterable, List, Sequence, Tuple
+import json
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Download formats of a ready report besides the csv. Every format carries the csv's columns in the csv's
+# units: minutes for a window of up to an hour, hours rounded to 2 decimals for longer ones.
+#format -> (file extension, media type)
+REPORT_FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'ndjson': ('ndjson', 'application/x-ndjson'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('arrow', 'application/vnd.apache.arrow.file'),
+}
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+
+
+def report_columns(report_windows: Sequence[Tuple[str, timedelta]]) -> List[str]:
+    #store_id, then the uptime and the downtime of every window in the order they're configured
+    names = [name for name, _ in report_windows]
+    return ['store_id'] + [f'uptime_{name}' for name in names] + [f'downtime_{name}' for name in names]
+
+
+def hour_columns(report_windows: Sequence[Tuple[str, timedelta]]) -> List[str]:
+    #the columns reported in hours rather than minutes
+    longer = [name for name, length in report_windows if length > timedelta(hours=1)]
+    return [f'uptime_{name}' for name in longer] + [f'downtime_{name}' for name in longer]
+
+
+def rows_to_columns(rows: Sequence, column_names: Sequence[str], in_hours: Collection[str]) -> Dict[str, np.ndarray]:
+    #rows hold the values of column_names in that order, stored in minutes
+    values = np.asarray(rows, dtype=np.int64).reshape(len(rows), len(column_names))
+    columns = {}
+    for index, name in enumerate(column_names):
+        columns[name] = np.round(values[:, index] / 60, 2) if name in in_hours else values[:, index]
+    return columns
+
+
+def write_ndjson(batches: Iterable[Dict[str, np.ndarray]], file: BinaryIO, column_names: Sequence[str]) -> None:
+    for columns in batches:
+        lines = [
+            json.dumps(dict(zip(column_names, values)), separators=(",", ":"))
+            for values in zip(*(columns[name].tolist() for name in column_names))
+        ]
+        if lines:
+            file.write(("\n".join(lines) + "\n").encode())
+
+
+def write_columnar(format: str, batches: Iterable[Dict[str, np.ndarray]], file: BinaryIO, column_names: Sequence[str], in_hours: Collection[str]) -> None:
+    #record batches go straight from the column arrays into the file, one per batch of rows
+    if pyarrow is None:
+        raise RuntimeError(f"pyarrow is needed for {format} reports")
+    schema = pyarrow.schema([(name, pyarrow.float64() if name in in_hours else pyarrow.int64()) for name in column_names])
+    if format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(file, schema)
+    else:
+        writer = pyarrow.ipc.new_file(file, schema)
+    with writer:
+        for columns in batches:
+            writer.write_batch(pyarrow.record_batch([pyarrow.array(columns[name]) for name in column_names], schema=schema))
+
+
+def available_formats() -> List[str]:
+    return [format for format in REPORT_FORMATS if pyarrow is not None or format not in COLUMNAR_FORMATS]
@@ -1,6 +1,24 @@
+from typing import Iterator, Optional, Sequence
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
 from app.crud import BaseCRUDService
 from .model import ReportItem
 
 class ReportItemService(BaseCRUDService[ReportItem]):
     def __init__(self):
         super().__init__(ReportItem)
+
+    def delete_for_stores(self, db: Session, report_id: int, min_store_id: Optional[int] = None, max_store_id: Optional[int] = None) -> int:
+        #clears what an earlier attempt of a shard wrote, so a retried shard doesn't duplicate items
+        query = db.query(ReportItem).filter(ReportItem.report_id == report_id)
+        if min_store_id is not None:
+            query = query.filter(ReportItem.store_id >= min_store_id)
+        if max_store_id is not None:
+            query = query.filter(ReportItem.store_id <= max_store_id)
+        deleted = query.delete(synchronize_session=False)
+        db.commit()
+        return deleted
+
+    def stream_report_rows(self, db: Session, report_id: int, columns: Sequence[str], yield_per: int = 10000) -> Iterator[Row]:
+        #only the columns the report shows, fetched from a server side cursor
+        return self.findColumns(db, columns, order_by=('store_id',), yield_per=yield_per, report_id=report_id)
@@ -0,0 +1,65 @@
+from queue import Queue
+from typing import List, Optional
+import contextvars
+import threading
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from .report_item_service import ReportItemService
+
+
+class ReportItemSink:
+    """Bulk writer for report item rows.
+
+    Batches handed to write() are written with ReportItemService.bulkInsert by a background thread on its
+    own session while the caller computes the next batch. Every batch commits on its own. An error in the
+    writer thread is raised from the next write() or from close().
+    """
+
+    def __init__(self, report_item_service: ReportItemService, bind: Engine, max_pending: int = 2):
+        self.report_item_service = report_item_service
+        self.bind = bind
+        self._queue: Queue = Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        #the writer runs in a copy of the caller's context, so its inserts count towards the caller's query stats
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run,), name="report-item-sink", daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> "ReportItemSink":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def write(self, rows: List[dict]) -> None:
+        self._raise_error()
+        if rows:
+            #blocks once max_pending batches are waiting, so a slow database holds back the producer
+            self._queue.put(rows)
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self) -> None:
+        while True:
+            rows = self._queue.get()
+            if rows is None:
+                return
+            if self._error is not None:
+                #keep draining so the producer never blocks on a dead writer
+                continue
+            try:
+                self._flush(rows)
+            except BaseException as e:
+                self._error = e
+
+    def _flush(self, rows: List[dict]) -> None:
+        with Session(self.bind) as db:
+            self.report_item_service.bulkInsert(db, rows, batch_size=len(rows))
@@ -0,0 +1,83 @@
+from datetime import datetime
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import numpy as np
+from sqlalchemy.orm import Session
+from app.business_hour.schedule_index import ScheduleIndex, schedule_index as default_schedule_index
+from app.business_hour.service import BusinessHourService
+from app.store_status.service import StoreStatusService
+from . import uptime_engine
+
+
+class _StoreGroups:
+    """Walks rows ordered by store_id and hands out the rows of one store at a time."""
+
+    def __init__(self, rows: Iterable):
+        self._rows = iter(rows)
+        self._next = next(self._rows, None)
+
+    def take(self, store_id: int) -> List:
+        #store ids must be requested in ascending order
+        while self._next is not None and self._next.store_id < store_id:
+            self._next = next(self._rows, None)
+        group = []
+        while self._next is not None and self._next.store_id == store_id:
+            group.append(self._next)
+            self._next = next(self._rows, None)
+        return group
+
+
+class ReportBatch(NamedTuple):
+    store_ids: List[int]
+    open_intervals: uptime_engine.OpenIntervalArrays
+    statuses: uptime_engine.StatusArrays
+    rollups: Optional[uptime_engine.RollupArrays]
+    first_polls: Optional[np.ndarray]
+
+
+class ReportDataLoader:
+    def __init__(self, business_hour_service: BusinessHourService, status_service: StoreStatusService, rollup_service=None, schedule_index: ScheduleIndex = default_schedule_index):
+        self.business_hour_service = business_hour_service
+        self.status_service = status_service
+        self.rollup_service = rollup_service
+        self.schedule_index = schedule_index
+
+    def iter_batches(self, db: Session, store_ids: List[int], status_ranges: List[Tuple[datetime, datetime]], rollup_range: Optional[Tuple[datetime, datetime]] = None, batch_size: int = 1000, first_poll_after: Optional[List[datetime]] = None) -> Iterator[ReportBatch]:
+        """Yields the UTC open intervals, statuses and (optionally) hourly rollups and first poll times after
+        each of first_poll_after per batch of stores.
+
+        Each kind of row is read with a single streamed query and merged against the sorted store ids,
+        so only one batch worth of rows is held in memory at a time. The session should not be committed
+        while iterating, as that would close the server side cursors.
+        """
+        store_ids = sorted(store_ids)
+        if not store_ids:
+            return
+        #only the store id range being reported on is read, which keeps shards from scanning each other's rows
+        min_store_id, max_store_id = store_ids[0], store_ids[-1]
+        business_hours = _StoreGroups(self.business_hour_service.stream_schedule_rows(db, min_store_id, max_store_id))
+        statuses = _StoreGroups(self.status_service.stream_status_rows(db, status_ranges, min_store_id, max_store_id))
+        rollups = None
+        if rollup_range is not None:
+            rollups = _StoreGroups(self.rollup_service.stream_rollup_rows(db, *rollup_range, min_store_id, max_store_id))
+        first_polls = None
+        if first_poll_after:
+            first_polls = _StoreGroups(self.status_service.stream_first_status_times(db, first_poll_after, min_store_id, max_store_id))
+        #open intervals have to cover every instant that is read
+        ranges = status_ranges + ([rollup_range] if rollup_range is not None else [])
+        horizon_start_us = min(uptime_engine.to_epoch_us(start) for start, _ in ranges)
+        horizon_end_us = max(uptime_engine.to_epoch_us(end) for _, end in ranges)
+
+        for i in range(0, len(store_ids), batch_size):
+            batch = store_ids[i:i + batch_size]
+            yield ReportBatch(
+                batch,
+                uptime_engine.open_intervals_to_arrays([self._open_intervals(business_hours.take(store_id), horizon_start_us, horizon_end_us) for store_id in batch]),
+                uptime_engine.statuses_to_arrays([statuses.take(store_id) for store_id in batch]),
+                uptime_engine.rollups_to_arrays([rollups.take(store_id) for store_id in batch]) if rollups else None,
+                uptime_engine.first_polls_to_arrays([first_polls.take(store_id) for store_id in batch], len(first_poll_after)) if first_polls else None,
+            )
+
+    def _open_intervals(self, schedule_rows: List, start_us: int, end_us: int):
+        #stores sharing a schedule and timezone get the very same interval arrays back
+        timezone_name = schedule_rows[0].timezone if schedule_rows else None
+        return self.schedule_index.intervals(schedule_rows, timezone_name, start_us, end_us)
@@ -1,192 +1,311 @@
 from fastapi import HTTPException
-from typing import List, Tuple
+from typing import List, Mapping, Optional, Tuple
 from app.business_hour.service import BusinessHourService
+from app.async_crud import AsyncBaseCRUDService
 from app.crud import BaseCRUDService
 from app.report.enum import ReportStatus
 from app.store_status.enum import ActivityStatus
-from app.redis import redis_cache
+from app.redis import invalidate_on_commit, redis_cache
+from .artifact_store import BlobStore
 from .report_item_service import ReportItemService
+from .report_item_sink import ReportItemSink
+from .report_status import FINISHED_STATUSES, ReportStatusChannel
+from . import report_formats
+from . import uptime_engine
+from .report_loader import ReportBatch, ReportDataLoader
 from app.store.service import StoreService
 from app.store_status.service import StoreStatusService
+from app.store_status_hourly.service import StoreStatusHourlyService
 from .model import Report, ReportItem
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.database import engine
+from app.database import AsyncSessionLocal, engine, session_scope
 from datetime import datetime, timedelta
 import pytz
+import asyncio
 import csv
+import gzip
 import io
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from redis import Redis
 from app.config import Config
 
+# (name, length) of every window a report covers, all ending at the report time.
+# each name needs matching uptime_<name>/downtime_<name> columns on ReportItem
+DEFAULT_REPORT_WINDOWS = [
+    ("last_hour", timedelta(hours=1)),
+    ("last_day", timedelta(days=1)),
+    ("last_week", timedelta(weeks=1)),
+]
+#csv rows are sent in pieces of about this many characters rather than one row at a time
+CSV_CHUNK_SIZE = 64 * 1024
+#seconds between keepalive comments on a report status event stream
+STATUS_EVENTS_KEEPALIVE = 15
+
+def _is_finished(report: Optional[Report]) -> bool:
+    return report is not None and report.status in (ReportStatus.READY, ReportStatus.FAILED)
+
 class ReportService(BaseCRUDService[Report]):
-    def __init__(self, store_service: StoreService, status_service: StoreStatusService, business_hour_service: BusinessHourService, report_item_service: ReportItemService):
+    def __init__(self, store_service: StoreService, status_service: StoreStatusService, business_hour_service: BusinessHourService, report_item_service: ReportItemService, rollup_service: StoreStatusHourlyService, artifact_store: BlobStore, report_windows: List[Tuple[str, timedelta]] = DEFAULT_REPORT_WINDOWS, report_source: str = Config.REPORT_SOURCE):
         super().__init__(Report)
+        #report lookups from the endpoints, which run on the event loop
+        self.async_reports = AsyncBaseCRUDService(Report)
         self.store_service = store_service
         self.status_service = status_service
         self.business_hour_service = business_hour_service
         self.report_item_service = report_item_service
+        self.artifact_store = artifact_store
+        self.report_loader = ReportDataLoader(business_hour_service, status_service, rollup_service)
+        self.report_windows = report_windows
+        #what a downloaded report shows, a column pair for every window
+        self.report_columns = report_formats.report_columns(report_windows)
+        self.hour_columns = report_formats.hour_columns(report_windows)
+        self.report_source = report_source
         self.redis_client = Redis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB)
+        self.report_statuses = ReportStatusChannel()
 
-    def _calculate_uptime_downtime(self, business_hours, store_statuses, start_date: datetime, end_date: datetime) -> Tuple[int, int, int]:
-        total_uptime, total_downtime, expected_uptime = 0, 0, 0
-        current_date = start_date.date()
-        total_duration = (end_date - start_date).total_seconds() / 60
-
-        #Iterate through each day in the date range
-        while current_date <= end_date.date():
-            day_of_week = current_date.weekday()
-
-            #Filter business hours for the current day of the week
-            day_business_hours = [
-                bh for bh in business_hours if bh.day_of_week.value == day_of_week]
-
-            #Iterate through each business hour in the day
-            for bh in day_business_hours:
-                start_datetime = max(datetime.combine(current_date, bh.start_time), start_date)
-                end_datetime = min(datetime.combine(current_date, bh.end_time), end_date)
-                
-                if end_datetime <= start_datetime:
-                    #add a day to end_datetime
-                    end_datetime += timedelta(days=1)
-
-                #Calculate the duration of the business hour period
-                period_duration = min((end_datetime - start_datetime).total_seconds() / 60, total_duration - expected_uptime)
-                expected_uptime += period_duration
-
-                #Filter store statuses for the current business hour period
-                period_status_reports = [sr for sr in store_statuses if start_datetime <= sr.timestamp <= end_datetime]
-
-                #If there are no store statuses for the current business hour period, add the duration to downtime
-                if not period_status_reports:
-                    total_downtime += period_duration
-                    continue
+    def generate_report(self, report_id: int) -> None:
+        self.generate_report_shard(report_id)
+        self.mark_report_as_ready(report_id)
 
-                #Initialize the last check time and status
-                #Assume the first store status is inactive
-                last_check_time, last_status = start_datetime, False
+    def generate_report_shard(self, report_id: int, min_store_id: Optional[int] = None, max_store_id: Optional[int] = None) -> None:
+        #statuses are streamed on their own session so committing report items doesn't close the cursors
+        with session_scope() as db, Session(engine) as read_db:
+            self.report_item_service.delete_for_stores(db, report_id, min_store_id, max_store_id)
+            store_ids = self.store_service.find_ids(db, min_store_id, max_store_id)
+            self._process_stores_in_batches(db, read_db, store_ids, report_id)
 
-                #Iterate through each store status in the current business hour period
-                for sr in period_status_reports:
-                    duration = (sr.timestamp - last_check_time).total_seconds() / 60
-                    #if the last status is active, add the duration to uptime, otherwise add it to downtime
-                    total_uptime += duration if last_status else 0
-                    total_downtime += duration if not last_status else 0
+    def get_report_shards(self, n_shards: int) -> List[Tuple[int, int]]:
+        with session_scope() as db:
+            return self.store_service.get_id_shards(db, n_shards)
 
-                    last_check_time = sr.timestamp
-                    last_status = (sr.status == ActivityStatus.ACTIVE)
+    def _get_current_time(self) -> datetime:
+        #adjust current time as per the requirement
+        return datetime.strptime("2023-01-19 08:03:07.391994", "%Y-%m-%d %H:%M:%S.%f").astimezone(pytz.UTC)
 
-                final_duration = (end_datetime - last_check_time).total_seconds() / 60
-                #if the last status is active, add the duration to uptime, otherwise add it to downtime
-                total_uptime += final_duration if last_status else 0
-                total_downtime += final_duration if not last_status else 0
+    def _get_report_windows(self, current_time: datetime) -> List[Tuple[str, datetime, datetime]]:
+        return [(name, current_time - length, current_time) for name, length in self.report_windows]
 
-            current_date += timedelta(days=1)
+    def _process_stores_in_batches(self, db: Session, read_db: Session, store_ids: List[int], report_id: int, batch_size: int = 1000):
+        windows = self._get_report_windows(self._get_current_time())
+        if self.report_source == 'rollup':
+            #whole hours come from the hourly rollups, polls are only read for the partial hours at the window edges
+            status_ranges, rollup_range = uptime_engine.rollup_read_ranges(windows)
+            first_poll_after = [start for _, start, _ in windows]
+        else:
+            status_ranges = [(min(start for _, start, _ in windows), max(end for _, _, end in windows))]
+            rollup_range, first_poll_after = None, None
+        batches = self.report_loader.iter_batches(read_db, store_ids, status_ranges, rollup_range, batch_size, first_poll_after)
 
-        return int(total_uptime), int(total_downtime), int(expected_uptime)
+        #items are written in the background while the next batch is computed
+        with ReportItemSink(self.report_item_service, engine) as sink:
+            for batch in batches:
+                sink.write(self._generate_batch_report(batch, windows, report_id))
+
+    def _generate_batch_report(self, batch: ReportBatch, windows: List[Tuple[str, datetime, datetime]], report_id: int) -> List[dict]:
+        #every window of the whole batch comes out of a single engine pass
+        if batch.rollups is not None:
+            results = uptime_engine.calculate_windows_from_rollups(batch.open_intervals, batch.statuses, batch.rollups, batch.first_polls, len(batch.store_ids), windows)
+        else:
+            results = uptime_engine.calculate_windows(batch.open_intervals, batch.statuses, len(batch.store_ids), windows)
 
-    def generate_report(self, report_id: int) -> None:
-        with Session(engine) as db:
-            stores = self.store_service.findAllBy(db, limit=20000)
-            self._process_stores_in_batches(db, stores, report_id)
-            self.mark_report_as_ready(report_id)
-           
-    def _process_stores_in_batches(self, db: Session, stores: List, report_id: int, batch_size: int = 1000):
         report_items = []
-        for store in stores:
-            report_item = self._generate_store_report(db, store, report_id)
+        for i, store_id in enumerate(batch.store_ids):
+            report_item = {"store_id": store_id, "report_id": report_id, "created_by": "system", "updated_by": "system"}
+            for name, (uptime, downtime, _) in results.items():
+                report_item[f"uptime_{name}"] = int(uptime[i])
+                report_item[f"downtime_{name}"] = int(downtime[i])
             report_items.append(report_item)
-            
-            if len(report_items) >= batch_size:
-                self.report_item_service.createMultiple(db, objs_in=report_items)
-                report_items = []
-
-        if report_items:
-            self.report_item_service.createMultiple(db, objs_in=report_items)
-
-    def _generate_store_report(self, db: Session, store, report_id: int) -> dict:
-        #adjust current time as per the requirement
-        current_time = datetime.strptime("2023-01-19 08:03:07.391994", "%Y-%m-%d %H:%M:%S.%f").astimezone(pytz.UTC)
-        one_hour_ago = current_time - timedelta(hours=1)
-        one_day_ago = current_time - timedelta(days=1)
-        one_week_ago = current_time - timedelta(weeks=1)
+        return report_items
 
-        business_hours = self.business_hour_service.findAllBy(db, limit=10000, store_id=store.id)
-
-        store_statuses = self.status_service.findAllByAttributes(db, limit=10000, store_id=store.id, timestamp={'$gte': one_week_ago})
-        store_statuses.sort(key=lambda x: x.timestamp)
-
-        store_statuses_last_hour = [sr for sr in store_statuses if one_hour_ago <= sr.timestamp <= current_time]
-        store_statuses_last_day = [sr for sr in store_statuses if one_day_ago <= sr.timestamp <= current_time]
-        store_statuses_last_week = [sr for sr in store_statuses if one_week_ago <= sr.timestamp <= current_time]    
+    def mark_report_as_ready(self, report_id: int) -> None:
+        #the files are in place before anyone can see the report as ready
+        self.materialize_report(report_id)
+        with session_scope() as db:
+            invalidate_on_commit(db, f"report:{report_id}")
+            self.findAndUpdate(db, filter_by={"id":report_id}, update_data={"status":ReportStatus.READY,"generated_at":datetime.now().astimezone(pytz.UTC)})
+        #published once committed, so whoever hears it finds the report ready in the database as well
+        self.report_statuses.publish(report_id, ReportStatus.READY)
 
-        uptime_last_hour, downtime_last_hour, expected_uptime_last_hour = self._calculate_uptime_downtime(business_hours, store_statuses_last_hour, one_hour_ago, current_time)
-        uptime_last_day, downtime_last_day, expected_uptime_last_day = self._calculate_uptime_downtime(business_hours, store_statuses_last_day, one_day_ago, current_time)
-        uptime_last_week, downtime_last_week, expected_uptime_last_week = self._calculate_uptime_downtime(business_hours, store_statuses_last_week, one_week_ago, current_time)
+    def mark_report_as_failed(self, report_id: int) -> None:
+        with session_scope() as db:
+            invalidate_on_commit(db, f"report:{report_id}")
+            self.findAndUpdate(db, filter_by={"id":report_id}, update_data={"status":ReportStatus.FAILED})
+        self.report_statuses.publish(report_id, ReportStatus.FAILED)
+    
+    async def prepare_report_async(self, db: AsyncSession) -> int:
+        report_id = (await self.async_reports.create(db, obj_in=self._new_report())).id
+        await self.report_statuses.publish_async(report_id, ReportStatus.PENDING)
+        return report_id
 
+    def _new_report(self) -> dict:
         return {
-            "store_id": store.id,
-            "report_id":report_id,
-            "uptime_last_hour":uptime_last_hour,
-            "uptime_last_day":uptime_last_day,
-            "uptime_last_week":uptime_last_week,
-            "downtime_last_hour":downtime_last_hour,
-            "downtime_last_day":downtime_last_day,
-            "downtime_last_week":downtime_last_week,
+            "status": ReportStatus.PENDING,
+            "requested_at": datetime.now().astimezone(pytz.UTC),
+
             "created_by":"system",
             "updated_by":"system"
         }
+        
+    def materialize_report(self, report_id: int) -> None:
+        #a ready report never changes, so its csv is written once, plain and pre-compressed
+        key = self._artifact_key(report_id, 'csv')
+        with self.artifact_store.writer(key) as plain, self.artifact_store.writer(key + ".gz") as compressed:
+            with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as gz:
+                for chunk in self._generate_csv(report_id):
+                    data = chunk.encode()
+                    plain.write(data)
+                    gz.write(data)
 
-    def mark_report_as_ready(self, report_id: int) -> None:
-        with Session(engine) as db:
-            self.findAndUpdate(db, filter_by={"id":report_id}, update_data={"status":ReportStatus.READY,"generated_at":datetime.now().astimezone(pytz.UTC)})
+    async def get_report_async(self, db: AsyncSession, report_id: int, request_headers: Optional[Mapping[str, str]] = None, format: str = 'csv'):
+        self._check_format(format)
+        status = await self._current_status_async(db, report_id)
+        if status == ReportStatus.FAILED:
+            return "Failed"
+        if status != ReportStatus.READY:
+            return "Running"
 
-    def mark_report_as_failed(self, report_id: int) -> None:
-        with Session(engine) as db:
-            self.findAndUpdate(db, filter_by={"id":report_id}, update_data={"status":ReportStatus.FAILED})
-    
-    def prepare_report(self) -> int:
-        with Session(engine) as db:
-            report = {
-                "status": ReportStatus.PENDING,
-                "requested_at": datetime.now().astimezone(pytz.UTC),
-
-                "created_by":"system",
-                "updated_by":"system"
-            }
-            return self.create(db, obj_in=report).id
-        
-    def get_report(self, report_id: int):
-        with Session(engine) as db:
-            report = self.findOneById(db, report_id)
+        if self._needs_materializing(report_id, format):
+            #a first download of a format reads every item, that's done off the event loop
+            await run_in_threadpool(self.materialize_report_format, report_id, format)
+        return self._report_response(report_id, request_headers or {}, format)
+
+    async def get_report_status_async(self, db: AsyncSession, report_id: int, wait: float = 0) -> str:
+        #long poll: answers as soon as the report is ready or failed, or with its current status after wait seconds
+        status = None
+        if wait > 0:
+            status = await self.report_statuses.wait_until_finished(report_id, min(wait, Config.REPORT_STATUS_MAX_WAIT))
+        return (status or await self._current_status_async(db, report_id)).value
+
+    async def report_status_events(self, db: AsyncSession, report_id: int) -> StreamingResponse:
+        #server sent events: the current status, then every change until the report is ready or failed
+        status = await self._current_status_async(db, report_id)
+
+        async def events():
+            current = status
+            yield f"event: status\ndata: {current.value}\n\n"
+            while current not in FINISHED_STATUSES:
+                next_status = await self.report_statuses.wait_until_finished(report_id, STATUS_EVENTS_KEEPALIVE)
+                if next_status is None:
+                    #redis can't tell, look at the database now and then instead
+                    await asyncio.sleep(STATUS_EVENTS_KEEPALIVE)
+                    async with AsyncSessionLocal() as own_db:
+                        next_status = await self._current_status_async(own_db, report_id)
+                if next_status == current:
+                    yield ": keepalive\n\n"
+                    continue
+                current = next_status
+                yield f"event: status\ndata: {current.value}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    async def _current_status_async(self, db: AsyncSession, report_id: int) -> ReportStatus:
+        #from redis when it knows the report, the database otherwise
+        status = await self.report_statuses.get(report_id)
+        if status is None:
+            report = await self._find_report_async(db, report_id)
             if report is None:
                 raise HTTPException(status_code=404, detail="Report not found")
-            if report.status == ReportStatus.FAILED:
-                return "Failed"
-            if report.status != ReportStatus.READY:
-                return "Running"
-            
-            reportItems = self.report_item_service.findAllBy(db, limit=20000, report_id=report.id)
-            return StreamingResponse(self._generate_csv(reportItems), media_type="text/csv", headers={"Content-Disposition": f"attachment; filename=report_{report_id}.csv"})
-        
-    def _generate_csv(self, report_items: List[ReportItem]):
+            status = report.status
+        return status
+
+    #finished reports don't change anymore, so only those are cached
+    @redis_cache(tags=lambda report_id: [f"report:{report_id}"], cache_if=_is_finished)
+    async def _find_report_async(self, db: AsyncSession, report_id: int) -> Optional[Report]:
+        return await self.async_reports.findOneById(db, report_id)
+
+    def _check_format(self, format: str) -> None:
+        if format not in report_formats.REPORT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unknown report format, use one of {', '.join(report_formats.REPORT_FORMATS)}")
+        if format not in report_formats.available_formats():
+            raise HTTPException(status_code=501, detail=f"{format} reports need pyarrow, which is not installed")
+
+    def _needs_materializing(self, report_id: int, format: str) -> bool:
+        #other formats are written the first time someone asks for them and served from the file after that
+        return format != 'csv' and self.artifact_store.etag(self._artifact_key(report_id, format)) is None
+
+    def _report_response(self, report_id: int, request_headers: Mapping[str, str], format: str) -> Response:
+        artifact = self._serve_artifact(report_id, request_headers, format)
+        if artifact is not None:
+            return artifact
+        #reports finished before artifacts were written are rebuilt from their items, read while the response is being sent
+        #(starlette iterates a sync generator on its thread pool)
+        return StreamingResponse(self._generate_csv(report_id), media_type="text/csv", headers={"Content-Disposition": f"attachment; filename=report_{report_id}.csv"})
+
+    def materialize_report_format(self, report_id: int, format: str) -> None:
+        with self.artifact_store.writer(self._artifact_key(report_id, format)) as file:
+            if format == 'ndjson':
+                report_formats.write_ndjson(self._iter_report_columns(report_id), file, self.report_columns)
+            else:
+                report_formats.write_columnar(format, self._iter_report_columns(report_id), file, self.report_columns, self.hour_columns)
+
+    def _iter_report_columns(self, report_id: int, batch_size: int = 65536):
+        with Session(engine) as db:
+            for rows in self.report_item_service.stream_report_rows(db, report_id, self.report_columns, yield_per=batch_size).partitions():
+                yield report_formats.rows_to_columns(rows, self.report_columns, self.hour_columns)
+
+    def _artifact_key(self, report_id: int, format: str) -> str:
+        extension, _ = report_formats.REPORT_FORMATS[format]
+        return f"report_{report_id}.{extension}"
+
+    def _serve_artifact(self, report_id: int, request_headers: Mapping[str, str], format: str = 'csv') -> Optional[Response]:
+        key = filename = self._artifact_key(report_id, format)
+        _, media_type = report_formats.REPORT_FORMATS[format]
+        headers = {"Vary": "Accept-Encoding"}
+        #only the csv has a pre-compressed copy, parquet and arrow are compressed or binary already
+        if format == 'csv' and _accepts_gzip(request_headers.get("accept-encoding", "")) and self.artifact_store.etag(key + ".gz") is not None:
+            key += ".gz"
+            headers["Content-Encoding"] = "gzip"
+        etag = self.artifact_store.etag(key)
+        if etag is None:
+            return None
+        headers["ETag"] = etag
+        if _etag_matches(request_headers.get("if-none-match", ""), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept-Encoding"})
+
+        path = self.artifact_store.local_path(key)
+        if path is not None:
+            #file responses answer Range requests themselves and hand the file to the server without reading it in python
+            return FileResponse(path, media_type=media_type, filename=filename, headers=headers)
+        headers["Content-Disposition"] = f"attachment; filename={filename}"
+        return StreamingResponse(self._read_artifact(key), media_type=media_type, headers=headers)
+
+    def _read_artifact(self, key: str, chunk_size: int = CSV_CHUNK_SIZE):
+        #opened once the response starts sending and closed when it's done or the client goes away
+        with self.artifact_store.open(key) as file:
+            while chunk := file.read(chunk_size):
+                yield chunk
+
+    def _generate_csv(self, report_id: int, chunk_size: int = CSV_CHUNK_SIZE):
         buffer = io.StringIO()
         writer = csv.writer(buffer)
         
-        writer.writerow(['store_id', 'uptime_last_hour', 'uptime_last_day', 'uptime_last_week', 'downtime_last_hour', 'downtime_last_day', 'downtime_last_week'])
+        writer.writerow(self.report_columns)
         
-        for row in report_items:
-            writer.writerow([
-                row.store_id, 
-                round(row.uptime_last_hour, 2), 
-                round(row.uptime_last_day/60, 2), 
-                round(row.uptime_last_week/60, 2), 
-                round(row.downtime_last_hour, 2), 
-                round(row.downtime_last_day/60, 2), 
-                round(row.downtime_last_week/60, 2)
-            ])
+        with Session(engine) as db:
+            for row in self.report_item_service.stream_report_rows(db, report_id, self.report_columns):
+                writer.writerow([round(value/60, 2) if name in self.hour_columns else round(value, 2) for name, value in zip(self.report_columns, row)])
+                if buffer.tell() >= chunk_size:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate(0)
+        if buffer.tell():
             yield buffer.getvalue()
-            buffer.seek(0)
-            buffer.truncate(0)
 
-              
\ No newline at end of file
+              
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    #weak comparison, as If-None-Match asks for
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in if_none_match.split(","))
@@ -0,0 +1,81 @@
+from typing import Optional
+import asyncio
+from redis import Redis, RedisError
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+from app.config import Config
+from .enum import ReportStatus
+
+FINISHED_STATUSES = (ReportStatus.READY, ReportStatus.FAILED)
+
+
+class ReportStatusChannel:
+    """The status of each report kept in redis, published on the report's own channel whenever it changes.
+
+    Status checks and waits for a report to finish are answered from here without the database. Every
+    read returns None when redis doesn't know the report or can't be reached, and the caller then falls
+    back to the database.
+    """
+
+    def __init__(self, client: Optional[Redis] = None, async_client: Optional[AsyncRedis] = None, ttl: int = Config.REPORT_STATUS_TTL):
+        self.client = client or Redis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB,
+                                      socket_connect_timeout=1, socket_timeout=1, retry=Retry(NoBackoff(), 0))
+        #no socket timeout here, waiting subscribers block on the connection until a message or their own timeout
+        self.async_client = async_client or AsyncRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB,
+                                                       socket_connect_timeout=1, retry=AsyncRetry(NoBackoff(), 0))
+        self.ttl = ttl
+
+    def publish(self, report_id: int, status: ReportStatus) -> None:
+        try:
+            pipeline = self.client.pipeline()
+            pipeline.set(self._key(report_id), status.value, ex=self.ttl)
+            pipeline.publish(self._key(report_id), status.value)
+            pipeline.execute()
+        except RedisError as e:
+            print(f"Publishing status {status.value} of report {report_id} failed: {e}")
+
+    async def publish_async(self, report_id: int, status: ReportStatus) -> None:
+        try:
+            pipeline = self.async_client.pipeline()
+            pipeline.set(self._key(report_id), status.value, ex=self.ttl)
+            pipeline.publish(self._key(report_id), status.value)
+            await pipeline.execute()
+        except RedisError as e:
+            print(f"Publishing status {status.value} of report {report_id} failed: {e}")
+
+    async def get(self, report_id: int) -> Optional[ReportStatus]:
+        try:
+            value = await self.async_client.get(self._key(report_id))
+        except RedisError:
+            return None
+        return ReportStatus(value.decode()) if value is not None else None
+
+    async def wait_until_finished(self, report_id: int, timeout: float) -> Optional[ReportStatus]:
+        #the status once the report is ready or failed, or its status when timeout runs out first
+        pubsub = self.async_client.pubsub()
+        try:
+            #subscribed before reading, so a change between the two is still heard
+            await pubsub.subscribe(self._key(report_id))
+            status = await self.get(report_id)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while status is not None and status not in FINISHED_STATUSES:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+                if message is not None and message["type"] == "message":
+                    status = ReportStatus(message["data"].decode())
+            return status
+        except RedisError:
+            return None
+        finally:
+            try:
+                await pubsub.aclose()
+            except RedisError:
+                pass
+
+    def _key(self, report_id: int) -> str:
+        return f"report_status:{report_id}"
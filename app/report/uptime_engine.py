@@ -0,0 +1,359 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, NamedTuple, Sequence, Tuple
+import numpy as np
+from app.store_status.enum import ActivityStatus
+
+# Vectorized uptime/downtime engine used by ReportService.
+# All instants are int64 microseconds since the unix epoch (UTC), all durations are int64 microseconds.
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECONDS_PER_MINUTE = 60 * 1_000_000
+MICROSECONDS_PER_HOUR = 60 * MICROSECONDS_PER_MINUTE
+MICROSECONDS_PER_DAY = 24 * MICROSECONDS_PER_HOUR
+#codes for the status a store was left in at the end of an hour bucket
+NO_STATUS, INACTIVE, ACTIVE = -1, 0, 1
+#first poll time of a store that has no poll after a window start
+NO_POLL = np.iinfo(np.int64).max
+
+
+class OpenIntervalArrays(NamedTuple):
+    store_index: np.ndarray  # position of the store in the batch, ascending
+    start: np.ndarray  # epoch microseconds the store opens, ascending within a store
+    end: np.ndarray  # epoch microseconds it closes, intervals of a store never overlap or touch
+
+
+class StatusArrays(NamedTuple):
+    store_index: np.ndarray  # position of the store in the batch, ascending
+    timestamp: np.ndarray  # epoch microseconds, ascending within a store
+    active: np.ndarray  # status bitmap, True for ActivityStatus.ACTIVE
+
+
+class RollupArrays(NamedTuple):
+    store_index: np.ndarray  # position of the store in the batch
+    hour_start: np.ndarray  # epoch microseconds of the UTC hour bucket
+    uptime: np.ndarray  # minutes, float
+    downtime: np.ndarray  # minutes, float
+    expected: np.ndarray  # minutes, float
+    last_status: np.ndarray  # ACTIVE, INACTIVE or NO_STATUS when closed or not polled yet at the end of the hour
+
+
+def to_epoch_us(value: datetime) -> int:
+    #naive datetimes are treated as UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def open_intervals_to_arrays(intervals_by_store: Sequence[Tuple[np.ndarray, np.ndarray]]) -> OpenIntervalArrays:
+    #(starts, ends) per store, as handed out by the schedule index
+    counts = [len(starts) for starts, _ in intervals_by_store]
+    if not sum(counts):
+        empty = np.zeros(0, dtype=np.int64)
+        return OpenIntervalArrays(empty, empty, empty)
+    return OpenIntervalArrays(
+        np.repeat(np.arange(len(intervals_by_store), dtype=np.int64), counts),
+        np.concatenate([starts for starts, _ in intervals_by_store]).astype(np.int64),
+        np.concatenate([ends for _, ends in intervals_by_store]).astype(np.int64),
+    )
+
+
+def statuses_to_arrays(statuses_by_store: Sequence[Iterable]) -> StatusArrays:
+    store_index, timestamp, active = [], [], []
+    for index, statuses in enumerate(statuses_by_store):
+        for sr in statuses:
+            store_index.append(index)
+            timestamp.append(to_epoch_us(sr.timestamp))
+            active.append(sr.status == ActivityStatus.ACTIVE)
+    return StatusArrays(
+        np.asarray(store_index, dtype=np.int64),
+        np.asarray(timestamp, dtype=np.int64),
+        np.asarray(active, dtype=bool),
+    )
+
+
+def from_epoch_us(value: int) -> datetime:
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def floor_hour_us(value: int) -> int:
+    return (value // MICROSECONDS_PER_HOUR) * MICROSECONDS_PER_HOUR
+
+
+def rollups_to_arrays(rollups_by_store: Sequence[Iterable]) -> RollupArrays:
+    store_index, hour_start, uptime, downtime, expected, last_status = [], [], [], [], [], []
+    for index, rollups in enumerate(rollups_by_store):
+        for row in rollups:
+            store_index.append(index)
+            hour_start.append(to_epoch_us(row.hour_start))
+            uptime.append(row.uptime_minutes)
+            downtime.append(row.downtime_minutes)
+            expected.append(row.expected_minutes)
+            last_status.append(NO_STATUS if row.last_status is None else int(row.last_status == ActivityStatus.ACTIVE))
+    return RollupArrays(
+        np.asarray(store_index, dtype=np.int64),
+        np.asarray(hour_start, dtype=np.int64),
+        np.asarray(uptime, dtype=np.float64),
+        np.asarray(downtime, dtype=np.float64),
+        np.asarray(expected, dtype=np.float64),
+        np.asarray(last_status, dtype=np.int8),
+    )
+
+
+def first_polls_to_arrays(rows_by_store: Sequence[Iterable], n_windows: int) -> np.ndarray:
+    #(n_windows, n_stores) epoch microseconds of the first poll at or after each window start, NO_POLL when there is none
+    first_polls = np.full((n_windows, len(rows_by_store)), NO_POLL, dtype=np.int64)
+    for index, rows in enumerate(rows_by_store):
+        for row in rows:
+            for window in range(n_windows):
+                value = getattr(row, f"first_{window}")
+                if value is not None:
+                    first_polls[window, index] = to_epoch_us(value)
+    return first_polls
+
+
+def _segment_sum(values: np.ndarray, segment: np.ndarray, n_segments: int) -> np.ndarray:
+    totals = np.zeros(n_segments, dtype=np.int64)
+    np.add.at(totals, segment, values)
+    return totals
+
+
+def overlapping_intervals(intervals: OpenIntervalArrays, start_us: int, end_us: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    #open intervals overlapping [start_us, end_us), not cut to the range
+    overlaps = (intervals.end > start_us) & (intervals.start < end_us)
+    return intervals.store_index[overlaps], intervals.start[overlaps], intervals.end[overlaps]
+
+
+def calculate_windows(intervals: OpenIntervalArrays, statuses: StatusArrays, n_stores: int, windows: Sequence[Tuple[str, datetime, datetime]]) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Uptime, downtime and expected uptime in whole minutes for every store of the batch and every window.
+
+    All windows are answered from one pass over the status arrays: the periods of every window are
+    looked up together, so another window only adds its periods and one more accumulator.
+    A period is an open interval cut to the window, a status counts towards it when it lies inside
+    [start, end] of the period.
+    """
+    n_windows = len(windows)
+    bounds = [(to_epoch_us(start), to_epoch_us(end)) for _, start, end in windows]
+    period_segment, period_store, period_start, period_end = [], [], [], []
+    for index, (start_us, end_us) in enumerate(bounds):
+        store, start, end = overlapping_intervals(intervals, start_us, end_us)
+        period_segment.append(index * n_stores + store)
+        period_store.append(store)
+        period_start.append(np.maximum(start, start_us))
+        period_end.append(np.minimum(end, end_us))
+    period_segment, period_store, period_start, period_end = (
+        np.concatenate(column) for column in (period_segment, period_store, period_start, period_end))
+    period_duration = period_end - period_start
+
+    #composite (store, timestamp) keys keep every store's statuses in its own sorted segment
+    base_us = min(start_us for start_us, _ in bounds)
+    last_us = max(end_us for _, end_us in bounds)
+    span_us = (last_us - base_us) + 1
+    in_range = (statuses.timestamp >= base_us) & (statuses.timestamp <= last_us)
+    timestamp = statuses.timestamp[in_range]
+    active = statuses.active[in_range]
+    keys = statuses.store_index[in_range] * span_us + (timestamp - base_us)
+
+    lo = np.searchsorted(keys, period_store * span_us + (period_start - base_us), side='left')
+    hi = np.searchsorted(keys, period_store * span_us + (period_end - base_us), side='right')
+    has_status = hi > lo
+
+    #uptime between consecutive polls is credited to the earlier poll's status
+    gap = np.diff(timestamp)
+    active_gap = np.r_[0, np.cumsum(np.where(active[:-1], gap, 0))] if len(timestamp) else np.zeros(0, dtype=np.int64)
+
+    first, last = lo[has_status], hi[has_status] - 1
+    last_active = active[last]
+    lead = timestamp[first] - period_start[has_status]
+    tail = period_end[has_status] - timestamp[last]
+    inner_total = timestamp[last] - timestamp[first]
+    inner_up = active_gap[last] - active_gap[first]
+
+    period_up = np.zeros(len(period_segment), dtype=np.int64)
+    #a period without any poll is down for its whole duration
+    period_down = np.where(has_status, 0, period_duration)
+    #before the first poll the store is assumed inactive
+    period_up[has_status] = inner_up + np.where(last_active, tail, 0)
+    period_down[has_status] = lead + (inner_total - inner_up) + np.where(last_active, 0, tail)
+
+    n_segments = n_windows * n_stores
+    uptime = _segment_sum(period_up, period_segment, n_segments).reshape(n_windows, n_stores)
+    downtime = _segment_sum(period_down, period_segment, n_segments).reshape(n_windows, n_stores)
+    expected = _segment_sum(period_duration, period_segment, n_segments).reshape(n_windows, n_stores)
+    return {
+        name: (uptime[index] // MICROSECONDS_PER_MINUTE, downtime[index] // MICROSECONDS_PER_MINUTE, expected[index] // MICROSECONDS_PER_MINUTE)
+        for index, (name, _, _) in enumerate(windows)
+    }
+
+
+def calculate_uptime_downtime(intervals: OpenIntervalArrays, statuses: StatusArrays, n_stores: int, start_date: datetime, end_date: datetime) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Uptime, downtime and expected uptime in whole minutes for every store of the batch."""
+    return calculate_windows(intervals, statuses, n_stores, [("window", start_date, end_date)])["window"]
+
+
+def carry_in_from_rollups(rollups: RollupArrays, n_stores: int, hour_us: int) -> np.ndarray:
+    """Status every store was left in at hour_us, taken from the rollup of the hour before."""
+    carry_in = np.full(n_stores, NO_STATUS, dtype=np.int8)
+    previous = rollups.hour_start == hour_us - MICROSECONDS_PER_HOUR
+    carry_in[rollups.store_index[previous]] = rollups.last_status[previous]
+    return carry_in
+
+
+def calculate_rollup(intervals: OpenIntervalArrays, statuses: StatusArrays, n_stores: int, carry_start_us: int, start_us: int, end_us: int, carry_in: np.ndarray) -> RollupArrays:
+    """Per (store, UTC hour) uptime, downtime and expected minutes over [start_us, end_us).
+
+    Inside an open period a store has the status of its latest poll. Before the first poll of a period it
+    is inactive, except for periods already open at carry_start_us: those continue with carry_in, the
+    status the store was left in at that instant. Only polls in [carry_start_us, end_us] are used, so
+    carry_start_us should be an hour boundary whose previous hour has a rollup. Hours without any open
+    time produce no row.
+    """
+    period_store, period_start, period_end = overlapping_intervals(intervals, start_us, end_us)
+    piece_from = np.maximum(period_start, start_us)
+    piece_to = np.minimum(period_end, end_us)
+
+    #cut every period at the hour boundaries
+    first_hour = floor_hour_us(piece_from)
+    n_pieces = (floor_hour_us(piece_to - 1) - first_hour) // MICROSECONDS_PER_HOUR + 1
+    period = np.repeat(np.arange(len(period_store)), n_pieces)
+    offset = np.arange(len(period)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+    hour = first_hour[period] + offset * MICROSECONDS_PER_HOUR
+    piece_store = period_store[period]
+    piece_start = np.maximum(piece_from[period], hour)
+    piece_end = np.minimum(piece_to[period], hour + MICROSECONDS_PER_HOUR)
+    opened = period_start[period]
+
+    span_us = (end_us - carry_start_us) + 1
+    in_range = (statuses.timestamp >= carry_start_us) & (statuses.timestamp <= end_us)
+    timestamp = statuses.timestamp[in_range]
+    active = statuses.active[in_range]
+    keys = statuses.store_index[in_range] * span_us + (timestamp - carry_start_us)
+    piece_base = piece_store * span_us - carry_start_us
+
+    #status at the start of each piece: the latest poll of the period so far, else what was carried in
+    initial = np.full(len(piece_store), NO_STATUS, dtype=np.int8)
+    if len(keys):
+        latest = np.searchsorted(keys, piece_base + piece_start, side='right') - 1
+        found = (latest >= 0) & (keys[np.maximum(latest, 0)] >= piece_base + np.maximum(opened, carry_start_us))
+        initial[found] = active[latest[found]]
+    carried = (initial == NO_STATUS) & (opened < carry_start_us)
+    initial[carried] = carry_in[piece_store[carried]]
+    initial_active = initial == ACTIVE
+
+    #polls strictly inside the piece switch the status from there on
+    lo = np.searchsorted(keys, piece_base + piece_start, side='right')
+    hi = np.searchsorted(keys, piece_base + piece_end, side='left')
+    has_status = hi > lo
+    gap = np.diff(timestamp)
+    active_gap = np.r_[0, np.cumsum(np.where(active[:-1], gap, 0))] if len(timestamp) else np.zeros(0, dtype=np.int64)
+
+    duration = piece_end - piece_start
+    piece_up = np.where(initial_active, duration, 0)
+    first, last = lo[has_status], hi[has_status] - 1
+    lead = timestamp[first] - piece_start[has_status]
+    tail = piece_end[has_status] - timestamp[last]
+    piece_up[has_status] = (
+        np.where(initial_active[has_status], lead, 0)
+        + active_gap[last] - active_gap[first]
+        + np.where(active[last], tail, 0)
+    )
+
+    #the status handed to the next hour, only for periods still open after this one
+    end_status = initial.copy()
+    end_status[has_status] = active[last]
+    continues = (piece_end == hour + MICROSECONDS_PER_HOUR) & (period_end[period] > piece_end)
+    end_status = np.where(continues, end_status, NO_STATUS).astype(np.int8)
+
+    segment_keys = piece_store * (span_us // MICROSECONDS_PER_HOUR + 2) + (hour - floor_hour_us(start_us)) // MICROSECONDS_PER_HOUR
+    segments, segment = np.unique(segment_keys, return_inverse=True)
+    n_segments = len(segments)
+    row_store = np.zeros(n_segments, dtype=np.int64)
+    row_hour = np.zeros(n_segments, dtype=np.int64)
+    row_store[segment] = piece_store
+    row_hour[segment] = hour
+    uptime = _segment_sum(piece_up, segment, n_segments)
+    expected = _segment_sum(duration, segment, n_segments)
+    last_status = np.full(n_segments, NO_STATUS, dtype=np.int8)
+    np.maximum.at(last_status, segment, end_status)
+
+    has_open_time = expected > 0
+    return RollupArrays(
+        row_store[has_open_time],
+        row_hour[has_open_time],
+        uptime[has_open_time] / MICROSECONDS_PER_MINUTE,
+        (expected - uptime)[has_open_time] / MICROSECONDS_PER_MINUTE,
+        expected[has_open_time] / MICROSECONDS_PER_MINUTE,
+        last_status[has_open_time],
+    )
+
+
+def rollup_read_ranges(windows: Sequence[Tuple[str, datetime, datetime]]) -> Tuple[List[Tuple[datetime, datetime]], Tuple[datetime, datetime]]:
+    """The status ranges and the rollup range calculate_windows_from_rollups needs for these windows."""
+    status_ranges = []
+    for _, start, end in windows:
+        start_us, end_us = to_epoch_us(start), to_epoch_us(end)
+        status_ranges.append((from_epoch_us(floor_hour_us(start_us)), from_epoch_us(floor_hour_us(start_us) + MICROSECONDS_PER_HOUR)))
+        status_ranges.append((from_epoch_us(floor_hour_us(end_us)), end))
+    rollup_start = min(floor_hour_us(to_epoch_us(start)) for _, start, _ in windows) - MICROSECONDS_PER_HOUR
+    rollup_end = max(floor_hour_us(to_epoch_us(end)) for _, _, end in windows)
+    return status_ranges, (from_epoch_us(rollup_start), from_epoch_us(rollup_end))
+
+
+def calculate_windows_from_rollups(intervals: OpenIntervalArrays, statuses: StatusArrays, rollups: RollupArrays, first_polls: np.ndarray, n_stores: int, windows: Sequence[Tuple[str, datetime, datetime]]) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Same result as calculate_windows, built from hourly rollups.
+
+    Whole hours inside a window are summed from the rollups. Only the partial hours at either end of a
+    window are computed from polls, so statuses only need to cover the hours the window starts and ends in,
+    and rollups the hours from the one before the earliest window start.
+
+    Like calculate_windows, a window starts from scratch: a store is inactive until its first poll inside
+    the window. Rollups carry the status of earlier polls across the window start, so that carried uptime
+    is taken back up to first_polls[window], the first poll of each store at or after the window start.
+    """
+    results = {}
+    for index, (name, start, end) in enumerate(windows):
+        start_us, end_us = to_epoch_us(start), to_epoch_us(end)
+        whole_from = -(-start_us // MICROSECONDS_PER_HOUR) * MICROSECONDS_PER_HOUR
+        whole_to = max(floor_hour_us(end_us), whole_from)
+        inside = (rollups.hour_start >= whole_from) & (rollups.hour_start < whole_to)
+        #summed in whole microseconds and floored like calculate_windows, summing float minutes can round up to a minute it doesn't reach
+        uptime = _segment_sum(_minutes_to_us(rollups.uptime[inside]), rollups.store_index[inside], n_stores)
+        downtime = _segment_sum(_minutes_to_us(rollups.downtime[inside]), rollups.store_index[inside], n_stores)
+        expected = _segment_sum(_minutes_to_us(rollups.expected[inside]), rollups.store_index[inside], n_stores)
+
+        #nothing is carried into the window, carried_up below takes it back out of the hours after the first
+        partials = [(start_us, start_us, min(whole_from, end_us), np.full(n_stores, NO_STATUS, dtype=np.int8))]
+        if whole_to >= whole_from and end_us > whole_to:
+            partials.append((whole_to, whole_to, end_us, carry_in_from_rollups(rollups, n_stores, whole_to)))
+        for carry_start_us, partial_start_us, partial_end_us, carry_in in partials:
+            if partial_end_us <= partial_start_us:
+                continue
+            partial = calculate_rollup(intervals, statuses, n_stores, carry_start_us, partial_start_us, partial_end_us, carry_in)
+            uptime += _segment_sum(_minutes_to_us(partial.uptime), partial.store_index, n_stores)
+            downtime += _segment_sum(_minutes_to_us(partial.downtime), partial.store_index, n_stores)
+            expected += _segment_sum(_minutes_to_us(partial.expected), partial.store_index, n_stores)
+
+        if whole_from < end_us:
+            carried_up = _carried_uptime(intervals, carry_in_from_rollups(rollups, n_stores, whole_from), first_polls[index], start_us, whole_from, end_us)
+            uptime -= carried_up
+            downtime += carried_up
+
+        results[name] = (uptime // MICROSECONDS_PER_MINUTE, downtime // MICROSECONDS_PER_MINUTE, expected // MICROSECONDS_PER_MINUTE)
+    return results
+
+
+def _minutes_to_us(minutes: np.ndarray) -> np.ndarray:
+    #rollup minutes are whole microseconds divided by MICROSECONDS_PER_MINUTE
+    return np.rint(minutes * MICROSECONDS_PER_MINUTE).astype(np.int64)
+
+
+def _carried_uptime(intervals: OpenIntervalArrays, carry_in: np.ndarray, first_polls: np.ndarray, start_us: int, whole_from_us: int, end_us: int) -> np.ndarray:
+    """Microseconds per store the rollups credit from whole_from_us on to an active poll from before start_us.
+
+    That status lasts through the period open at start_us until the store's first poll after start_us,
+    and carry_in (the status at whole_from_us) only still is that status when the first poll comes later.
+    """
+    carried = (intervals.start < start_us) & (intervals.end > whole_from_us)
+    store = intervals.store_index[carried]
+    carried_to = np.minimum(np.minimum(intervals.end[carried], first_polls[store]), end_us)
+    span = np.where(carry_in[store] == ACTIVE, np.maximum(carried_to - whole_from_us, 0), 0)
+    return _segment_sum(span, store, len(carry_in))
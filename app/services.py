@@ -1,12 +1,20 @@
 # import all services from here
+from app.database import engine
+from app.report.artifact_store import get_blob_store
 from app.report.report_item_service import ReportItemService
 from app.report.report_service import ReportService
+from .store.poll_coordinator import PollCoordinator
 from .store.service import StoreService
+from .store_status.ingest import StatusIngestQueue
 from .store_status.service import StoreStatusService
 from .business_hour.service import BusinessHourService
+from .store_status_hourly.service import StoreStatusHourlyService
 
 status_service = StoreStatusService()
 business_hour_service = BusinessHourService()
-store_service = StoreService(status_service, business_hour_service)
+store_status_hourly_service = StoreStatusHourlyService(business_hour_service, status_service)
+store_service = StoreService(status_service, business_hour_service, store_status_hourly_service)
 report_item_service = ReportItemService()
-report_service = ReportService(store_service, status_service, business_hour_service, report_item_service)
+report_service = ReportService(store_service, status_service, business_hour_service, report_item_service, store_status_hourly_service, get_blob_store())
+poll_coordinator = PollCoordinator()
+status_ingest_queue = StatusIngestQueue(status_service, store_service, store_status_hourly_service, engine)
@@ -11,6 +11,7 @@ class Store(BaseAudit):
     status_reports = relationship('StoreStatus', back_populates='store')
     business_hours = relationship('BusinessHour', back_populates='store')
     report_items = relationship('ReportItem', back_populates='store')
+    hourly_statuses = relationship('StoreStatusHourly', back_populates='store')
 
     __table_args__ = (
         Index('ix_stores_id', 'id'),
@@ -0,0 +1,108 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+import threading
+import uuid
+from redis import Redis
+from redis.exceptions import RedisError
+from app.config import Config
+
+#deletes the lock only while it still holds the caller's token, in one step, so a lock that expired
+#and was taken by the next run is never deleted from under it
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+#pushes the expiry out only while the lock still holds the caller's token
+EXTEND_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class PollCoordinator:
+    """Bookkeeping in redis that keeps poll shards from piling up when a cycle runs long.
+
+    Every dispatched cycle is stamped with its start time. A shard task only polls if its cycle is still
+    the newest one (tasks of an older cycle still waiting in the queue are dropped in favour of the newer
+    cycle), the shard hasn't completed that cycle yet, and no earlier run of the same shard is still going.
+    A finished shard records the cycle as its watermark.
+
+    Shards are keyed by their index in the cycle rather than their store id range, the ranges move
+    whenever stores are added while shard i of one cycle and shard i of the next stay the same lock.
+    The lock lives for lock_ttl seconds and a running shard keeps renewing it inside hold_shard(), so a
+    shard that overruns its interval keeps the next cycle's shard out while one on a dead worker doesn't.
+    """
+
+    def __init__(self, client: Optional[Redis] = None, lock_ttl: float = Config.POLL_LOCK_TTL, namespace: str = "poll"):
+        self.client = client or Redis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB)
+        self.lock_ttl = lock_ttl
+        self.namespace = namespace
+        self._release_lock = self.client.register_script(RELEASE_LOCK)
+        self._extend_lock = self.client.register_script(EXTEND_LOCK)
+
+    def start_cycle(self, cycle_at: datetime) -> None:
+        self.client.set(f"{self.namespace}:latest_cycle", cycle_at.timestamp())
+
+    def begin_shard(self, shard: int, cycle_at: datetime) -> Optional[str]:
+        #a lock token when the shard should poll now, None when it should be skipped
+        latest = self.client.get(f"{self.namespace}:latest_cycle")
+        if latest is not None and float(latest) > cycle_at.timestamp():
+            print(f"Poll shard {shard} of {cycle_at.isoformat()} skipped, a newer cycle has started")
+            return None
+        watermark = self.client.hget(f"{self.namespace}:watermarks", self._field(shard))
+        if watermark is not None and float(watermark) >= cycle_at.timestamp():
+            print(f"Poll shard {shard} of {cycle_at.isoformat()} skipped, already polled")
+            return None
+        token = uuid.uuid4().hex
+        if not self.client.set(self._lock_key(shard), token, nx=True, px=self._lock_ttl_ms()):
+            print(f"Poll shard {shard} of {cycle_at.isoformat()} skipped, the previous run is still going")
+            return None
+        return token
+
+    @contextmanager
+    def hold_shard(self, shard: int, token: str) -> Iterator[None]:
+        #renews the lock a few times per lock_ttl from a heartbeat thread for as long as the block runs
+        stop = threading.Event()
+
+        def heartbeat() -> None:
+            while not stop.wait(self.lock_ttl / 3):
+                try:
+                    if not self._extend_lock(keys=[self._lock_key(shard)], args=[token, self._lock_ttl_ms()]):
+                        print(f"Poll shard {shard} lost its lock, another run may be polling the same stores")
+                        return
+                except RedisError as e:
+                    print(f"Poll shard {shard} lock renewal failed: {e!r}")
+
+        thread = threading.Thread(target=heartbeat, name=f"poll-shard-{shard}-lock", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def finish_shard(self, shard: int, cycle_at: datetime, token: str) -> None:
+        self.client.hset(f"{self.namespace}:watermarks", self._field(shard), cycle_at.timestamp())
+        self._release_lock(keys=[self._lock_key(shard)], args=[token])
+
+    def abandon_shard(self, shard: int, token: str) -> None:
+        #lets the next cycle poll the shard after a failed run instead of waiting for the lock to expire
+        self._release_lock(keys=[self._lock_key(shard)], args=[token])
+
+    def watermarks(self) -> Dict[int, float]:
+        #shard index -> epoch seconds of the last cycle that shard completed
+        return {int(field): float(value) for field, value in self.client.hgetall(f"{self.namespace}:watermarks").items()}
+
+    def _lock_ttl_ms(self) -> int:
+        return max(int(self.lock_ttl * 1000), 1)
+
+    def _field(self, shard: int) -> str:
+        return str(shard)
+
+    def _lock_key(self, shard: int) -> str:
+        return f"{self.namespace}:lock:{self._field(shard)}"
@@ -1,58 +1,83 @@
-import random
-from app.business_hour.model import DayOfWeek
+from itertools import groupby, islice
+from app.business_hour.model import BusinessHour
+from app.business_hour.schedule_index import schedule_index
 from app.business_hour.service import BusinessHourService
-from app.crud import BaseCRUDService
-from app.store_status.enum import ActivityStatus
-from app.store_status.model import StoreStatus
+from app.crud import BaseCRUDService, id_range
 from app.store_status.service import StoreStatusService
+from app.store_status_hourly.service import StoreStatusHourlyService
 from .model import Store
+from .status_probe import StatusProbe, get_status_probe
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
-from app.database import engine
-from datetime import datetime, time
+from typing import Iterator, List, Optional, Tuple
+from app.config import Config
+from app.database import session_scope
+from app.redis import redis_cache
+from datetime import datetime
 import pytz
 
 class StoreService(BaseCRUDService[Store]):
-    def __init__(self, store_status_service: StoreStatusService, business_hour_service: BusinessHourService):
+    cache_tags = ("stores",)
+
+    def __init__(self, store_status_service: StoreStatusService, business_hour_service: BusinessHourService, store_status_hourly_service: StoreStatusHourlyService, status_probe: Optional[StatusProbe] = None):
         super().__init__(Store)
         self.store_status_service = store_status_service
         self.business_hour_service = business_hour_service
+        self.store_status_hourly_service = store_status_hourly_service
+        self.status_probe = status_probe or get_status_probe()
+
+    @redis_cache(tags=("stores",))
+    def find_ids(self, db: Session, min_store_id: Optional[int] = None, max_store_id: Optional[int] = None) -> List[int]:
+        return list(self.findColumns(db, ('id',), order_by=('id',), id=id_range(min_store_id, max_store_id)).scalars())
+
+    def get_id_shards(self, db: Session, n_shards: int) -> List[Tuple[int, int]]:
+        #contiguous (min_store_id, max_store_id) ranges holding roughly the same number of stores
+        store_ids = self.find_ids(db)
+        if not store_ids:
+            return []
+        shard_size = -(-len(store_ids) // max(n_shards, 1))
+        return [(store_ids[i], store_ids[min(i + shard_size, len(store_ids)) - 1]) for i in range(0, len(store_ids), shard_size)]
+
+    def stream_store_schedules(self, db: Session, min_store_id: Optional[int] = None, max_store_id: Optional[int] = None, yield_per: int = 10000) -> Iterator[Row]:
+        #a row per business hour of each store carrying the store's timezone, ordered by store.
+        #a store without business hours comes back once with empty business hour columns
+        query = self.selectColumns(
+            ('id', 'timezone', BusinessHour.day_of_week, BusinessHour.start_time, BusinessHour.end_time),
+            order_by=('id',), id=id_range(min_store_id, max_store_id),
+        ).outerjoin(BusinessHour, BusinessHour.store_id == Store.id)
+        return db.execute(query, execution_options={"yield_per": yield_per})
+
+    def find_open_store_ids(self, db: Session, at: datetime, min_store_id: Optional[int] = None, max_store_id: Optional[int] = None) -> List[int]:
+        #the weekly schedule is in the store's local time, overnight hours run into the next day.
+        #stores sharing a schedule and timezone share the interval arrays the check runs against
+        open_store_ids = []
+        for store_id, rows in groupby(self.stream_store_schedules(db, min_store_id, max_store_id), key=lambda row: row.id):
+            rows = list(rows)
+            business_hours = [row for row in rows if row.day_of_week is not None]
+            if schedule_index.is_open(business_hours, rows[0].timezone, at):
+                open_store_ids.append(store_id)
+        return open_store_ids
+
+    def log_store_statuses(self, min_store_id: Optional[int] = None, max_store_id: Optional[int] = None, polled_at: Optional[datetime] = None, refresh_rollups: bool = True) -> int:
+        #every poll of a cycle carries the same timestamp, shards of one cycle are handed the cycle's
+        polled_at = polled_at or datetime.now().astimezone(pytz.utc)
+        polls = 0
+        with session_scope() as db:
+            store_ids = self.find_open_store_ids(db, polled_at, min_store_id, max_store_id)
+            #results are written as they come in, a batch at a time, while the remaining stores are probed
+            probes = self.status_probe.probe(store_ids)
+            while batch := list(islice(probes, Config.STATUS_PROBE_WRITE_BATCH)):
+                probed_ids, statuses = zip(*batch)
+                self.store_status_service.bulkInsert(db, {
+                    "store_id": list(probed_ids),
+                    "timestamp": polled_at,
+                    "status": list(statuses),
+                    "created_by": "celery_poller",
+                    "updated_by": "celery_poller",
+                }, batch_size=len(batch))
+                polls += len(batch)
 
-    def _is_time_within_hours(self, current_time: time, start_time: time, end_time: time) -> bool:
-        current_time_utc = current_time.replace(tzinfo=pytz.UTC)
-        start_time_utc = start_time.replace(tzinfo=pytz.UTC)
-        end_time_utc = end_time.replace(tzinfo=pytz.UTC)
-        
-        return start_time_utc <= current_time_utc <= end_time_utc
-
-    def log_store_statuses(self):
-        with Session(engine) as db:
-            batch_size = 1000
-            statuses = []
-            stores = self.findAll(db, limit=20000)
-  
-            for store in stores:
-                current_time = datetime.now().astimezone(pytz.utc)
-                business_hours = self.business_hour_service.findAllBy(db, limit=10000, store_id=store.id, day_of_week=DayOfWeek(current_time.weekday()))
-
-                is_within_business_hours = any(
-                    self._is_time_within_hours(current_time.time(), business_hour.start_time, business_hour.end_time)
-                    for business_hour in business_hours
-                )
-                
-                if is_within_business_hours:
-                    statuses.append(
-                        StoreStatus(
-                            store_id=store.id,
-                            timestamp=current_time,
-                            status=random.choice(
-                                [ActivityStatus.ACTIVE, ActivityStatus.INACTIVE]),
-
-                            created_by="celery_poller",
-                            updated_by="celery_poller",
-                        )
-                    )
-                    if len(statuses) >= batch_size:
-                        self.store_status_service.create(db, statuses)
-                        statuses = []
-            if statuses:
-                self.store_status_service.create(db, statuses)
+        #fold this cycle's polls into the rollup of the running hour, sharded cycles do that once all shards are done
+        if refresh_rollups:
+            self.store_status_hourly_service.refresh(polled_at, polled_at)
+        return polls
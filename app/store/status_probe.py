@@ -0,0 +1,125 @@
+from abc import ABC, abstractmethod
+from queue import Queue
+from typing import AsyncIterator, Iterator, Optional, Sequence, Tuple
+import asyncio
+import contextvars
+import random
+import threading
+import httpx
+from app.config import Config
+from app.store_status.enum import ActivityStatus
+
+Probe = Tuple[int, ActivityStatus]
+
+
+class StatusProbe(ABC):
+    """Finds out whether stores are active right now.
+
+    probe() yields a (store_id, status) pair for every store id it is given, in whatever order the
+    answers come in, so the caller can write results while the rest are still being probed.
+    """
+
+    @abstractmethod
+    def probe(self, store_ids: Sequence[int]) -> Iterator[Probe]:
+        ...
+
+
+class RandomStatusProbe(StatusProbe):
+    #no real check, a coin flip per store
+    def probe(self, store_ids: Sequence[int]) -> Iterator[Probe]:
+        for store_id in store_ids:
+            yield store_id, random.choice([ActivityStatus.ACTIVE, ActivityStatus.INACTIVE])
+
+
+class HttpStatusProbe(StatusProbe):
+    """Probes a health endpoint per store, url_template formatted with store_id.
+
+    A 2xx answer is ACTIVE, anything else, including a timeout or a refused connection, is INACTIVE.
+    At most `concurrency` probes are in flight at once over one pooled client, so connections to the
+    same host are reused across probes. Each probe gets `timeout` seconds. transport replaces the
+    client's network transport, tests pass an httpx.MockTransport.
+    """
+
+    def __init__(self, url_template: str = Config.STATUS_PROBE_URL, concurrency: int = Config.STATUS_PROBE_CONCURRENCY, timeout: float = Config.STATUS_PROBE_TIMEOUT,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.url_template = url_template
+        self.concurrency = max(concurrency, 1)
+        self.timeout = timeout
+        self.transport = transport
+
+    def probe(self, store_ids: Sequence[int]) -> Iterator[Probe]:
+        #the event loop runs on its own thread and hands every result over as soon as it's in
+        results: Queue = Queue()
+        stop = threading.Event()
+        error: list = []
+
+        def run() -> None:
+            try:
+                asyncio.run(self._forward(store_ids, results, stop))
+            except BaseException as e:
+                error.append(e)
+            finally:
+                results.put(None)
+
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(run,), name="status-probe", daemon=True)
+        thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is None:
+                    break
+                yield result
+        finally:
+            #a caller that stops early stops the probing too, probes already in flight still run out
+            stop.set()
+            thread.join()
+        if error:
+            raise error[0]
+
+    async def probe_async(self, store_ids: Sequence[int], stop: Optional[threading.Event] = None) -> AsyncIterator[Probe]:
+        pending = iter(store_ids)
+        done: asyncio.Queue = asyncio.Queue()
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(self.timeout), transport=self.transport) as client:
+
+            async def worker() -> None:
+                #a fixed pool of workers rather than a task per store keeps 20k store ids cheap
+                for store_id in pending:
+                    if stop is not None and stop.is_set():
+                        return
+                    await done.put((store_id, await self._probe_one(client, store_id)))
+
+            async def run_workers() -> None:
+                try:
+                    await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(store_ids)))))
+                finally:
+                    await done.put(None)
+
+            workers = asyncio.create_task(run_workers())
+            try:
+                while (result := await done.get()) is not None:
+                    yield result
+                #raises what failed a worker
+                await workers
+            finally:
+                workers.cancel()
+                await asyncio.gather(workers, return_exceptions=True)
+
+    async def _probe_one(self, client: httpx.AsyncClient, store_id: int) -> ActivityStatus:
+        try:
+            response = await client.get(self.url_template.format(store_id=store_id))
+        except httpx.HTTPError:
+            return ActivityStatus.INACTIVE
+        return ActivityStatus.ACTIVE if response.is_success else ActivityStatus.INACTIVE
+
+    async def _forward(self, store_ids: Sequence[int], results: Queue, stop: threading.Event) -> None:
+        async for result in self.probe_async(store_ids, stop):
+            results.put(result)
+
+
+def get_status_probe(kind: str = Config.STATUS_PROBE) -> StatusProbe:
+    if kind == 'random':
+        return RandomStatusProbe()
+    if kind == 'http':
+        return HttpStatusProbe()
+    raise ValueError(f"Unknown status probe: {kind}")
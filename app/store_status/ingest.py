@@ -0,0 +1,212 @@
+from datetime import datetime
+from fastapi import HTTPException, Request
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional, Tuple
+import contextvars
+import csv
+import io
+import json
+import threading
+import time
+import pytz
+from app.config import Config
+from .enum import ActivityStatus
+from .service import StoreStatusService
+
+#(store_id, timestamp, status)
+Ping = Tuple[int, datetime, ActivityStatus]
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonlines")
+CSV_TYPES = ("text/csv", "application/csv")
+#how long a writer that failed to write waits before trying the same pings again, in seconds
+WRITE_RETRY_AFTER = 1
+
+
+def parse_timestamp(value: str) -> datetime:
+    #ISO 8601, or the "2023-01-22 12:09:39.388884 UTC" of the store status csv. no offset means UTC
+    value = value.strip()
+    if value.endswith(" UTC"):
+        value = value[:-4]
+    timestamp = datetime.fromisoformat(value)
+    return pytz.utc.localize(timestamp) if timestamp.tzinfo is None else timestamp.astimezone(pytz.utc)
+
+
+def parse_pings(body: bytes, content_type: str) -> List[Ping]:
+    """Pings of an NDJSON or CSV body, each a store_id, timestamp_utc and status like the store status csv.
+
+    Raises a 415 for any other content type and a 400 naming the first bad ping.
+    """
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type not in NDJSON_TYPES + CSV_TYPES:
+        raise HTTPException(status_code=415, detail=f"Send pings as one of {', '.join(NDJSON_TYPES + CSV_TYPES)}")
+    try:
+        text = body.decode()
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Pings must be UTF-8")
+    if media_type in NDJSON_TYPES:
+        records, decode = [line for line in text.splitlines() if line.strip()], json.loads
+    else:
+        records, decode = csv.DictReader(io.StringIO(text)), dict
+
+    pings = []
+    for number, record in enumerate(records, start=1):
+        try:
+            record = decode(record)
+            pings.append((int(record["store_id"]), parse_timestamp(record["timestamp_utc"]), ActivityStatus(record["status"].strip().lower())))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise HTTPException(status_code=400, detail=f"Bad ping {number}: {e!r}")
+    return pings
+
+
+async def read_body(request: Request, max_bytes: int = Config.INGEST_MAX_BYTES) -> bytes:
+    #a 413 before anything is parsed, from the Content-Length when there is one and otherwise as soon
+    #as more than max_bytes have come in
+    too_large = HTTPException(status_code=413, detail=f"At most {max_bytes} bytes per request")
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise too_large
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+class StatusIngestQueue:
+    """Group commit for store status pings pushed over HTTP.
+
+    Accepted pings wait in memory until a writer thread inserts them with one bulkInsert, as soon as
+    flush_rows pings are waiting or the oldest has waited flush_ms. Pings of stores that don't exist are
+    dropped when written. Once max_pending pings are waiting new batches are turned away with a 429, and
+    while writes are failing with a 503, so senders back off instead of piling up pings in memory. Pings
+    are accepted before they are written, ones still waiting are lost if the process dies. After every
+    write the hourly rollups from the hour of the oldest written ping on are refreshed by the same thread,
+    so pings arriving meanwhile simply go out with the next, bigger write.
+    """
+
+    def __init__(self, status_service: StoreStatusService, store_service, rollup_service, bind: Engine,
+                 flush_rows: int = Config.INGEST_FLUSH_ROWS, flush_ms: int = Config.INGEST_FLUSH_MS,
+                 max_pending: int = Config.INGEST_MAX_PENDING, max_batch: int = Config.INGEST_MAX_BATCH):
+        self.status_service = status_service
+        self.store_service = store_service
+        self.rollup_service = rollup_service
+        self.bind = bind
+        self.flush_rows = max(flush_rows, 1)
+        self.flush_ms = flush_ms
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self._pending: List[Ping] = []
+        self._oldest_at: Optional[float] = None
+        self._failing = False
+        self._closing = False
+        self._ready = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        with self._ready:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._closing = False
+            self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run,), name="status-ingest", daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        #writes out everything accepted so far, a writer that can't write gives up on what's left
+        with self._ready:
+            self._closing = True
+            self._ready.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    async def ingest(self, body: bytes, content_type: str) -> int:
+        #parsing a big batch would hold up the event loop
+        pings = await run_in_threadpool(parse_pings, body, content_type)
+        self.submit(pings)
+        return len(pings)
+
+    def submit(self, pings: List[Ping]) -> None:
+        if len(pings) > self.max_batch:
+            raise HTTPException(status_code=413, detail=f"At most {self.max_batch} pings per request")
+        with self._ready:
+            if self._closing or self._thread is None or not self._thread.is_alive():
+                raise HTTPException(status_code=503, detail="Status ingestion is not running", headers={"Retry-After": str(WRITE_RETRY_AFTER)})
+            if self._failing:
+                raise HTTPException(status_code=503, detail="Status writes are failing, retry later", headers={"Retry-After": str(WRITE_RETRY_AFTER)})
+            if len(self._pending) + len(pings) > self.max_pending:
+                raise HTTPException(status_code=429, detail="Too many pings waiting to be written, retry later", headers={"Retry-After": str(max(1, -(-self.flush_ms // 1000)))})
+            if not pings:
+                return
+            if not self._pending:
+                self._oldest_at = time.monotonic()
+            self._pending.extend(pings)
+            self._ready.notify()
+
+    def pending(self) -> int:
+        with self._ready:
+            return len(self._pending)
+
+    def _run(self) -> None:
+        while True:
+            with self._ready:
+                while not self._pending and not self._closing:
+                    self._ready.wait()
+                if not self._pending:
+                    return
+                #wait for a full batch until the oldest ping is due
+                deadline = self._oldest_at + self.flush_ms / 1000
+                while len(self._pending) < self.flush_rows and not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+                batch = self._pending[:self.flush_rows]
+                del self._pending[:self.flush_rows]
+
+            try:
+                written = self._flush(batch)
+                self._failing = False
+            except Exception as e:
+                print(f"Writing {len(batch)} store status pings failed: {e}")
+                with self._ready:
+                    if self._closing:
+                        print(f"Dropping {len(batch) + len(self._pending)} store status pings on shutdown")
+                        self._pending.clear()
+                        return
+                    #back in front of the queue to be tried again, new pings are refused meanwhile
+                    self._pending[:0] = batch
+                    self._failing = True
+                time.sleep(WRITE_RETRY_AFTER)
+                continue
+
+            if written:
+                self._refresh_rollups(written)
+
+    def _refresh_rollups(self, timestamps: Tuple[datetime, ...]) -> None:
+        #the pings are written already, a failed refresh is left to the hourly catch up instead of retrying them
+        try:
+            self.rollup_service.refresh_late(min(timestamps), max(timestamps))
+        except Exception as e:
+            print(f"Refreshing the rollups of {len(timestamps)} store status pings failed: {e}")
+
+    def _flush(self, batch: List[Ping]) -> Tuple[datetime, ...]:
+        #timestamps of the pings written
+        with Session(self.bind) as db:
+            known = set(self.store_service.find_ids(db))
+            pings = [ping for ping in batch if ping[0] in known]
+            if len(pings) < len(batch):
+                print(f"Dropped {len(batch) - len(pings)} store status pings of unknown stores")
+            if not pings:
+                return ()
+            store_ids, timestamps, statuses = zip(*pings)
+            self.status_service.bulkInsert(db, {
+                "store_id": list(store_ids),
+                "timestamp": list(timestamps),
+                "status": list(statuses),
+                "created_by": "ingest_api",
+                "updated_by": "ingest_api",
+            }, batch_size=len(pings))
+            return timestamps
@@ -1,7 +1,34 @@
-from app.crud import BaseCRUDService
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.engine import Row
+from app.crud import BaseCRUDService, id_range
+from app.store.model import Store
 from .model import StoreStatus
 from sqlalchemy.orm import Session
 
 class StoreStatusService(BaseCRUDService[StoreStatus]):
     def __init__(self):
         super().__init__(StoreStatus)
+
+    def stream_status_rows(self, db: Session, ranges: List[Tuple[datetime, datetime]], min_store_id: Optional[int] = None, max_store_id: Optional[int] = None, yield_per: int = 10000) -> Iterator[Row]:
+        #ordered by (store_id, timestamp) so postgres can walk ix_store_status_store_id_timestamp
+        query = self.selectColumns(
+            ('store_id', 'timestamp', 'status'), order_by=('store_id', 'timestamp'), store_id=id_range(min_store_id, max_store_id),
+        ).where(or_(*(and_(StoreStatus.timestamp >= start, StoreStatus.timestamp <= end) for start, end in ranges)))
+        return db.execute(query, execution_options={"yield_per": yield_per})
+
+
+    def stream_first_status_times(self, db: Session, starts: List[datetime], min_store_id: Optional[int] = None, max_store_id: Optional[int] = None, yield_per: int = 10000) -> Iterator[Row]:
+        #per store the timestamp of its first poll at or after each of starts (first_0, first_1, ...), None when there is none.
+        #min() per store is answered with one seek into ix_store_status_store_id_timestamp, so no range of polls is read
+        firsts = [
+            select(func.min(StoreStatus.timestamp)).where(StoreStatus.store_id == Store.id, StoreStatus.timestamp >= start).scalar_subquery().label(f"first_{index}")
+            for index, start in enumerate(starts)
+        ]
+        query = select(Store.id.label('store_id'), *firsts).order_by(Store.id)
+        if min_store_id is not None:
+            query = query.where(Store.id >= min_store_id)
+        if max_store_id is not None:
+            query = query.where(Store.id <= max_store_id)
+        return db.execute(query, execution_options={"yield_per": yield_per})
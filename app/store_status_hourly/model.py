@@ -0,0 +1,22 @@
+from sqlalchemy import Column, DateTime, Enum, Float, ForeignKey, Index, BigInteger
+from sqlalchemy.orm import relationship
+from app.store_status.enum import ActivityStatus
+from ..base import BaseAudit
+
+# per store, per UTC hour aggregate of store_status, all times are in minutes
+class StoreStatusHourly(BaseAudit):
+    __tablename__ = 'store_status_hourly'
+
+    store_id = Column(BigInteger, ForeignKey('stores.id'), nullable=False)
+    hour_start = Column(DateTime(timezone=True), nullable=False)
+    uptime_minutes = Column(Float, nullable=False, default=0)
+    downtime_minutes = Column(Float, nullable=False, default=0)
+    expected_minutes = Column(Float, nullable=False, default=0)
+    #status the store was left in at the end of the hour, null when closed or not polled yet in the open period
+    last_status = Column(Enum(ActivityStatus), nullable=True)
+
+    store = relationship('Store', back_populates='hourly_statuses')
+
+    __table_args__ = (
+        Index('ix_store_status_hourly_store_id_hour_start', 'store_id', 'hour_start', unique=True),
+    )
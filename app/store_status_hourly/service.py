@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+from app.business_hour.service import BusinessHourService
+from app.crud import BaseCRUDService, id_range
+from app.database import engine, session_scope
+from app.report import uptime_engine
+from app.report.report_loader import ReportDataLoader
+from app.store.model import Store
+from app.store_status.enum import ActivityStatus
+from app.store_status.service import StoreStatusService
+from .model import StoreStatusHourly
+
+class StoreStatusHourlyService(BaseCRUDService[StoreStatusHourly]):
+    def __init__(self, business_hour_service: BusinessHourService, status_service: StoreStatusService):
+        super().__init__(StoreStatusHourly)
+        self.loader = ReportDataLoader(business_hour_service, status_service, self)
+
+    def stream_rollup_rows(self, db: Session, start: datetime, end: datetime, min_store_id: Optional[int] = None, max_store_id: Optional[int] = None, yield_per: int = 10000) -> Iterator[Row]:
+        #rollups of the hours in [start, end), ordered by store
+        return self.findColumns(
+            db, ('store_id', 'hour_start', 'uptime_minutes', 'downtime_minutes', 'expected_minutes', 'last_status'),
+            order_by=('store_id', 'hour_start'), yield_per=yield_per,
+            hour_start={'$gte': start, '$lt': end}, store_id=id_range(min_store_id, max_store_id),
+        )
+
+    def get_watermark(self, db: Session) -> Optional[datetime]:
+        return db.scalar(select(func.max(StoreStatusHourly.hour_start)))
+
+    def refresh(self, start: datetime, end: datetime, batch_size: int = 1000) -> None:
+        """Recomputes the rollups of every hour from the one holding start through the one holding end, for every store.
+
+        Each hour continues from the rollup of the hour before it, so hours are refreshed oldest first,
+        a day at a time.
+        """
+        start_us = uptime_engine.floor_hour_us(uptime_engine.to_epoch_us(start))
+        #a status right on an hour boundary belongs to the hour it starts
+        end_us = uptime_engine.floor_hour_us(uptime_engine.to_epoch_us(end)) + uptime_engine.MICROSECONDS_PER_HOUR
+        end_us = max(end_us, start_us + uptime_engine.MICROSECONDS_PER_HOUR)
+        for chunk_start_us in range(start_us, end_us, uptime_engine.MICROSECONDS_PER_DAY):
+            self._refresh_hours(chunk_start_us, min(chunk_start_us + uptime_engine.MICROSECONDS_PER_DAY, end_us), batch_size)
+
+    def refresh_late(self, start: datetime, end: datetime) -> None:
+        """Refreshes after statuses between start and end were written, which may be older than the latest rollup.
+
+        Every hour carries its last status into the next one, so a late status can change every rollup
+        after it. The refresh runs on through the hour of the latest rollup, catch_up only moves forward.
+        """
+        with session_scope() as db:
+            watermark = self.get_watermark(db)
+        if watermark is not None and uptime_engine.to_epoch_us(watermark) > uptime_engine.to_epoch_us(end):
+            end = watermark
+        self.refresh(start, end)
+
+    def catch_up(self, now: Optional[datetime] = None, horizon: timedelta = timedelta(weeks=1)) -> None:
+        #picks up from the latest rollup (which may have been written while its hour was still running) up to the current hour
+        now = now or datetime.now().astimezone()
+        with session_scope() as db:
+            watermark = self.get_watermark(db)
+        start = now - horizon
+        if watermark is not None and uptime_engine.to_epoch_us(watermark) > uptime_engine.to_epoch_us(start):
+            start = watermark
+        self.refresh(start, now)
+
+    def _refresh_hours(self, start_us: int, end_us: int, batch_size: int) -> None:
+        start, end = uptime_engine.from_epoch_us(start_us), uptime_engine.from_epoch_us(end_us)
+        previous_hour = uptime_engine.from_epoch_us(start_us - uptime_engine.MICROSECONDS_PER_HOUR)
+        with session_scope() as db, Session(engine) as read_db:
+            store_ids = list(db.scalars(select(Store.id).order_by(Store.id)))
+            batches = self.loader.iter_batches(read_db, store_ids, [(start, end)], rollup_range=(previous_hour, start), batch_size=batch_size)
+            for batch in batches:
+                n_stores = len(batch.store_ids)
+                carry_in = uptime_engine.carry_in_from_rollups(batch.rollups, n_stores, start_us)
+                rollups = uptime_engine.calculate_rollup(batch.open_intervals, batch.statuses, n_stores, start_us, start_us, end_us, carry_in)
+
+                #hours that no longer have any open time go, the rest is upserted: a refresh running at the same
+                #time (the poll chord's and the hourly catch up) can insert the same hours after this delete
+                db.query(StoreStatusHourly).filter(
+                    StoreStatusHourly.store_id >= batch.store_ids[0],
+                    StoreStatusHourly.store_id <= batch.store_ids[-1],
+                    StoreStatusHourly.hour_start >= start,
+                    StoreStatusHourly.hour_start < end,
+                ).delete(synchronize_session=False)
+                last_status = {uptime_engine.NO_STATUS: None, uptime_engine.INACTIVE: ActivityStatus.INACTIVE, uptime_engine.ACTIVE: ActivityStatus.ACTIVE}
+                self.bulkUpsert(db, {
+                    "store_id": np.asarray(batch.store_ids, dtype=np.int64)[rollups.store_index],
+                    "hour_start": [uptime_engine.from_epoch_us(hour_start) for hour_start in rollups.hour_start],
+                    "uptime_minutes": rollups.uptime,
+                    "downtime_minutes": rollups.downtime,
+                    "expected_minutes": rollups.expected,
+                    "last_status": [last_status[code] for code in rollups.last_status.tolist()],
+                    "created_by": "rollup",
+                    "updated_by": "rollup",
+                }, conflict_keys=("store_id", "hour_start"), batch_size=10000)
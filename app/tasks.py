@@ -1,31 +1,111 @@
 
-from celery import Celery
+from celery import Celery, Task, chord, group
+from celery.signals import worker_process_init
+from app import instrumentation
+from app.database import reset_after_fork, session_scope
 from app.services import *
-from datetime import timedelta
+from datetime import datetime, timedelta
+import pytz
 from app.config import Config
 
+class UnitOfWorkTask(Task):
+    def __call__(self, *args, **kwargs):
+        #every task run is one unit of work: one session shared by the services it calls, and its own query stats
+        with instrumentation.query_stats(f"task {self.name}"), session_scope():
+            return super().__call__(*args, **kwargs)
+
 celery = Celery(
     "worker",
+    task_cls=UnitOfWorkTask,
     broker=f"redis://{Config.REDIS_HOST}:{Config.REDIS_PORT}/{Config.REDIS_DB}",
     backend=f"redis://{Config.REDIS_HOST}:{Config.REDIS_PORT}/{Config.REDIS_DB}",
     broker_connection_retry_on_startup=True
 )
 
+@worker_process_init.connect
+def reset_pools(**kwargs):
+    #prefork children must not reuse the connections the parent opened before forking
+    reset_after_fork()
+
 @celery.task(name='tasks.poll_store_status')
 def poll_store_status():
-    store_service.log_store_statuses()
+    #fans the cycle out over store id ranges, the rollups are refreshed once every shard is done
+    cycle_at = datetime.now().astimezone(pytz.utc)
+    with session_scope() as db:
+        shards = store_service.get_id_shards(db, Config.POLL_SHARDS)
+    poll_coordinator.start_cycle(cycle_at)
+    #a shard still queued when the next cycle is dispatched skips itself in begin_shard rather than run late.
+    #an expired task would be revoked and fail the chord, leaving the cycle's rollups to the hourly catch up
+    shard_tasks = group(
+        poll_store_shard.si(shard, min_store_id, max_store_id, cycle_at.isoformat())
+        for shard, (min_store_id, max_store_id) in enumerate(shards)
+    )
+    chord(shard_tasks)(refresh_polled_rollups.si(cycle_at.isoformat()))
+
+@celery.task(name='tasks.poll_store_shard')
+def poll_store_shard(shard, min_store_id, max_store_id, cycle_at):
+    #shard is the index of the range in its cycle, the overrun lock and watermark are kept per index
+    cycle_at = datetime.fromisoformat(cycle_at)
+    token = poll_coordinator.begin_shard(shard, cycle_at)
+    if token is None:
+        return 0
+    try:
+        with poll_coordinator.hold_shard(shard, token):
+            polls = store_service.log_store_statuses(min_store_id, max_store_id, polled_at=cycle_at, refresh_rollups=False)
+    except Exception:
+        poll_coordinator.abandon_shard(shard, token)
+        raise
+    poll_coordinator.finish_shard(shard, cycle_at, token)
+    return polls
+
+@celery.task(name='tasks.refresh_polled_rollups')
+def refresh_polled_rollups(cycle_at):
+    cycle_at = datetime.fromisoformat(cycle_at)
+    store_status_hourly_service.refresh(cycle_at, cycle_at)
+
+@celery.task(name='tasks.rollup_store_status')
+def rollup_store_status():
+    store_status_hourly_service.catch_up()
 
 @celery.task(name='tasks.generate_report')
 def generate_report(report_id):
     try:
-        report_service.generate_report(report_id)
+        if Config.REPORT_SHARDS <= 1:
+            report_service.generate_report(report_id)
+            return
+        shards = report_service.get_report_shards(Config.REPORT_SHARDS)
+        #the report is marked ready by the chord callback once every shard has written its items
+        shard_tasks = [generate_report_shard.si(report_id, min_store_id, max_store_id) for min_store_id, max_store_id in shards]
+        chord(shard_tasks)(finalize_report.si(report_id).on_error(report_failed.si(report_id)))
     except Exception as e:
         report_service.mark_report_as_failed(report_id)
 
-# Schedule the task to run every 60 minutes
+@celery.task(
+    name='tasks.generate_report_shard',
+    autoretry_for=(Exception,),
+    max_retries=Config.REPORT_SHARD_MAX_RETRIES,
+    retry_backoff=True,
+)
+def generate_report_shard(report_id, min_store_id, max_store_id):
+    #a failed shard retries on its own, the report only fails once its retries are used up
+    report_service.generate_report_shard(report_id, min_store_id, max_store_id)
+
+@celery.task(name='tasks.finalize_report')
+def finalize_report(report_id):
+    report_service.mark_report_as_ready(report_id)
+
+@celery.task(name='tasks.report_failed')
+def report_failed(report_id):
+    report_service.mark_report_as_failed(report_id)
+
+# Schedule the task to run every POLL_INTERVAL_MINUTES minutes
 celery.conf.beat_schedule = {
     'poll-store-status': {
         'task': 'tasks.poll_store_status',
+        'schedule': timedelta(minutes=Config.POLL_INTERVAL_MINUTES),
+    },
+    'rollup-store-status': {
+        'task': 'tasks.rollup_store_status',
         'schedule': timedelta(minutes=60),
     },
 }
@@ -0,0 +1,38 @@
+import sys
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+from app.base import Base
+#registers every table on Base.metadata
+import app.models
+
+
+@pytest.fixture
+def engine():
+    #one in-memory sqlite database shared by every connection of the test
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    with Session(engine) as session:
+        yield session
+
+
+@pytest.fixture
+def app_engine(engine, monkeypatch):
+    #the services open their own sessions on app.database.engine, every module holding it gets the test database
+    import app.database
+    import app.redis
+    import app.services
+    #cached lookups would outlive the database of the test that made them
+    monkeypatch.setattr(app.redis.cache, "enabled", False)
+    original = app.database.engine
+    for name, module in list(sys.modules.items()):
+        if name.startswith("app") and getattr(module, "engine", None) is original:
+            monkeypatch.setattr(module, "engine", engine)
+    return engine
@@ -0,0 +1,103 @@
+import asyncio
+import fakeredis
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+import app.redis
+from app.async_crud import AsyncBaseCRUDService
+from app.base import Base
+from app.models import Store
+from app.redis import RedisCache
+
+
+class AsyncStoreService(AsyncBaseCRUDService[Store]):
+    cache_tags = ("stores",)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    server = fakeredis.FakeServer()
+    cache = RedisCache(client=fakeredis.FakeRedis(server=server), async_client=fakeredis.FakeAsyncRedis(server=server), enabled=True, l1_size=100, l1_ttl=60)
+    #the after_commit listener invalidates through the module level cache
+    monkeypatch.setattr(app.redis, "cache", cache)
+    return cache
+
+
+def _run(test):
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as db:
+                return await test(db)
+        finally:
+            await engine.dispose()
+    return asyncio.run(run())
+
+
+def test_queries_match_the_sync_service(cache):
+    service = AsyncBaseCRUDService(Store)
+
+    async def test(db):
+        await service.createMultiple(db, [{"id": store_id, "timezone": "UTC"} for store_id in (1, 2, 3)])
+        await service.create(db, {"id": 4, "timezone": "Asia/Tokyo"})
+
+        assert await service.count(db) == 4
+        assert await service.count(db, timezone="UTC") == 3
+        assert [store.id for store in await service.findAllByAttributes(db, id={"$gte": 2}, timezone={"$in": ["UTC"]})] == [2, 3]
+
+        updated = await service.findAndUpdate(db, {"id": 2}, {"timezone": "Europe/Paris"})
+        assert updated.timezone == "Europe/Paris"
+        assert (await service.findOneById(db, 2)).timezone == "Europe/Paris"
+        assert await service.findAndUpdate(db, {"id": 99}, {"timezone": "UTC"}) is None
+
+    _run(test)
+
+
+def test_writes_invalidate_cache_tags_on_commit(cache):
+    service = AsyncStoreService(Store)
+    calls = 0
+
+    @cache.cached(tags=("stores",))
+    def cached_store_count(store_id):
+        nonlocal calls
+        calls += 1
+        return calls
+
+    async def test(db):
+        cached_store_count(1)
+        await service.create(db, {"id": 1})
+        assert cached_store_count(1) == 2
+
+        await service.findAndUpdate(db, {"id": 1}, {"timezone": "UTC"})
+        assert cached_store_count(1) == 3
+
+        await service.updateMultiple(db, {"id": 1}, {"timezone": "Asia/Tokyo"})
+        #nothing is dropped before the commit
+        assert cached_store_count(1) == 3
+        await db.commit()
+        assert cached_store_count(1) == 4
+
+        await service.updateMultiple(db, {"id": 1}, {"timezone": "UTC"})
+        await db.rollback()
+        assert cached_store_count(1) == 4
+
+    _run(test)
+
+
+def test_services_without_tags_leave_the_cache_alone(cache):
+    service = AsyncBaseCRUDService(Store)
+    calls = 0
+
+    @cache.cached(tags=("stores",))
+    def cached_store_count(store_id):
+        nonlocal calls
+        calls += 1
+        return calls
+
+    async def test(db):
+        cached_store_count(1)
+        await service.create(db, {"id": 1})
+        assert cached_store_count(1) == 1
+
+    _run(test)
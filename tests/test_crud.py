@@ -0,0 +1,178 @@
+from datetime import date, datetime, time, timedelta, timezone
+import struct
+import numpy as np
+import pytest
+from sqlalchemy import event, select
+from app.crud import PGCOPY_HEADER, PGCOPY_TRAILER, BaseCRUDService, _copy_text
+from app.models import Store, StoreStatus, StoreStatusHourly
+from app.store_status.enum import ActivityStatus
+
+HOUR = datetime(2023, 1, 19, 8, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def inserts(engine):
+    #rows per INSERT sent to the database
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT"):
+            statements.append(len(parameters) if executemany else 1)
+
+    event.listen(engine, "before_cursor_execute", count)
+    yield statements
+    event.remove(engine, "before_cursor_execute", count)
+
+
+def _stores(db):
+    return [(store.id, store.timezone, store.created_by) for store in db.scalars(select(Store).order_by(Store.id))]
+
+
+def test_dicts_and_column_arrays_insert_the_same_rows(db):
+    service = BaseCRUDService(Store)
+    service.bulkInsert(db, [{"id": 1, "timezone": "UTC", "created_by": "test"}, {"id": 2, "timezone": "Asia/Tokyo", "created_by": "test"}])
+    service.bulkInsert(db, {"id": np.asarray([3, 4], dtype=np.int64), "timezone": ["UTC", "Asia/Tokyo"], "created_by": "test"})
+
+    assert _stores(db) == [(1, "UTC", "test"), (2, "Asia/Tokyo", "test"), (3, "UTC", "test"), (4, "Asia/Tokyo", "test")]
+    #the audit defaults are filled in, the ORM isn't there to do it
+    assert all(store.created_at is not None and store.updated_at is not None for store in db.scalars(select(Store)))
+
+
+def test_scalar_columns_repeat_for_every_row(db):
+    BaseCRUDService(Store).bulkInsert(db, {"id": range(1, 6), "timezone": "Europe/Paris", "created_by": "test"})
+    assert _stores(db) == [(store_id, "Europe/Paris", "test") for store_id in range(1, 6)]
+
+
+def test_batches_and_return_ids(db, inserts):
+    service = BaseCRUDService(Store)
+    rows = [{"timezone": "UTC"} for _ in range(5)]
+
+    ids = service.bulkInsert(db, rows, batch_size=2, return_ids=True)
+
+    assert inserts == [2, 2, 1]
+    assert len(set(ids)) == 5
+    assert sorted(ids) == [store_id for store_id, _, _ in _stores(db)]
+    #the caller's rows are left as they were
+    assert rows == [{"timezone": "UTC"} for _ in range(5)]
+    assert service.bulkInsert(db, rows) is None
+
+
+def test_commit_false_leaves_the_transaction_open(db):
+    service = BaseCRUDService(Store)
+    service.bulkInsert(db, [{"id": 1}], commit=False)
+    db.rollback()
+    assert _stores(db) == []
+
+
+def _hourly(store_id, uptime, last_status=ActivityStatus.ACTIVE, hour=HOUR):
+    return {"store_id": store_id, "hour_start": hour, "uptime_minutes": uptime, "downtime_minutes": 60 - uptime, "expected_minutes": 60, "last_status": last_status}
+
+
+def _hourly_rows(db):
+    return [(row.store_id, row.uptime_minutes, row.last_status) for row in db.scalars(select(StoreStatusHourly).order_by(StoreStatusHourly.store_id, StoreStatusHourly.hour_start))]
+
+
+def test_upsert_updates_conflicting_rows(db):
+    service = BaseCRUDService(StoreStatusHourly)
+    service.bulkUpsert(db, [_hourly(1, 10), _hourly(2, 20)], conflict_keys=("store_id", "hour_start"))
+    first_ids = {row.store_id: row.id for row in db.scalars(select(StoreStatusHourly))}
+
+    ids = service.bulkUpsert(db, [_hourly(2, 45, ActivityStatus.INACTIVE), _hourly(3, 30)], conflict_keys=("store_id", "hour_start"), return_ids=True)
+
+    assert _hourly_rows(db) == [(1, 10, ActivityStatus.ACTIVE), (2, 45, ActivityStatus.INACTIVE), (3, 30, ActivityStatus.ACTIVE)]
+    #the updated row keeps its id
+    assert first_ids[2] in ids and len(ids) == 2
+
+
+def test_upsert_with_chosen_columns(db):
+    service = BaseCRUDService(StoreStatusHourly)
+    service.bulkUpsert(db, [_hourly(1, 10)], conflict_keys=("store_id", "hour_start"))
+    service.bulkUpsert(db, [_hourly(1, 50, ActivityStatus.INACTIVE)], conflict_keys=("store_id", "hour_start"), update_columns=["uptime_minutes"])
+    assert _hourly_rows(db) == [(1, 50, ActivityStatus.ACTIVE)]
+
+
+def test_upsert_do_nothing_keeps_conflicting_rows(db):
+    service = BaseCRUDService(StoreStatusHourly)
+    service.bulkUpsert(db, [_hourly(1, 10)], conflict_keys=("store_id", "hour_start"))
+
+    ids = service.bulkUpsert(db, [_hourly(1, 50), _hourly(2, 20)], conflict_keys=("store_id", "hour_start"), update_columns=[], return_ids=True)
+
+    assert _hourly_rows(db) == [(1, 10, ActivityStatus.ACTIVE), (2, 20, ActivityStatus.ACTIVE)]
+    #only the inserted row comes back
+    assert len(ids) == 1
+
+
+def test_bulk_update_counts_updated_rows(db):
+    service = BaseCRUDService(Store)
+    service.bulkInsert(db, {"id": [1, 2, 3], "timezone": "UTC"})
+
+    updated = service.bulkUpdate(db, [{"id": 1, "timezone": "Asia/Tokyo"}, {"id": 3, "timezone": "Europe/Paris"}, {"id": 99, "timezone": "UTC"}], batch_size=2)
+
+    assert updated == 2
+    assert [(store_id, timezone_name) for store_id, timezone_name, _ in _stores(db)] == [(1, "Asia/Tokyo"), (2, "UTC"), (3, "Europe/Paris")]
+
+
+def test_bulk_update_by_another_key(db):
+    service = BaseCRUDService(Store)
+    service.bulkInsert(db, {"id": [1, 2, 3], "timezone": ["UTC", "UTC", "Asia/Tokyo"]})
+    assert service.bulkUpdate(db, [{"timezone": "UTC", "created_by": "moved"}], key="timezone") == 2
+    assert [created_by for _, _, created_by in _stores(db)] == ["moved", "moved", None]
+
+
+def test_copy_text_escaping():
+    assert _copy_text(None) == "\\N"
+    assert _copy_text("tab\there\nnew\\line\rend") == "tab\\there\\nnew\\\\line\\rend"
+    assert _copy_text(ActivityStatus.INACTIVE) == "INACTIVE"
+    assert _copy_text(True) == "t" and _copy_text(False) == "f"
+    assert _copy_text(12.5) == "12.5"
+    assert _copy_text(datetime(2023, 1, 19, 8, 3, 7, 5, tzinfo=timezone.utc)) == "2023-01-19 08:03:07.000005+00:00"
+    assert _copy_text(date(2023, 1, 19)) == "2023-01-19"
+    assert _copy_text(time(23, 59, 59)) == "23:59:59"
+
+
+def test_copy_falls_back_to_text_for_types_without_a_binary_encoding():
+    #the float minute columns have no binary encoder
+    payload = BaseCRUDService(StoreStatusHourly)._encode_copy([
+        {"store_id": 1, "uptime_minutes": 12.5, "last_status": ActivityStatus.ACTIVE, "created_by": "a\tb"},
+        {"store_id": 2, "uptime_minutes": 0.0, "last_status": None, "created_by": None},
+    ], binary=True)
+    assert not payload.binary
+    assert payload.count == 2
+    assert payload.data == b"1\t12.5\tACTIVE\ta\\tb\n2\t0.0\t\\N\t\\N\n"
+
+
+def _field(value_format, value):
+    size = struct.calcsize(value_format)
+    return struct.pack(f">i{value_format}", size, value)
+
+
+def test_copy_binary_encoding():
+    tokyo = timezone(timedelta(hours=9))
+    payload = BaseCRUDService(StoreStatus)._encode_copy([
+        {"store_id": 7, "timestamp": datetime(2000, 1, 1, 0, 0, 1, tzinfo=timezone.utc), "status": ActivityStatus.INACTIVE, "created_by": None},
+        #another zone is sent as UTC, a naive value is taken as UTC
+        {"store_id": 8, "timestamp": datetime(2000, 1, 1, 9, tzinfo=tokyo), "status": ActivityStatus.ACTIVE, "created_by": "probe"},
+        {"store_id": 9, "timestamp": datetime(1999, 12, 31, 23, 59, 59, 999999), "status": "ACTIVE", "created_by": "probe"},
+    ], binary=True)
+
+    assert payload.binary
+    assert payload.columns == ["store_id", "timestamp", "status", "created_by"]
+    assert payload.count == 3
+    assert PGCOPY_HEADER == b"PGCOPY\n\xff\r\n\x00" + b"\x00" * 8
+    assert payload.data == b"".join([
+        PGCOPY_HEADER,
+        struct.pack(">h", 4), _field("q", 7), _field("q", 1000000), struct.pack(">i", 8) + b"INACTIVE", struct.pack(">i", -1),
+        struct.pack(">h", 4), _field("q", 8), _field("q", 0), struct.pack(">i", 6) + b"ACTIVE", struct.pack(">i", 5) + b"probe",
+        struct.pack(">h", 4), _field("q", 9), _field("q", -1), struct.pack(">i", 6) + b"ACTIVE", struct.pack(">i", 5) + b"probe",
+        PGCOPY_TRAILER,
+    ])
+    assert PGCOPY_TRAILER == b"\xff\xff"
+
+
+def test_encode_copy_fills_defaults_and_counts_rows():
+    payload = BaseCRUDService(Store).encodeCopy({"timezone": ["UTC", "Asia/Tokyo"], "created_by": "backfill"}, binary=False)
+    assert payload.count == 2
+    assert payload.columns == ["timezone", "created_by", "id", "created_at", "updated_at"]
+    lines = payload.data.decode().splitlines()
+    assert [line.split("\t")[:2] for line in lines] == [["UTC", "backfill"], ["Asia/Tokyo", "backfill"]]
+    assert all(int(line.split("\t")[2]) > 0 for line in lines)
@@ -0,0 +1,268 @@
+import asyncio
+from datetime import datetime, time, timedelta, timezone
+import time as clock
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from app.store_status import ingest
+from app.business_hour.model import DayOfWeek
+from app.models import BusinessHour, Store, StoreStatus, StoreStatusHourly
+from app.store_status.enum import ActivityStatus
+from app.store_status.ingest import StatusIngestQueue, parse_pings, read_body
+from app.store_status.service import StoreStatusService
+
+MAX_BYTES = 64
+#a Thursday
+DAY = datetime(2023, 1, 19, tzinfo=timezone.utc)
+
+
+def _client(parsed: list) -> TestClient:
+    app = FastAPI()
+
+    @app.post("/store_status")
+    async def ingest(request: Request):
+        body = await read_body(request, MAX_BYTES)
+        parsed.append(body)
+        return {"bytes": len(body)}
+
+    return TestClient(app)
+
+
+def test_body_up_to_the_limit_is_read():
+    parsed = []
+    response = _client(parsed).post("/store_status", content=b"x" * MAX_BYTES)
+    assert response.status_code == 200
+    assert parsed == [b"x" * MAX_BYTES]
+
+
+def test_oversized_content_length_is_turned_away_before_reading():
+    received = []
+
+    async def receive():
+        received.append(True)
+        return {"type": "http.request", "body": b"x" * (MAX_BYTES + 1), "more_body": False}
+
+    request = Request({"type": "http", "method": "POST", "headers": [(b"content-length", str(MAX_BYTES + 1).encode())]}, receive)
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(read_body(request, MAX_BYTES))
+    assert raised.value.status_code == 413
+    assert received == []
+
+
+def test_streamed_body_is_cut_off_once_over_the_limit():
+    parsed = []
+
+    def chunks():
+        #no Content-Length, chunked transfer
+        for _ in range(1000):
+            yield b"x" * 16
+
+    response = _client(parsed).post("/store_status", content=chunks())
+    assert response.status_code == 413
+    assert parsed == []
+
+
+def _open_all_day(engine, *store_ids):
+    with Session(engine) as db:
+        for store_id in store_ids:
+            db.add(Store(id=store_id, timezone="UTC"))
+            for day in DayOfWeek:
+                db.add(BusinessHour(store_id=store_id, day_of_week=day, start_time=time(0, 0), end_time=time(23, 59, 59)))
+        db.commit()
+
+
+def _queue(engine, **kwargs) -> StatusIngestQueue:
+    from app.services import status_service, store_service, store_status_hourly_service
+    return StatusIngestQueue(status_service, store_service, store_status_hourly_service, engine, **kwargs)
+
+
+def _rollups(engine):
+    with Session(engine) as db:
+        return [
+            (row.store_id, row.hour_start, row.uptime_minutes, row.downtime_minutes, row.expected_minutes, row.last_status)
+            for row in db.scalars(select(StoreStatusHourly).order_by(StoreStatusHourly.store_id, StoreStatusHourly.hour_start))
+        ]
+
+
+def test_late_ping_refreshes_every_later_rollup(app_engine):
+    from app.services import store_status_hourly_service
+    _open_all_day(app_engine, 1)
+    with Session(app_engine) as db:
+        db.add_all([
+            StoreStatus(store_id=1, timestamp=DAY + timedelta(hours=8, minutes=10), status=ActivityStatus.ACTIVE),
+            StoreStatus(store_id=1, timestamp=DAY + timedelta(hours=11, minutes=30), status=ActivityStatus.ACTIVE),
+        ])
+        db.commit()
+    store_status_hourly_service.refresh(DAY + timedelta(hours=8), DAY + timedelta(hours=11, minutes=30))
+
+    #inactive at 08:50, pushed after the rollups through 11:00 were written. hours 9 and 10 start inactive now
+    queue = _queue(app_engine, flush_ms=0)
+    queue.start()
+    queue.submit([(1, DAY + timedelta(hours=8, minutes=50), ActivityStatus.INACTIVE)])
+    queue.close()
+    refreshed = _rollups(app_engine)
+
+    with Session(app_engine) as db:
+        db.query(StoreStatusHourly).delete()
+        db.commit()
+    store_status_hourly_service.refresh(DAY + timedelta(hours=8), DAY + timedelta(hours=11, minutes=30))
+    rebuilt = _rollups(app_engine)
+
+    assert refreshed == rebuilt
+    assert [(uptime, downtime, last_status) for _, _, uptime, downtime, _, last_status in rebuilt] == [
+        (40, 20, ActivityStatus.INACTIVE),
+        (0, 60, ActivityStatus.INACTIVE),
+        (0, 60, ActivityStatus.INACTIVE),
+        (30, 30, ActivityStatus.ACTIVE),
+    ]
+
+
+def test_parse_ndjson_and_csv():
+    ndjson = b'{"store_id": 1, "timestamp_utc": "2023-01-19T08:00:00Z", "status": "active"}\n\n{"store_id": "2", "timestamp_utc": "2023-01-19 10:00:00+02:00", "status": " Inactive "}\n'
+    csv_body = b"store_id,status,timestamp_utc\n1,active,2023-01-19 08:00:00.000000 UTC\n2,inactive,2023-01-19 08:00:00\n"
+    assert parse_pings(ndjson, "application/x-ndjson; charset=utf-8") == [
+        (1, DAY + timedelta(hours=8), ActivityStatus.ACTIVE),
+        (2, DAY + timedelta(hours=8), ActivityStatus.INACTIVE),
+    ]
+    assert parse_pings(csv_body, "text/csv") == [
+        (1, DAY + timedelta(hours=8), ActivityStatus.ACTIVE),
+        (2, DAY + timedelta(hours=8), ActivityStatus.INACTIVE),
+    ]
+    assert parse_pings(b"", "text/csv") == []
+
+
+@pytest.mark.parametrize("body, content_type, status_code, detail", [
+    (b'{"store_id": 1}', "application/json", 415, "Send pings as one of"),
+    (b"\xff\xfe", "text/csv", 400, "UTF-8"),
+    (b'{"store_id": 1, "timestamp_utc": "2023-01-19T08:00:00Z", "status": "active"}\n{"store_id": 1, "status": "active"}', "application/x-ndjson", 400, "Bad ping 2"),
+    (b'{"store_id": 1, "timestamp_utc": "2023-01-19T08:00:00Z", "status": "sleeping"}', "application/x-ndjson", 400, "Bad ping 1"),
+    (b"not json", "application/x-ndjson", 400, "Bad ping 1"),
+    (b"store_id,status,timestamp_utc\nx,active,2023-01-19 08:00:00\n", "text/csv", 400, "Bad ping 1"),
+])
+def test_parse_rejects_bad_bodies(body, content_type, status_code, detail):
+    with pytest.raises(HTTPException) as raised:
+        parse_pings(body, content_type)
+    assert raised.value.status_code == status_code
+    assert detail in raised.value.detail
+
+
+def _statuses(engine):
+    with Session(engine) as db:
+        return db.scalar(select(func.count(StoreStatus.id)))
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = clock.monotonic() + timeout
+    while not predicate():
+        assert clock.monotonic() < deadline, "timed out"
+        clock.sleep(0.01)
+
+
+def _pings(count, store_id=1):
+    return [(store_id, DAY + timedelta(hours=8, seconds=second), ActivityStatus.ACTIVE) for second in range(count)]
+
+
+def test_writes_once_flush_rows_are_waiting(app_engine):
+    _open_all_day(app_engine, 1)
+    queue = _queue(app_engine, flush_rows=3, flush_ms=60000)
+    queue.start()
+    try:
+        queue.submit(_pings(2))
+        clock.sleep(0.2)
+        assert _statuses(app_engine) == 0
+        queue.submit(_pings(1))
+        _wait_for(lambda: _statuses(app_engine) == 3)
+        assert queue.pending() == 0
+    finally:
+        queue.close()
+
+
+def test_writes_once_the_oldest_ping_waited_flush_ms(app_engine):
+    _open_all_day(app_engine, 1)
+    queue = _queue(app_engine, flush_rows=1000, flush_ms=300)
+    queue.start()
+    try:
+        submitted = clock.monotonic()
+        queue.submit(_pings(2))
+        _wait_for(lambda: _statuses(app_engine) == 2)
+        assert clock.monotonic() - submitted >= 0.3
+    finally:
+        queue.close()
+
+
+def test_pings_of_unknown_stores_are_dropped(app_engine):
+    _open_all_day(app_engine, 1)
+    queue = _queue(app_engine, flush_ms=0)
+    queue.start()
+    queue.submit(_pings(2) + _pings(3, store_id=99))
+    queue.close()
+    with Session(app_engine) as db:
+        assert list(db.scalars(select(StoreStatus.store_id))) == [1, 1]
+
+
+def test_full_queue_answers_429_and_shutdown_drains_it(app_engine):
+    _open_all_day(app_engine, 1)
+    queue = _queue(app_engine, flush_rows=1000, flush_ms=60000, max_pending=5, max_batch=4)
+    queue.start()
+    queue.submit(_pings(4))
+
+    with pytest.raises(HTTPException) as raised:
+        queue.submit(_pings(2))
+    assert raised.value.status_code == 429
+    assert "Retry-After" in raised.value.headers
+    with pytest.raises(HTTPException) as raised:
+        queue.submit(_pings(5))
+    assert raised.value.status_code == 413
+
+    queue.close()
+    assert _statuses(app_engine) == 4
+    assert queue.pending() == 0
+
+
+def test_stopped_queue_answers_503(app_engine):
+    queue = _queue(app_engine)
+    with pytest.raises(HTTPException) as raised:
+        queue.submit(_pings(1))
+    assert raised.value.status_code == 503
+
+    queue.start()
+    queue.close()
+    with pytest.raises(HTTPException) as raised:
+        queue.submit(_pings(1))
+    assert raised.value.status_code == 503
+
+
+class FailingStatusService(StoreStatusService):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def bulkInsert(self, db, rows, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise OperationalError("INSERT", {}, Exception("database is down"))
+        return super().bulkInsert(db, rows, *args, **kwargs)
+
+
+def test_failing_writes_answer_503_and_are_retried(app_engine, monkeypatch):
+    from app.services import store_service, store_status_hourly_service
+    monkeypatch.setattr(ingest, "WRITE_RETRY_AFTER", 0.3)
+    _open_all_day(app_engine, 1)
+    queue = StatusIngestQueue(FailingStatusService(failures=1), store_service, store_status_hourly_service, app_engine, flush_ms=0)
+    queue.start()
+    try:
+        queue.submit(_pings(2))
+        _wait_for(lambda: queue._failing)
+        with pytest.raises(HTTPException) as raised:
+            queue.submit(_pings(1))
+        assert raised.value.status_code == 503
+        #the failed batch is written on the retry
+        _wait_for(lambda: _statuses(app_engine) == 2)
+        _wait_for(lambda: not queue._failing)
+        queue.submit(_pings(1))
+    finally:
+        queue.close()
+    assert _statuses(app_engine) == 3
@@ -0,0 +1,159 @@
+import inspect
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from app import instrumentation
+from app.config import Config
+from app.crud import BaseCRUDService
+from app.models import Store
+
+
+def test_failed_statement_leaves_no_timing_behind(monkeypatch):
+    monkeypatch.setattr(Config, "QUERY_INSTRUMENTATION", True)
+    engine = create_engine("sqlite://")
+    instrumentation.instrument_engine(engine)
+
+    with instrumentation.query_stats("test") as stats, engine.connect() as conn:
+        conn.execute(text("select 1"))
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                conn.execute(text("select * from missing_table"))
+        conn.execute(text("select 2"))
+
+        assert not [key for key in conn.info if "started" in key]
+
+    #only the statements that ran are recorded, each with its own timing
+    assert stats.count == 2
+    assert stats.to_dict()["call_sites"][instrumentation.UNTAGGED]["max_ms"] < 1000
+
+
+@pytest.fixture
+def instrumented(engine, monkeypatch):
+    #services are tagged when their class is created, which happened with instrumentation off
+    monkeypatch.setattr(Config, "QUERY_INSTRUMENTATION", True)
+    for name, method in list(vars(BaseCRUDService).items()):
+        if not name.startswith("_") and inspect.isfunction(method):
+            monkeypatch.setattr(BaseCRUDService, name, instrumentation._tagged(method))
+    instrumentation.reset()
+    instrumentation.instrument_engine(engine)
+    yield engine
+    instrumentation.reset()
+
+
+def _seed(engine, count):
+    with Session(engine) as db:
+        BaseCRUDService(Store).bulkInsert(db, {"id": range(1, count + 1), "timezone": "UTC"})
+
+
+def test_counts_and_latency_histograms_per_call_site(instrumented):
+    _seed(instrumented, 3)
+    service = BaseCRUDService(Store)
+    with instrumentation.query_stats("unit") as stats, Session(instrumented) as db:
+        service.findAll(db)
+        service.findOneById(db, 1)
+        service.findOneById(db, 2)
+        db.execute(text("select 1"))
+
+    summary = stats.to_dict()
+    assert summary["name"] == "unit"
+    assert summary["count"] == 4
+    assert summary["duration_ms"] >= summary["total_ms"]
+    sites = summary["call_sites"]
+    assert {name: site["count"] for name, site in sites.items()} == {"Store.findAll": 1, "Store.findOneById": 2, instrumentation.UNTAGGED: 1}
+    for site in sites.values():
+        assert sum(site["histogram"].values()) == site["count"]
+        assert site["max_ms"] >= site["mean_ms"] > 0
+    #the process wide stats saw the seeding too
+    assert instrumentation.process_stats.to_dict()["call_sites"]["Store.bulkInsert"]["count"] == 1
+
+
+def test_histogram_buckets():
+    stats = instrumentation.QueryStats()
+    for elapsed_ms in (0.5, 1, 3, 30, 30, 7000):
+        stats.record("Store.findAll", "SELECT 1", elapsed_ms)
+    site = stats.to_dict()["call_sites"]["Store.findAll"]
+    assert site["histogram"] == {"<=1ms": 2, "<=5ms": 1, "<=50ms": 2, ">5000ms": 1}
+    assert site["max_ms"] == 7000
+
+
+def test_statements_are_tagged_with_the_innermost_service_method(instrumented):
+    _seed(instrumented, 2)
+
+    class StoreLookup(BaseCRUDService[Store]):
+        def timezones(self, db, store_ids):
+            #its own statement, then one inside another tagged method
+            timezones = list(db.scalars(select(Store.timezone).where(Store.id.in_(store_ids))))
+            self.findOneById(db, store_ids[0])
+            return timezones
+
+        def stream_ids(self, db):
+            yield from db.scalars(select(Store.id))
+
+    lookup = StoreLookup(Store)
+    with instrumentation.query_stats("unit") as stats, Session(instrumented) as db:
+        assert lookup.timezones(db, [1, 2]) == ["UTC", "UTC"]
+        for _ in lookup.stream_ids(db):
+            #statements the caller runs between items are not the generator's
+            db.execute(text("select 1"))
+
+    counts = {name: site["count"] for name, site in stats.to_dict()["call_sites"].items()}
+    assert counts == {"Store.timezones": 1, "Store.findOneById": 1, "Store.stream_ids": 1, instrumentation.UNTAGGED: 2}
+
+
+def test_repeated_select_shapes_are_n_plus_one_suspects(instrumented, capsys):
+    threshold = Config.QUERY_N_PLUS_ONE_THRESHOLD
+    _seed(instrumented, threshold + 5)
+    service = BaseCRUDService(Store)
+    with instrumentation.query_stats("GET /stores") as stats, Session(instrumented) as db:
+        #in lists of any length are one shape, repeated threshold times
+        for size in range(2, threshold + 2):
+            service.findAllByAttributes(db, id={"$in": list(range(1, size + 1))})
+        #one short of the threshold
+        for store_id in range(1, threshold):
+            service.findOneById(db, store_id)
+    suspects = stats.n_plus_one_suspects()
+
+    assert [(suspect["call_site"], suspect["count"]) for suspect in suspects] == [("Store.findAllByAttributes", threshold)]
+    assert "IN (...)" in suspects[0]["statement"]
+    assert f"Possible N+1 in GET /stores: {threshold} x Store.findAllByAttributes" in capsys.readouterr().out
+    assert instrumentation.recent_units[-1]["n_plus_one_suspects"] == suspects
+
+
+def test_query_shapes_collapse_placeholder_lists():
+    assert instrumentation.query_shape("SELECT *\n  FROM stores WHERE id IN (?, ?, ?)") == "SELECT * FROM stores WHERE id IN (...)"
+    assert instrumentation.query_shape("SELECT * FROM stores WHERE id IN (%(id_1)s, %(id_2)s)") == "SELECT * FROM stores WHERE id IN (...)"
+
+
+def test_header_and_debug_endpoint(instrumented):
+    from app.main import collect_query_stats, debug_queries
+    _seed(instrumented, 2)
+    app = FastAPI()
+    app.middleware("http")(collect_query_stats)
+    app.get("/debug/queries")(debug_queries)
+
+    @app.get("/stores")
+    async def stores():
+        with Session(instrumented) as db:
+            return [BaseCRUDService(Store).findOneById(db, store_id).id for store_id in (1, 2)]
+
+    client = TestClient(app)
+    response = client.get("/stores")
+    assert response.json() == [1, 2]
+    assert response.headers["X-Query-Count"] == "2"
+    assert float(response.headers["X-Query-Time-Ms"]) > 0
+
+    snapshot = client.get("/debug/queries").json()
+    assert snapshot["recent"][-1]["name"] == "GET /stores"
+    assert snapshot["recent"][-1]["call_sites"]["Store.findOneById"]["count"] == 2
+    assert snapshot["process"]["call_sites"]["Store.findOneById"]["count"] == 2
+
+
+def test_debug_endpoint_is_off_without_instrumentation(monkeypatch):
+    from app.main import debug_queries
+    monkeypatch.setattr(Config, "QUERY_INSTRUMENTATION", False)
+    app = FastAPI()
+    app.get("/debug/queries")(debug_queries)
+    assert TestClient(app).get("/debug/queries").status_code == 404
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+import time
+import fakeredis
+import pytest
+from app.store.poll_coordinator import PollCoordinator
+
+CYCLE = datetime(2023, 1, 19, 8, 0, tzinfo=timezone.utc)
+NEXT_CYCLE = CYCLE + timedelta(hours=1)
+
+
+@pytest.fixture
+def coordinator():
+    return PollCoordinator(client=fakeredis.FakeRedis(), lock_ttl=60)
+
+
+def test_a_running_shard_holds_back_the_same_index_of_the_next_cycle(coordinator):
+    coordinator.start_cycle(CYCLE)
+    token = coordinator.begin_shard(0, CYCLE)
+    assert token is not None
+
+    #the next cycle's shard 0 may cover a different store id range, it waits for the same lock
+    coordinator.start_cycle(NEXT_CYCLE)
+    assert coordinator.begin_shard(0, NEXT_CYCLE) is None
+    assert coordinator.begin_shard(1, NEXT_CYCLE) is not None
+
+    coordinator.finish_shard(0, CYCLE, token)
+    assert coordinator.begin_shard(0, NEXT_CYCLE) is not None
+
+
+def test_shards_of_an_older_cycle_and_polled_shards_are_skipped(coordinator):
+    coordinator.start_cycle(CYCLE)
+    token = coordinator.begin_shard(0, CYCLE)
+    coordinator.finish_shard(0, CYCLE, token)
+    assert coordinator.watermarks() == {0: CYCLE.timestamp()}
+    #delivered twice
+    assert coordinator.begin_shard(0, CYCLE) is None
+
+    coordinator.start_cycle(NEXT_CYCLE)
+    assert coordinator.begin_shard(1, CYCLE) is None
+
+
+def test_abandoned_shard_can_run_again(coordinator):
+    coordinator.start_cycle(CYCLE)
+    token = coordinator.begin_shard(0, CYCLE)
+    coordinator.abandon_shard(0, token)
+    assert coordinator.watermarks() == {}
+    assert coordinator.begin_shard(0, CYCLE) is not None
+
+
+def test_release_leaves_a_lock_taken_by_another_run(coordinator):
+    coordinator.start_cycle(CYCLE)
+    stale_token = coordinator.begin_shard(0, CYCLE)
+    #the lock expired while the shard was still running and the next cycle took it
+    coordinator.client.delete(coordinator._lock_key(0))
+    coordinator.start_cycle(NEXT_CYCLE)
+    token = coordinator.begin_shard(0, NEXT_CYCLE)
+
+    coordinator.finish_shard(0, CYCLE, stale_token)
+    assert coordinator.client.get(coordinator._lock_key(0)) == token.encode()
+    coordinator.abandon_shard(0, stale_token)
+    assert coordinator.client.get(coordinator._lock_key(0)) == token.encode()
+
+    coordinator.finish_shard(0, NEXT_CYCLE, token)
+    assert coordinator.client.get(coordinator._lock_key(0)) is None
+
+
+def test_a_shard_overrunning_the_lock_ttl_keeps_its_lock():
+    coordinator = PollCoordinator(client=fakeredis.FakeRedis(), lock_ttl=0.2)
+    coordinator.start_cycle(CYCLE)
+    token = coordinator.begin_shard(0, CYCLE)
+
+    with coordinator.hold_shard(0, token):
+        #well past the ttl and into the next cycle, the running shard still holds the lock
+        time.sleep(0.7)
+        coordinator.start_cycle(NEXT_CYCLE)
+        assert coordinator.begin_shard(0, NEXT_CYCLE) is None
+    coordinator.finish_shard(0, CYCLE, token)
+
+    assert coordinator.begin_shard(0, NEXT_CYCLE) is not None
+
+
+def test_the_lock_of_a_dead_worker_expires_after_the_ttl():
+    coordinator = PollCoordinator(client=fakeredis.FakeRedis(), lock_ttl=0.2)
+    coordinator.start_cycle(CYCLE)
+    #taken and never renewed or released
+    assert coordinator.begin_shard(0, CYCLE) is not None
+
+    coordinator.start_cycle(NEXT_CYCLE)
+    assert coordinator.begin_shard(0, NEXT_CYCLE) is None
+    time.sleep(0.3)
+    assert coordinator.begin_shard(0, NEXT_CYCLE) is not None
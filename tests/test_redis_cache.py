@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import time
+import fakeredis
+import pytest
+from sqlalchemy.orm import Session
+from app.redis import RedisCache
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def _cache(server, **kwargs) -> RedisCache:
+    #every RedisCache on the same server behaves like another process sharing one redis
+    kwargs.setdefault("l1_size", 100)
+    kwargs.setdefault("l1_ttl", 60)
+    return RedisCache(client=fakeredis.FakeRedis(server=server), async_client=fakeredis.FakeAsyncRedis(server=server), enabled=True, **kwargs)
+
+
+class Counter:
+    def __init__(self, delay: float = 0):
+        self.calls = 0
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return [*args, self.calls]
+
+
+def test_local_tier_answers_without_redis(server):
+    cache = _cache(server)
+    compute = Counter()
+    cached = cache.cached(tags=("stores",))(lambda store_id: compute(store_id))
+
+    assert cached(1) == [1, 1]
+    #gone from redis, still in the local tier
+    cache.client.flushall()
+    assert cached(1) == [1, 1]
+    assert compute.calls == 1
+
+    cache.clear_local()
+    assert cached(1) == [1, 2]
+
+
+def test_local_tier_expires_after_l1_ttl(server):
+    cache, other = _cache(server, l1_ttl=0.05), _cache(server, l1_ttl=0.05)
+    compute = Counter()
+    cached = cache.cached(tags=("stores",))(lambda store_id: compute(store_id))
+
+    assert cached(1) == [1, 1]
+    #another process invalidates, this one keeps its local copy for at most l1_ttl
+    other.invalidate("stores")
+    assert cached(1) == [1, 1]
+    time.sleep(0.1)
+    assert cached(1) == [1, 2]
+
+
+def test_local_tier_can_be_turned_off(server):
+    cache = _cache(server, l1_size=0)
+    compute = Counter()
+    cached = cache.cached()(lambda store_id: compute(store_id))
+
+    cached(1)
+    cache.client.flushall()
+    cached(1)
+    assert compute.calls == 2
+
+
+def test_single_flight_across_threads_and_processes(server):
+    caches = [_cache(server), _cache(server)]
+    compute = Counter(delay=0.2)
+    functions = [cache.cached()(lambda store_id: compute(store_id)) for cache in caches]
+    start = threading.Barrier(8)
+    results = []
+
+    def call(function):
+        start.wait()
+        results.append(function(7))
+
+    threads = [threading.Thread(target=call, args=(functions[i % 2],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert compute.calls == 1
+    assert results == [[7, 1]] * 8
+
+
+def test_single_flight_async(server):
+    cache = _cache(server)
+    calls = 0
+
+    @cache.cached()
+    async def slow(store_id):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.2)
+        return store_id
+
+    async def run():
+        return await asyncio.gather(*(slow(3) for _ in range(5)))
+
+    assert asyncio.run(run()) == [3] * 5
+    assert calls == 1
+
+
+def test_invalidate_drops_tagged_entries(server):
+    cache = _cache(server)
+    compute = Counter()
+    by_store = cache.cached(tags=lambda store_id: [f"store:{store_id}"])(lambda store_id: compute(store_id))
+
+    by_store(1)
+    by_store(2)
+    cache.invalidate("store:1")
+    assert by_store(1) == [1, 3]
+    assert by_store(2) == [2, 2]
+
+
+def test_result_computed_across_an_invalidation_is_not_stored(server):
+    cache, other = _cache(server), _cache(server)
+    calls = 0
+
+    @cache.cached(tags=("stores",))
+    def racing(store_id):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            #rows change while the first result is being computed
+            other.invalidate("stores")
+        return calls
+
+    assert racing(1) == 1
+    assert racing(1) == 2
+    assert racing(1) == 2
+
+
+def test_tags_callable_gets_every_bound_argument(server):
+    cache = _cache(server)
+    seen = []
+
+    def tags(**arguments):
+        seen.append(arguments)
+        return [f"store:{arguments['store_id']}"]
+
+    class Service:
+        @cache.cached(tags=tags)
+        def find(self, db: Session, store_id: int, day: int = 3, *, kind: str = "open"):
+            return [store_id, day, kind]
+
+    service = Service()
+    with Session() as db:
+        assert service.find(db, 5) == [5, 3, "open"]
+        assert service.find(db, store_id=6, kind="closed") == [6, 3, "closed"]
+
+    #self and the session are left out, defaults are filled in
+    assert seen == [{"store_id": 5, "day": 3, "kind": "open"}, {"store_id": 6, "day": 3, "kind": "closed"}]
+    assert cache.client.smembers(f"{cache.namespace}:tag:store:5")
+    assert cache.client.smembers(f"{cache.namespace}:tag:store:6")
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta, timezone
+import io
+import json
+import pyarrow.parquet
+import pytest
+from sqlalchemy.orm import Session
+from app.models import Report, ReportItem, Store
+from app.report import report_formats
+from app.report.artifact_store import LocalDirectoryBlobStore
+from app.report.enum import ReportStatus
+from app.report.report_service import DEFAULT_REPORT_WINDOWS, ReportService
+
+WINDOWS = DEFAULT_REPORT_WINDOWS + [("last_month", timedelta(days=30))]
+
+
+def test_columns_follow_the_windows():
+    assert report_formats.report_columns(DEFAULT_REPORT_WINDOWS) == ['store_id', 'uptime_last_hour', 'uptime_last_day', 'uptime_last_week', 'downtime_last_hour', 'downtime_last_day', 'downtime_last_week']
+    assert report_formats.report_columns(WINDOWS)[4] == 'uptime_last_month'
+    assert report_formats.report_columns(WINDOWS)[-1] == 'downtime_last_month'
+    #an hour long window stays in minutes
+    assert sorted(report_formats.hour_columns(WINDOWS)) == sorted(['uptime_last_day', 'uptime_last_week', 'uptime_last_month', 'downtime_last_day', 'downtime_last_week', 'downtime_last_month'])
+
+
+def test_an_added_window_reaches_every_format():
+    column_names = report_formats.report_columns(WINDOWS)
+    in_hours = report_formats.hour_columns(WINDOWS)
+    columns = report_formats.rows_to_columns([(7, 45, 600, 3000, 9000, 15, 840, 7080, 34200)], column_names, in_hours)
+
+    ndjson = io.BytesIO()
+    report_formats.write_ndjson([columns], ndjson, column_names)
+    assert json.loads(ndjson.getvalue()) == {
+        'store_id': 7, 'uptime_last_hour': 45, 'uptime_last_day': 10.0, 'uptime_last_week': 50.0, 'uptime_last_month': 150.0,
+        'downtime_last_hour': 15, 'downtime_last_day': 14.0, 'downtime_last_week': 118.0, 'downtime_last_month': 570.0,
+    }
+
+    parquet = io.BytesIO()
+    report_formats.write_columnar('parquet', [columns], parquet, column_names, in_hours)
+    table = pyarrow.parquet.read_table(io.BytesIO(parquet.getvalue()))
+    assert table.column_names == column_names
+    assert table.column('uptime_last_month').to_pylist() == [150.0]
+    assert table.schema.field('downtime_last_hour').type == pyarrow.int64()
+
+
+@pytest.fixture
+def report_id(app_engine):
+    with Session(app_engine) as db:
+        db.add(Store(id=1, timezone="UTC"))
+        report = Report(status=ReportStatus.READY, requested_at=datetime(2023, 1, 19, tzinfo=timezone.utc))
+        db.add(report)
+        db.flush()
+        db.add(ReportItem(report_id=report.id, store_id=1, uptime_last_hour=50, uptime_last_day=720, uptime_last_week=3000, downtime_last_hour=10, downtime_last_day=90, downtime_last_week=60))
+        db.commit()
+        return report.id
+
+
+def test_service_downloads_show_only_its_windows(report_id, tmp_path):
+    from app.services import business_hour_service, report_item_service, status_service, store_service, store_status_hourly_service
+    windows = [("last_hour", timedelta(hours=1)), ("last_week", timedelta(weeks=1))]
+    service = ReportService(store_service, status_service, business_hour_service, report_item_service, store_status_hourly_service, LocalDirectoryBlobStore(str(tmp_path)), report_windows=windows)
+
+    assert "".join(service._generate_csv(report_id)).splitlines() == [
+        "store_id,uptime_last_hour,uptime_last_week,downtime_last_hour,downtime_last_week",
+        "1,50,50.0,10,1.0",
+    ]
+    service.materialize_report_format(report_id, 'ndjson')
+    with open(tmp_path / f"report_{report_id}.ndjson") as file:
+        assert json.loads(file.read()) == {'store_id': 1, 'uptime_last_hour': 50, 'uptime_last_week': 50.0, 'downtime_last_hour': 10, 'downtime_last_week': 1.0}
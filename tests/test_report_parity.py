@@ -0,0 +1,142 @@
+from datetime import datetime, time, timedelta, timezone
+from types import SimpleNamespace
+import random
+import pytest
+from app.business_hour.model import DayOfWeek
+from app.business_hour.schedule_index import ScheduleIndex
+from app.report import uptime_engine
+from app.store_status.enum import ActivityStatus
+
+#the fixed "current time" reports are generated for
+NOW = datetime(2023, 1, 19, 8, 3, 7, 391994, tzinfo=timezone.utc)
+WINDOWS = [timedelta(hours=1), timedelta(days=1), timedelta(weeks=1)]
+
+
+def legacy_calculate_uptime_downtime(business_hours, store_statuses, start_date, end_date):
+    #ReportService._calculate_uptime_downtime before the vectorized engine, kept as the reference
+    total_uptime, total_downtime, expected_uptime = 0, 0, 0
+    current_date = start_date.date()
+    total_duration = (end_date - start_date).total_seconds() / 60
+
+    while current_date <= end_date.date():
+        day_of_week = current_date.weekday()
+        day_business_hours = [bh for bh in business_hours if bh.day_of_week.value == day_of_week]
+
+        for bh in day_business_hours:
+            start_datetime = max(datetime.combine(current_date, bh.start_time), start_date)
+            end_datetime = min(datetime.combine(current_date, bh.end_time), end_date)
+
+            if end_datetime <= start_datetime:
+                end_datetime += timedelta(days=1)
+
+            period_duration = min((end_datetime - start_datetime).total_seconds() / 60, total_duration - expected_uptime)
+            expected_uptime += period_duration
+
+            period_status_reports = [sr for sr in store_statuses if start_datetime <= sr.timestamp <= end_datetime]
+            if not period_status_reports:
+                total_downtime += period_duration
+                continue
+
+            last_check_time, last_status = start_datetime, False
+            for sr in period_status_reports:
+                duration = (sr.timestamp - last_check_time).total_seconds() / 60
+                total_uptime += duration if last_status else 0
+                total_downtime += duration if not last_status else 0
+                last_check_time = sr.timestamp
+                last_status = (sr.status == ActivityStatus.ACTIVE)
+
+            final_duration = (end_datetime - last_check_time).total_seconds() / 60
+            total_uptime += final_duration if last_status else 0
+            total_downtime += final_duration if not last_status else 0
+
+        current_date += timedelta(days=1)
+
+    return int(total_uptime), int(total_downtime), int(expected_uptime)
+
+
+def engine_calculate_uptime_downtime(business_hours, timezone_name, store_statuses, start_date, end_date):
+    starts, ends = ScheduleIndex().intervals(business_hours, timezone_name, uptime_engine.to_epoch_us(start_date), uptime_engine.to_epoch_us(end_date))
+    uptime, downtime, expected = uptime_engine.calculate_uptime_downtime(
+        uptime_engine.open_intervals_to_arrays([(starts, ends)]), uptime_engine.statuses_to_arrays([store_statuses]), 1, start_date, end_date)
+    return int(uptime[0]), int(downtime[0]), int(expected[0])
+
+
+def _hours(*spans, days=range(7), tzinfo=timezone.utc):
+    return [
+        SimpleNamespace(day_of_week=DayOfWeek(day), start_time=time(*start, tzinfo=tzinfo), end_time=time(*end, tzinfo=tzinfo))
+        for day in days for start, end in spans
+    ]
+
+
+def _polls(*polls):
+    return [SimpleNamespace(timestamp=timestamp, status=status) for timestamp, status in polls]
+
+
+def _random_polls(rng, start, end, count):
+    #on whole minutes, like the report time and the business hours, so the legacy float sums stay exact
+    minutes = int((end - start).total_seconds() // 60)
+    polls = [(start + timedelta(minutes=rng.randrange(minutes + 1)), rng.choice(list(ActivityStatus))) for _ in range(count)]
+    return _polls(*sorted(polls, key=lambda poll: poll[0]))
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_engine_matches_the_legacy_loop(seed):
+    #UTC stores with one period a day around the report time, the schedules the legacy loop got right
+    rng = random.Random(seed)
+    opens = (rng.randrange(0, 7), rng.randrange(60))
+    closes = (rng.randrange(9, 24), rng.randrange(60))
+    business_hours = _hours((opens, closes), days=rng.sample(range(7), rng.randrange(1, 8)))
+    now = NOW.replace(second=0, microsecond=0)
+    for length in WINDOWS:
+        start = now - length
+        statuses = _random_polls(rng, start, now, rng.randrange(0, 150))
+        assert engine_calculate_uptime_downtime(business_hours, 'UTC', statuses, start, now) == legacy_calculate_uptime_downtime(business_hours, statuses, start, now)
+
+
+#documented divergences, each with what the legacy loop reported and what the engine reports now
+
+def test_divergence_whole_minutes_are_not_lost_to_float_truncation():
+    #the legacy loop summed float minutes and truncated 59.99999... to 59, the engine counts exact microseconds
+    start = NOW - timedelta(hours=1)
+    business_hours = _hours(((0, 0), (23, 0)))
+    statuses = _polls((start + timedelta(seconds=3136, microseconds=522618), ActivityStatus.INACTIVE))
+    assert legacy_calculate_uptime_downtime(business_hours, statuses, start, NOW) == (0, 59, 60)
+    assert engine_calculate_uptime_downtime(business_hours, 'UTC', statuses, start, NOW) == (0, 60, 60)
+
+
+def test_divergence_store_timezone_is_honoured():
+    #05:00 to 10:00 in Tokyo is 20:00 to 01:00 UTC, the legacy loop read the stored times as UTC
+    start = NOW - timedelta(hours=1)
+    business_hours = _hours(((5, 0), (10, 0)))
+    statuses = _polls((start, ActivityStatus.ACTIVE))
+    assert legacy_calculate_uptime_downtime(business_hours, statuses, start, NOW) == (60, 0, 60)
+    assert engine_calculate_uptime_downtime(business_hours, 'Asia/Tokyo', statuses, start, NOW) == (0, 0, 0)
+
+
+def test_divergence_end_of_day_is_midnight():
+    #"open all day" is stored as 00:00 to 23:59:59. the legacy loop lost a second a day and started every
+    #day without a status, the engine reads it as open around the clock
+    start = NOW - timedelta(days=1)
+    business_hours = _hours(((0, 0), (23, 59, 59)))
+    statuses = _polls((start, ActivityStatus.ACTIVE))
+    assert legacy_calculate_uptime_downtime(business_hours, statuses, start, NOW) == (956, 483, 1439)
+    assert engine_calculate_uptime_downtime(business_hours, 'UTC', statuses, start, NOW) == (1440, 0, 1440)
+
+
+def test_divergence_periods_outside_the_window_are_not_wrapped():
+    #01:00 to 05:00 closes before the window opens on its first day. the legacy loop wrapped it into the
+    #next day and capped expected uptime at the window length, the engine counts the 4 hours inside
+    start = NOW - timedelta(days=1)
+    business_hours = _hours(((1, 0), (5, 0)))
+    statuses = _polls((start, ActivityStatus.ACTIVE))
+    assert legacy_calculate_uptime_downtime(business_hours, statuses, start, NOW) == (1256, 183, 1440)
+    assert engine_calculate_uptime_downtime(business_hours, 'UTC', statuses, start, NOW) == (0, 240, 240)
+
+
+def test_divergence_overlapping_periods_count_once():
+    #06:00 to 10:00 and 07:00 to 10:00 on the same days, the legacy loop counted 07:00 to 10:00 twice
+    start = NOW - timedelta(days=1)
+    business_hours = _hours(((6, 0), (10, 0)), ((7, 0), (10, 0)))
+    statuses = _polls((start, ActivityStatus.ACTIVE))
+    assert legacy_calculate_uptime_downtime(business_hours, statuses, start, NOW) == (233, 186, 420)
+    assert engine_calculate_uptime_downtime(business_hours, 'UTC', statuses, start, NOW) == (116, 123, 240)
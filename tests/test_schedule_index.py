@@ -0,0 +1,181 @@
+from datetime import datetime, time, timedelta, timezone
+from types import SimpleNamespace
+import random
+import numpy as np
+import pytest
+import pytz
+from app.business_hour.model import DayOfWeek
+from app.business_hour.schedule_index import ScheduleIndex, _TimezoneOffsets, build_open_intervals, normalize_schedule, schedule_id
+from app.report.uptime_engine import from_epoch_us, to_epoch_us
+
+NEW_YORK = "America/New_York"
+#clocks jump from 02:00 EST to 03:00 EDT on 2023-03-12 and fall back from 02:00 EDT to 01:00 EST on 2023-11-05, both sundays
+SPRING_FORWARD = datetime(2023, 3, 12)
+FALL_BACK = datetime(2023, 11, 5)
+
+
+def _utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def _local_us(day: datetime, hour: int, minute: int = 0) -> int:
+    #wall clock microseconds counted as if the wall clock were UTC
+    return to_epoch_us(day.replace(hour=hour, minute=minute, tzinfo=timezone.utc))
+
+
+def _offsets(day: datetime) -> _TimezoneOffsets:
+    return _TimezoneOffsets(NEW_YORK, to_epoch_us(_utc(day.year, day.month, day.day) - timedelta(days=4)), to_epoch_us(_utc(day.year, day.month, day.day) + timedelta(days=4)))
+
+
+def _hours(*spans, tzinfo=None):
+    #(day, (open h, m), (close h, m)) -> business hour rows
+    return [SimpleNamespace(day_of_week=day, start_time=time(*start, tzinfo=tzinfo), end_time=time(*end, tzinfo=tzinfo)) for day, start, end in spans]
+
+
+def _intervals(business_hours, day: datetime, timezone_name: str = NEW_YORK):
+    start_us = to_epoch_us(_utc(day.year, day.month, day.day) - timedelta(days=1))
+    end_us = to_epoch_us(_utc(day.year, day.month, day.day) + timedelta(days=2))
+    offsets = _TimezoneOffsets(timezone_name, start_us - 4 * 86400_000_000, end_us + 4 * 86400_000_000)
+    starts, ends = build_open_intervals(normalize_schedule(business_hours), offsets, start_us, end_us)
+    return [(from_epoch_us(start), from_epoch_us(end)) for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def test_skipped_wall_clock_times_resolve_to_the_jump():
+    offsets = _offsets(SPRING_FORWARD)
+    local = np.asarray([_local_us(SPRING_FORWARD, 1, 59), _local_us(SPRING_FORWARD, 2), _local_us(SPRING_FORWARD, 2, 30), _local_us(SPRING_FORWARD, 3)])
+    assert [from_epoch_us(value) for value in offsets.to_utc(local).tolist()] == [
+        _utc(2023, 3, 12, 6, 59),
+        #02:00 to 03:00 never happens on the wall clock, it all maps to the instant the clock jumps
+        _utc(2023, 3, 12, 7),
+        _utc(2023, 3, 12, 7),
+        _utc(2023, 3, 12, 7),
+    ]
+
+
+def test_repeated_wall_clock_times_resolve_to_their_first_occurrence():
+    offsets = _offsets(FALL_BACK)
+    local = np.asarray([_local_us(FALL_BACK, 0, 30), _local_us(FALL_BACK, 1, 30), _local_us(FALL_BACK, 2, 30)])
+    assert [from_epoch_us(value) for value in offsets.to_utc(local).tolist()] == [
+        _utc(2023, 11, 5, 4, 30),
+        #01:30 happens twice, first in EDT
+        _utc(2023, 11, 5, 5, 30),
+        _utc(2023, 11, 5, 7, 30),
+    ]
+
+
+def test_to_utc_matches_pytz_away_from_transitions():
+    offsets = _offsets(FALL_BACK)
+    tz = pytz.timezone(NEW_YORK)
+    rng = random.Random(0)
+    walls = [datetime(2023, 11, 2) + timedelta(minutes=rng.randrange(6 * 24 * 60)) for _ in range(200)]
+    walls = [wall for wall in walls if not (wall.date() == FALL_BACK.date() and 1 <= wall.hour < 2)]
+    local = np.asarray([to_epoch_us(wall.replace(tzinfo=timezone.utc)) for wall in walls])
+    assert offsets.to_utc(local).tolist() == [to_epoch_us(tz.localize(wall)) for wall in walls]
+
+
+def test_period_spanning_spring_forward_is_an_hour_shorter():
+    #01:00 EST to 03:00 EDT is one hour
+    assert _intervals(_hours((DayOfWeek.SUNDAY, (1, 0), (3, 0))), SPRING_FORWARD) == [(_utc(2023, 3, 12, 6), _utc(2023, 3, 12, 7))]
+
+
+def test_period_spanning_fall_back_is_an_hour_longer():
+    #01:00 EDT to 03:00 EST is three hours
+    assert _intervals(_hours((DayOfWeek.SUNDAY, (1, 0), (3, 0))), FALL_BACK) == [(_utc(2023, 11, 5, 5), _utc(2023, 11, 5, 8))]
+
+
+def test_overnight_spans_across_transitions():
+    #saturday 22:00 to sunday 04:00 local, closing on the day after it opened
+    overnight = _hours((DayOfWeek.SATURDAY, (22, 0), (4, 0)))
+    assert _intervals(overnight, SPRING_FORWARD - timedelta(days=1)) == [(_utc(2023, 3, 12, 3), _utc(2023, 3, 12, 8))]
+    assert _intervals(overnight, FALL_BACK - timedelta(days=1)) == [(_utc(2023, 11, 5, 2), _utc(2023, 11, 5, 9))]
+
+
+def test_touching_and_overlapping_periods_are_merged():
+    monday = datetime(2023, 1, 16)
+    business_hours = _hours(
+        (DayOfWeek.MONDAY, (9, 0), (12, 0)),
+        (DayOfWeek.MONDAY, (12, 0), (14, 0)),
+        (DayOfWeek.MONDAY, (13, 0), (17, 0)),
+        #sunday night into monday morning, touching the monday period at midnight
+        (DayOfWeek.SUNDAY, (22, 0), (0, 0)),
+        (DayOfWeek.MONDAY, (0, 0), (6, 0)),
+    )
+    assert _intervals(business_hours, monday, "UTC") == [(_utc(2023, 1, 15, 22), _utc(2023, 1, 16, 6)), (_utc(2023, 1, 16, 9), _utc(2023, 1, 16, 17))]
+
+
+def test_open_all_day_is_one_interval_across_days_and_transitions():
+    #23:59:59 is read as midnight, so the days touch and merge, also across the shorter day
+    business_hours = _hours(*((day, (0, 0), (23, 59, 59)) for day in DayOfWeek))
+    start_us, end_us = to_epoch_us(_utc(2023, 3, 11)), to_epoch_us(_utc(2023, 3, 14))
+    starts, ends = ScheduleIndex().intervals(business_hours, NEW_YORK, start_us, end_us)
+    assert len(starts) == 1
+    assert starts[0] <= start_us and ends[0] >= end_us
+
+
+def test_schedule_id_ignores_row_order_and_stored_offsets():
+    rows = _hours(
+        (DayOfWeek.MONDAY, (9, 0), (17, 0)),
+        (DayOfWeek.TUESDAY, (9, 0), (17, 0)),
+        (DayOfWeek.SATURDAY, (22, 0), (4, 0)),
+    )
+    shuffled = list(reversed(rows))
+    #the backfills store timetz values, the offset on a bare time means nothing
+    with_offsets = _hours(
+        (DayOfWeek.TUESDAY, (9, 0), (17, 0)),
+        (DayOfWeek.SATURDAY, (22, 0), (4, 0)),
+        (DayOfWeek.MONDAY, (9, 0), (17, 0)),
+        tzinfo=timezone(timedelta(hours=-6)),
+    )
+    ids = {schedule_id(normalize_schedule(business_hours), NEW_YORK) for business_hours in (rows, shuffled, with_offsets, rows + rows)}
+    assert len(ids) == 1
+    assert schedule_id(normalize_schedule(rows), "UTC") not in ids
+    assert schedule_id(normalize_schedule(rows[:2]), NEW_YORK) not in ids
+
+
+def _schedule(hour: int):
+    return _hours((DayOfWeek.MONDAY, (hour, 0), (hour + 1, 0)))
+
+
+@pytest.fixture
+def index():
+    return ScheduleIndex(max_entries=2)
+
+
+def _key(business_hours):
+    return schedule_id(normalize_schedule(business_hours), NEW_YORK)
+
+
+def test_least_recently_used_schedule_is_evicted(index):
+    at = _utc(2023, 1, 16, 12)
+    first, second, third = _schedule(1), _schedule(2), _schedule(3)
+    index.is_open(first, NEW_YORK, at)
+    index.is_open(second, NEW_YORK, at)
+    #first is used again, so second is the oldest when third comes in
+    index.is_open(first, NEW_YORK, at)
+    index.is_open(third, NEW_YORK, at)
+    assert list(index._entries) == [_key(first), _key(third)]
+
+
+def test_entries_are_reused_inside_their_horizon_and_rebuilt_outside(index):
+    business_hours = _schedule(9)
+    index.is_open(business_hours, NEW_YORK, _utc(2023, 1, 16, 12))
+    entry = index._entries[_key(business_hours)]
+    index.open_minutes(business_hours, NEW_YORK, _utc(2023, 1, 16), _utc(2023, 1, 17))
+    assert index._entries[_key(business_hours)] is entry
+
+    assert index.open_minutes(business_hours, NEW_YORK, _utc(2023, 1, 16), _utc(2023, 1, 30)) == 120
+    assert index._entries[_key(business_hours)] is not entry
+
+
+def test_invalidate(index):
+    at = _utc(2023, 1, 16, 12)
+    first, second = _schedule(1), _schedule(2)
+    index.is_open(first, NEW_YORK, at)
+    index.is_open(second, NEW_YORK, at)
+
+    index.invalidate(_key(first))
+    assert list(index._entries) == [_key(second)]
+    index.invalidate("not-a-schedule")
+    assert list(index._entries) == [_key(second)]
+    index.invalidate()
+    assert not index._entries
@@ -0,0 +1,87 @@
+import asyncio
+import socket
+import time
+import httpx
+import pytest
+from app.store.status_probe import HttpStatusProbe
+from app.store_status.enum import ActivityStatus
+
+URL = "http://stores.test/{store_id}/health"
+
+
+def _status_by_store(request: httpx.Request) -> httpx.Response:
+    #store 1 is up, the others answer with their id as the status code
+    store_id = int(request.url.path.split("/")[1])
+    return httpx.Response(200 if store_id == 1 else store_id)
+
+
+def test_only_2xx_is_active():
+    probe = HttpStatusProbe(URL, concurrency=4, timeout=1, transport=httpx.MockTransport(_status_by_store))
+    assert dict(probe.probe([1, 204, 301, 404, 500, 503])) == {
+        1: ActivityStatus.ACTIVE,
+        204: ActivityStatus.ACTIVE,
+        301: ActivityStatus.INACTIVE,
+        404: ActivityStatus.INACTIVE,
+        500: ActivityStatus.INACTIVE,
+        503: ActivityStatus.INACTIVE,
+    }
+
+
+def test_transport_errors_are_inactive():
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.startswith("/2/"):
+            raise httpx.ConnectError("connection refused", request=request)
+        if request.url.path.startswith("/3/"):
+            raise httpx.ReadTimeout("timed out", request=request)
+        return httpx.Response(200)
+
+    probe = HttpStatusProbe(URL, concurrency=2, timeout=1, transport=httpx.MockTransport(handler))
+    assert dict(probe.probe([1, 2, 3])) == {1: ActivityStatus.ACTIVE, 2: ActivityStatus.INACTIVE, 3: ActivityStatus.INACTIVE}
+
+
+def test_a_store_that_never_answers_times_out():
+    #the kernel accepts the connection into the backlog, nothing ever reads the request or answers it
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen(16)
+        probe = HttpStatusProbe(f"http://127.0.0.1:{server.getsockname()[1]}/{{store_id}}", concurrency=4, timeout=0.2)
+
+        started = time.monotonic()
+        assert dict(probe.probe([1, 2, 3, 4])) == {store_id: ActivityStatus.INACTIVE for store_id in (1, 2, 3, 4)}
+        #all four wait out their timeout at the same time
+        assert time.monotonic() - started < 2
+
+
+@pytest.mark.parametrize("concurrency", [1, 3, 8])
+def test_concurrency_limits_probes_in_flight(concurrency):
+    in_flight, most_in_flight = 0, 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, most_in_flight
+        in_flight += 1
+        most_in_flight = max(most_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200)
+
+    probe = HttpStatusProbe(URL, concurrency=concurrency, timeout=1, transport=httpx.MockTransport(handler))
+    results = list(probe.probe(range(1, 41)))
+
+    assert sorted(store_id for store_id, _ in results) == list(range(1, 41))
+    assert most_in_flight == concurrency
+
+
+def test_stopping_early_stops_probing():
+    probed = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        probed.append(request.url.path)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200)
+
+    probe = HttpStatusProbe(URL, concurrency=2, timeout=1, transport=httpx.MockTransport(handler))
+    for _ in probe.probe(range(1, 1001)):
+        break
+
+    #the probes in flight when the caller stopped run out, nothing new is started
+    assert len(probed) < 10
@@ -0,0 +1,43 @@
+from datetime import datetime, time, timedelta, timezone
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from app.business_hour.model import DayOfWeek
+from app.models import BusinessHour, Store, StoreStatus, StoreStatusHourly
+from app.store_status.enum import ActivityStatus
+
+DAY = datetime(2023, 1, 19, tzinfo=timezone.utc)
+
+
+def _store_open_all_day(engine, polls):
+    with Session(engine) as db:
+        db.add(Store(id=1, timezone="UTC"))
+        for day in DayOfWeek:
+            db.add(BusinessHour(store_id=1, day_of_week=day, start_time=time(0, 0), end_time=time(23, 59, 59)))
+        db.add_all(StoreStatus(store_id=1, timestamp=timestamp, status=status) for timestamp, status in polls)
+        db.commit()
+
+
+def _hours(engine):
+    with Session(engine) as db:
+        return [hour.replace(tzinfo=timezone.utc) for hour in db.scalars(select(StoreStatusHourly.hour_start).order_by(StoreStatusHourly.hour_start))]
+
+
+def test_refresh_includes_the_hour_holding_end(app_engine):
+    from app.services import store_status_hourly_service
+    #the last poll of a backfill right on an hour boundary
+    first, last = DAY + timedelta(hours=8, minutes=20), DAY + timedelta(hours=10)
+    _store_open_all_day(app_engine, [(first, ActivityStatus.ACTIVE), (last, ActivityStatus.INACTIVE)])
+
+    store_status_hourly_service.refresh(first, last)
+
+    assert _hours(app_engine) == [DAY + timedelta(hours=8), DAY + timedelta(hours=9), DAY + timedelta(hours=10)]
+
+
+def test_refresh_of_one_instant_covers_its_hour(app_engine):
+    from app.services import store_status_hourly_service
+    polled_at = DAY + timedelta(hours=8)
+    _store_open_all_day(app_engine, [(polled_at, ActivityStatus.ACTIVE)])
+
+    store_status_hourly_service.refresh(polled_at, polled_at)
+
+    assert _hours(app_engine) == [polled_at]
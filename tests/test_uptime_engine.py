@@ -0,0 +1,119 @@
+from datetime import timedelta
+import numpy as np
+import pytest
+from app.report import uptime_engine
+from app.report.uptime_engine import MICROSECONDS_PER_DAY, MICROSECONDS_PER_HOUR, MICROSECONDS_PER_MINUTE
+
+#2023-01-09 00:00 UTC, rollups start here and every window starts at least a day later
+RANGE_START_US = 1673222400 * 1_000_000
+RANGE_END_US = RANGE_START_US + 9 * MICROSECONDS_PER_DAY
+
+
+def _mixed_fixture(seed: int):
+    """Open intervals and polls of stores with very different schedules and polling habits."""
+    rng = np.random.default_rng(seed)
+    schedules = [
+        #open around the clock
+        [(RANGE_START_US, RANGE_END_US)],
+        #9 to 17 every day
+        [(RANGE_START_US + day * MICROSECONDS_PER_DAY + 9 * MICROSECONDS_PER_HOUR, RANGE_START_US + day * MICROSECONDS_PER_DAY + 17 * MICROSECONDS_PER_HOUR) for day in range(9)],
+        #over midnight, 20:30 to 03:15
+        [(RANGE_START_US + day * MICROSECONDS_PER_DAY + 20 * MICROSECONDS_PER_HOUR + 30 * MICROSECONDS_PER_MINUTE, RANGE_START_US + (day + 1) * MICROSECONDS_PER_DAY + 3 * MICROSECONDS_PER_HOUR + 15 * MICROSECONDS_PER_MINUTE) for day in range(8)],
+        #short odd periods at random
+        sorted({(start, start + int(rng.integers(5, 90)) * MICROSECONDS_PER_MINUTE) for start in (RANGE_START_US + np.arange(0, 9 * 24 * 60, 97) * MICROSECONDS_PER_MINUTE + 7 * MICROSECONDS_PER_MINUTE).tolist()}),
+        #never open
+        [],
+    ]
+    #polls every ~10 minutes, every ~hour, every ~5 hours and never
+    poll_every = [10 * MICROSECONDS_PER_MINUTE, MICROSECONDS_PER_HOUR, 5 * MICROSECONDS_PER_HOUR, None]
+
+    intervals_by_store, statuses = [], []
+    for schedule in schedules:
+        for every in poll_every:
+            store_index = len(intervals_by_store)
+            intervals_by_store.append((np.asarray([start for start, _ in schedule], dtype=np.int64), np.asarray([end for _, end in schedule], dtype=np.int64)))
+            if every is None:
+                continue
+            #jittered to the microsecond, some polls land on hour boundaries
+            timestamps = np.arange(RANGE_START_US, RANGE_END_US, every) + rng.integers(0, every, size=len(range(RANGE_START_US, RANGE_END_US, every)))
+            timestamps[::7] = uptime_engine.floor_hour_us(timestamps[::7])
+            for timestamp in np.unique(timestamps):
+                statuses.append((store_index, int(timestamp), bool(rng.random() < 0.7)))
+
+    statuses.sort()
+    return (
+        uptime_engine.open_intervals_to_arrays(intervals_by_store),
+        uptime_engine.StatusArrays(
+            np.asarray([store for store, _, _ in statuses], dtype=np.int64),
+            np.asarray([timestamp for _, timestamp, _ in statuses], dtype=np.int64),
+            np.asarray([active for _, _, active in statuses], dtype=bool),
+        ),
+        len(intervals_by_store),
+    )
+
+
+def _rollups(intervals, statuses, n_stores):
+    #a day at a time, each day continuing from the rollup of the hour before, like StoreStatusHourlyService.refresh
+    chunks = []
+    for start_us in range(RANGE_START_US, RANGE_END_US, MICROSECONDS_PER_DAY):
+        carry_in = np.full(n_stores, uptime_engine.NO_STATUS, dtype=np.int8)
+        if chunks:
+            carry_in = uptime_engine.carry_in_from_rollups(chunks[-1], n_stores, start_us)
+        chunks.append(uptime_engine.calculate_rollup(intervals, statuses, n_stores, start_us, start_us, start_us + MICROSECONDS_PER_DAY, carry_in))
+    return uptime_engine.RollupArrays(*(np.concatenate(column) for column in zip(*chunks)))
+
+
+def _first_polls(statuses, n_stores, windows):
+    first_polls = np.full((len(windows), n_stores), uptime_engine.NO_POLL, dtype=np.int64)
+    for index, (_, start, _) in enumerate(windows):
+        after = statuses.timestamp >= uptime_engine.to_epoch_us(start)
+        np.minimum.at(first_polls[index], statuses.store_index[after], statuses.timestamp[after])
+    return first_polls
+
+
+def _windows(now_us: int):
+    now = uptime_engine.from_epoch_us(now_us)
+    return [
+        ("last_hour", now - timedelta(hours=1), now),
+        ("last_day", now - timedelta(days=1), now),
+        ("last_week", now - timedelta(weeks=1), now),
+        ("few_minutes", now - timedelta(minutes=13), now),
+    ]
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("now_offset_us", [
+    0,
+    3 * MICROSECONDS_PER_MINUTE + 7_391_994,
+    59 * MICROSECONDS_PER_MINUTE + 59_999_999,
+    (11 * 60 + 40) * MICROSECONDS_PER_MINUTE + 123,
+])
+def test_raw_and_rollup_windows_agree(seed, now_offset_us):
+    intervals, statuses, n_stores = _mixed_fixture(seed)
+    rollups = _rollups(intervals, statuses, n_stores)
+    windows = _windows(RANGE_START_US + 8 * MICROSECONDS_PER_DAY + now_offset_us)
+
+    raw = uptime_engine.calculate_windows(intervals, statuses, n_stores, windows)
+    from_rollups = uptime_engine.calculate_windows_from_rollups(intervals, statuses, rollups, _first_polls(statuses, n_stores, windows), n_stores, windows)
+
+    for name, _, _ in windows:
+        for raw_totals, rollup_totals in zip(raw[name], from_rollups[name]):
+            np.testing.assert_array_equal(rollup_totals, raw_totals, err_msg=name)
+
+
+def test_status_before_the_window_is_not_carried_in():
+    #open all day, active at 06:50 and not polled again until 08:30: the window starting at 07:03 is down until 08:30
+    intervals = uptime_engine.open_intervals_to_arrays([(np.asarray([RANGE_START_US]), np.asarray([RANGE_START_US + MICROSECONDS_PER_DAY]))])
+    statuses = uptime_engine.StatusArrays(
+        np.zeros(2, dtype=np.int64),
+        np.asarray([RANGE_START_US + (6 * 60 + 50) * MICROSECONDS_PER_MINUTE, RANGE_START_US + (8 * 60 + 30) * MICROSECONDS_PER_MINUTE], dtype=np.int64),
+        np.asarray([True, True]),
+    )
+    now = uptime_engine.from_epoch_us(RANGE_START_US + (9 * 60 + 3) * MICROSECONDS_PER_MINUTE)
+    windows = [("last_two_hours", now - timedelta(hours=2), now)]
+    rollups = _rollups(intervals, statuses, 1)
+
+    raw = uptime_engine.calculate_windows(intervals, statuses, 1, windows)
+    from_rollups = uptime_engine.calculate_windows_from_rollups(intervals, statuses, rollups, _first_polls(statuses, 1, windows), 1, windows)
+    assert [int(total[0]) for total in raw["last_two_hours"]] == [33, 87, 120]
+    assert [int(total[0]) for total in from_rollups["last_two_hours"]] == [33, 87, 120]